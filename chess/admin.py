@@ -1,6 +1,7 @@
 from django.contrib import admin
-from .models import ChessMatch, ChessPiece
+from .models import ChessMatch, ChessMove, ChessPiece
 
 # Register your models here.
 admin.site.register(ChessMatch)
 admin.site.register(ChessPiece)
+admin.site.register(ChessMove)
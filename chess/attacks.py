@@ -0,0 +1,130 @@
+"""
+Precomputed attack tables for the bitboard engine in board.py.
+
+Knight, king and pawn attacks are plain per-square lookups. Rook and bishop attacks use magic bitboard
+tables: for every square the relevant blocker mask is enumerated once at import and each blocker subset maps
+straight to its attack set. Python's dict hashing takes the place of the magic multiply and shift, which is
+both simpler and faster than 64-bit multiplication on Python ints.
+"""
+WHITE = 'W'
+BLACK = 'B'
+
+FULL_BOARD = (1 << 64) - 1
+
+ROOK_DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+BISHOP_DIRECTIONS = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+KNIGHT_OFFSETS = ((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2))
+KING_OFFSETS = ((1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1))
+
+
+def _on_board(row, column):
+  return 0 <= row < 8 and 0 <= column < 8
+
+def _jump_table(offsets):
+  table = []
+  for square in range(64):
+    row, column = square >> 3, square & 7
+    bitboard = 0
+    for row_offset, column_offset in offsets:
+      if _on_board(row + row_offset, column + column_offset):
+        bitboard |= 1 << ((row + row_offset) * 8 + column + column_offset)
+    table.append(bitboard)
+  return table
+
+def _pawn_table(forward):
+  return _jump_table(((forward, 1), (forward, -1)))
+
+def _ray(square, row_step, column_step):
+  """
+  Squares reached from square in one direction, nearest first.
+  """
+  row, column = (square >> 3) + row_step, (square & 7) + column_step
+  squares = []
+  while _on_board(row, column):
+    squares.append(row * 8 + column)
+    row += row_step
+    column += column_step
+  return squares
+
+def _slider_attacks(square, occupied, directions):
+  attacks = 0
+  for row_step, column_step in directions:
+    for target in _ray(square, row_step, column_step):
+      attacks |= 1 << target
+      if occupied & (1 << target):
+        break
+  return attacks
+
+def _blocker_mask(square, directions):
+  # The last square of each ray never changes the attack set, leave it out to keep the tables small
+  mask = 0
+  for row_step, column_step in directions:
+    for target in _ray(square, row_step, column_step)[:-1]:
+      mask |= 1 << target
+  return mask
+
+def _slider_table(directions):
+  masks = []
+  tables = []
+  for square in range(64):
+    # Attacks along each direction only depend on blockers on that ray, build those small tables first
+    ray_tables = []
+    for row_step, column_step in directions:
+      ray = _ray(square, row_step, column_step)
+      ray_mask = sum(1 << target for target in ray[:-1])
+      ray_tables.append((ray_mask, {blockers: _slider_attacks(square, blockers, ((row_step, column_step),)) for blockers in _subsets(ray_mask)}))
+
+    mask = _blocker_mask(square, directions)
+    table = {}
+    for blockers in _subsets(mask):
+      attacks = 0
+      for ray_mask, ray_table in ray_tables:
+        attacks |= ray_table[blockers & ray_mask]
+      table[blockers] = attacks
+    masks.append(mask)
+    tables.append(table)
+  return masks, tables
+
+def _subsets(mask):
+  # Carry-Rippler walk over every subset of mask
+  subset = 0
+  while True:
+    yield subset
+    subset = (subset - mask) & mask
+    if not subset:
+      break
+
+KNIGHT_ATTACKS = _jump_table(KNIGHT_OFFSETS)
+KING_ATTACKS = _jump_table(KING_OFFSETS)
+PAWN_ATTACKS = {
+  WHITE: _pawn_table(1),
+  BLACK: _pawn_table(-1),
+}
+
+ROOK_MASKS, ROOK_TABLES = _slider_table(ROOK_DIRECTIONS)
+BISHOP_MASKS, BISHOP_TABLES = _slider_table(BISHOP_DIRECTIONS)
+
+# Squares strictly between two squares on a shared line, used for check blocking and pins
+BETWEEN = [[0] * 64 for _ in range(64)]
+# Whole line through two aligned squares, used to keep pinned pieces on their pin ray
+LINE = [[0] * 64 for _ in range(64)]
+for _square in range(64):
+  for _row_step, _column_step in ROOK_DIRECTIONS + BISHOP_DIRECTIONS:
+    _between = 0
+    _full_line = 1 << _square
+    for _target in _ray(_square, _row_step, _column_step) + _ray(_square, -_row_step, -_column_step):
+      _full_line |= 1 << _target
+    for _target in _ray(_square, _row_step, _column_step):
+      BETWEEN[_square][_target] = _between
+      LINE[_square][_target] = _full_line
+      _between |= 1 << _target
+
+
+def rook_attacks(square, occupied):
+  return ROOK_TABLES[square][occupied & ROOK_MASKS[square]]
+
+def bishop_attacks(square, occupied):
+  return BISHOP_TABLES[square][occupied & BISHOP_MASKS[square]]
+
+def queen_attacks(square, occupied):
+  return ROOK_TABLES[square][occupied & ROOK_MASKS[square]] | BISHOP_TABLES[square][occupied & BISHOP_MASKS[square]]
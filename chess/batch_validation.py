@@ -0,0 +1,108 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from .board import (
+  Board, PAWN, QUEEN, FORWARD, PROMOTION_ROW,
+  board_square, square_row, square_column, parse_square, encode_move, promotion_type,
+)
+from .game_state import AttackMaps, game_status
+
+
+_pool = None
+
+
+def parse_move(item):
+  """
+  (from square, to square, promotion) of a batch item, given either as a UCI string ('e7e8q') under 'move'
+  or as from_row, from_column, row, column and an optional promotion piece type like the websocket messages.
+  """
+  if 'move' in item:
+    move = item['move']
+    return parse_square(move[0:2]), parse_square(move[2:4]), promotion_type(move[4:5])
+  return (
+    board_square(int(item['from_row']), int(item['from_column'])),
+    board_square(int(item['row']), int(item['column'])),
+    promotion_type(item.get('promotion')),
+  )
+
+def validate_move(board, from_square, to_square, promotion=None):
+  """
+  Checks a single move with the from-square restricted generator instead of MoveValidator's cached list of
+  every legal move, which only pays off when many moves are tried from the same position.
+  """
+  piece = board.mailbox[from_square]
+  if piece is None or piece[0] != board.turn:
+    return {'valid': False}
+  team, piece_type = piece
+  if piece_type == PAWN and square_row(to_square) == PROMOTION_ROW[team]:
+    promotion = promotion or QUEEN
+  else:
+    promotion = None
+  move = encode_move(from_square, to_square, promotion)
+  if not board.is_legal(move):
+    return {'valid': False}
+
+  captured_square = to_square
+  if piece_type == PAWN and to_square == board.ep_square:
+    captured_square = to_square - FORWARD[team]
+  captured = None
+  if board.mailbox[captured_square] is not None:
+    captured = {
+      'piece_type': board.mailbox[captured_square][1],
+      'row': square_row(captured_square),
+      'column': square_column(captured_square),
+    }
+  attack_maps = AttackMaps(board)
+  attack_maps.push(move)
+  try:
+    status, result, check = game_status(board, attack_maps)
+    return {
+      'valid': True,
+      'captured': captured,
+      'promotion': promotion,
+      'fen': board.fen(),
+      'check': check,
+      'status': status,
+      'result': result,
+    }
+  finally:
+    board.pop()
+
+def validate_chunk(items):
+  """
+  Validates a list of {'fen': ..., move} items. Items sharing a position share one board, which is put back
+  after each move, so replaying alternatives from the same position costs one FEN parse.
+  """
+  boards = {}
+  results = []
+  for item in items:
+    try:
+      fen = item['fen']
+      if not isinstance(fen, str):
+        raise TypeError('fen must be a string')
+      if fen not in boards:
+        boards[fen] = Board.from_fen(fen)
+      results.append(validate_move(boards[fen], *parse_move(item)))
+    except (KeyError, IndexError, TypeError, ValueError) as error:
+      results.append({'valid': False, 'error': f'{type(error).__name__}: {error}'})
+  return results
+
+def validate_moves(items):
+  """
+  Validates many (position, move) pairs in one call. Large batches are split into chunks and spread over a
+  process pool, since validation is pure Python and would otherwise hold the GIL for the whole batch.
+  """
+  options = settings.CHESS_BATCH_VALIDATION
+  items = list(items)
+  if len(items) < options['POOL_THRESHOLD'] or options['PROCESSES'] < 2:
+    return validate_chunk(items)
+  chunk_size = options['CHUNK_SIZE']
+  chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+  return [result for chunk_results in _get_pool().map(validate_chunk, chunks) for result in chunk_results]
+
+def _get_pool():
+  global _pool
+  if _pool is None:
+    _pool = ProcessPoolExecutor(max_workers=settings.CHESS_BATCH_VALIDATION['PROCESSES'])
+  return _pool
@@ -0,0 +1,40 @@
+"""
+Setup shared by the bench_* management commands: a throwaway database to write to and the channel layer to
+broadcast over.
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+@contextmanager
+def bench_database():
+  """
+  Runs the block against a test database that is created for it and dropped afterwards.
+  """
+  if connection.vendor == 'sqlite':
+    # shared-cache in-memory databases fail concurrent writers with "table is locked" instead of waiting, and
+    # worker processes can't see them at all
+    settings.DATABASES['default'].setdefault('TEST', {})['NAME'] = os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+  runner = DiscoverRunner(verbosity=0)
+  old_config = runner.setup_databases()
+  try:
+    yield
+  finally:
+    runner.teardown_databases(old_config)
+
+@contextmanager
+def bench_channel_layer(redis=False):
+  """
+  Runs the block on the in-memory channel layer, or on the configured one when redis is set.
+  """
+  with override_settings(CHANNEL_LAYERS=settings.CHANNEL_LAYERS if redis else IN_MEMORY_CHANNEL_LAYERS):
+    yield
@@ -0,0 +1,594 @@
+from collections import namedtuple
+
+from .attacks import (
+  FULL_BOARD, KNIGHT_ATTACKS, KING_ATTACKS, PAWN_ATTACKS, BETWEEN, LINE,
+  rook_attacks, bishop_attacks, queen_attacks,
+)
+from .zobrist import PIECE_KEYS, CASTLING_KEYS, EN_PASSANT_KEYS, BLACK_TO_MOVE_KEY
+
+
+# Same codes as the ChessPiece choices, kept here so the engine can run without Django loaded
+WHITE = 'W'
+BLACK = 'B'
+TEAMS = (WHITE, BLACK)
+
+PAWN = 'P'
+KNIGHT = 'KN'
+BISHOP = 'B'
+ROOK = 'R'
+QUEEN = 'Q'
+KING = 'KI'
+PIECE_TYPES = (PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING)
+
+# Older matches were created with 'K' for kings, normalise it on the way in
+PIECE_TYPE_ALIASES = {'K': KING}
+
+# Promotion piece is packed into bits 12-14 of a move
+PROMOTION_CODES = {None: 0, KNIGHT: 1, BISHOP: 2, ROOK: 3, QUEEN: 4}
+PROMOTION_PIECES = {code: piece_type for piece_type, code in PROMOTION_CODES.items()}
+# What clients may call a promotion piece: its code, its FEN letter or the display name move broadcasts carry
+PROMOTION_NAMES = {
+  'kn': KNIGHT, 'n': KNIGHT, 'knight': KNIGHT,
+  'b': BISHOP, 'bishop': BISHOP,
+  'r': ROOK, 'rook': ROOK,
+  'q': QUEEN, 'queen': QUEEN,
+}
+
+WHITE_KINGSIDE = 1
+WHITE_QUEENSIDE = 2
+BLACK_KINGSIDE = 4
+BLACK_QUEENSIDE = 8
+ALL_CASTLING = WHITE_KINGSIDE | WHITE_QUEENSIDE | BLACK_KINGSIDE | BLACK_QUEENSIDE
+
+# king from, king to, rook from, rook to, squares that must be empty, squares the king must not cross while attacked
+CASTLING_MOVES = {
+  WHITE_KINGSIDE: (4, 6, 7, 5, (1 << 5) | (1 << 6), (4, 5, 6)),
+  WHITE_QUEENSIDE: (4, 2, 0, 3, (1 << 1) | (1 << 2) | (1 << 3), (4, 3, 2)),
+  BLACK_KINGSIDE: (60, 62, 63, 61, (1 << 61) | (1 << 62), (60, 61, 62)),
+  BLACK_QUEENSIDE: (60, 58, 56, 59, (1 << 57) | (1 << 58) | (1 << 59), (60, 59, 58)),
+}
+CASTLING_BY_TEAM = {
+  WHITE: (WHITE_KINGSIDE, WHITE_QUEENSIDE),
+  BLACK: (BLACK_KINGSIDE, BLACK_QUEENSIDE),
+}
+CASTLING_BY_KING_MOVE = {(move[0], move[1]): right for right, move in CASTLING_MOVES.items()}
+
+# Rights that survive a piece leaving or landing on each square
+CASTLING_KEEP = [ALL_CASTLING] * 64
+CASTLING_KEEP[4] &= ~(WHITE_KINGSIDE | WHITE_QUEENSIDE)
+CASTLING_KEEP[7] &= ~WHITE_KINGSIDE
+CASTLING_KEEP[0] &= ~WHITE_QUEENSIDE
+CASTLING_KEEP[60] &= ~(BLACK_KINGSIDE | BLACK_QUEENSIDE)
+CASTLING_KEEP[63] &= ~BLACK_KINGSIDE
+CASTLING_KEEP[56] &= ~BLACK_QUEENSIDE
+
+STARTING_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+FEN_PIECES = {PAWN: 'p', KNIGHT: 'n', BISHOP: 'b', ROOK: 'r', QUEEN: 'q', KING: 'k'}
+FEN_PIECE_TYPES = {letter: piece_type for piece_type, letter in FEN_PIECES.items()}
+FEN_CASTLING = ((WHITE_KINGSIDE, 'K'), (WHITE_QUEENSIDE, 'Q'), (BLACK_KINGSIDE, 'k'), (BLACK_QUEENSIDE, 'q'))
+
+# Same codes as the ChessMatch status and result choices
+ACTIVE = 'A'
+CHECKMATE = 'CM'
+STALEMATE = 'SM'
+INSUFFICIENT_MATERIAL = 'IM'
+THREEFOLD_REPETITION = 'TR'
+FIFTY_MOVES = 'FM'
+UNDECIDED = '*'
+WHITE_WINS = '1-0'
+BLACK_WINS = '0-1'
+DRAW = '1/2-1/2'
+
+DARK_SQUARES = sum(1 << square for square in range(64) if (square >> 3) % 2 == (square & 7) % 2)
+
+PAWN_START_ROW = {WHITE: 1, BLACK: 6}
+PROMOTION_ROW = {WHITE: 7, BLACK: 0}
+FORWARD = {WHITE: 8, BLACK: -8}
+
+
+def square_index(row, column):
+  return row * 8 + column
+
+def board_square(row, column):
+  """
+  square_index of coordinates that come from outside. Raises ValueError when they are off the board, where
+  row * 8 + column would alias onto some other square.
+  """
+  if not (0 <= row < 8 and 0 <= column < 8):
+    raise ValueError(f'({row}, {column}) is off the board')
+  return square_index(row, column)
+
+def square_row(square):
+  return square >> 3
+
+def square_column(square):
+  return square & 7
+
+def opponent(team):
+  return BLACK if team == WHITE else WHITE
+
+def encode_move(from_square, to_square, promotion=None):
+  return from_square | (to_square << 6) | (PROMOTION_CODES[promotion] << 12)
+
+def promotion_type(name):
+  """
+  Piece type of a requested promotion ('Q', 'q' and 'Queen' alike), None when none was asked for.
+  Raises ValueError for anything a pawn can't become.
+  """
+  if name is None or name == '':
+    return None
+  try:
+    return PROMOTION_NAMES[str(name).lower()]
+  except KeyError:
+    raise ValueError(f'a pawn cannot promote to {name!r}')
+
+def move_from(move):
+  return move & 63
+
+def move_to(move):
+  return (move >> 6) & 63
+
+def move_promotion(move):
+  return PROMOTION_PIECES[move >> 12]
+
+def square_name(square):
+  return 'abcdefgh'[square & 7] + str((square >> 3) + 1)
+
+def parse_square(name):
+  return board_square(int(name[1:]) - 1, 'abcdefgh'.index(name[0]))
+
+def iter_squares(bitboard):
+  while bitboard:
+    low_bit = bitboard & -bitboard
+    yield low_bit.bit_length() - 1
+    bitboard ^= low_bit
+
+# Read-only stand-in for a ChessPiece row, enough for MoveValidator and move broadcasts
+BoardPiece = namedtuple('BoardPiece', ('id', 'team', 'piece_type', 'row', 'column', 'move_count', 'captured'))
+
+
+class Board:
+  """
+  In-memory board built from a match's ChessPiece rows.
+  Every team/piece type pair is a 64-bit bitboard where bit (row * 8 + column) is set when a piece stands there.
+  A 64 entry mailbox mirrors the bitboards so "what is on this square" is a single lookup.
+  zobrist is the position's Zobrist hash, kept up to date by every push/pop, and zobrist_history holds the
+  hashes of the earlier positions for repetition checks.
+  """
+  def __init__(self):
+    self.bitboards = {team: {piece_type: 0 for piece_type in PIECE_TYPES} for team in TEAMS}
+    self.occupancy = {WHITE: 0, BLACK: 0}
+    self.mailbox = [None] * 64
+    self.piece_ids = {}
+    self.move_counts = {}
+    self.turn = WHITE
+    self.castling = 0
+    self.ep_square = None
+    self.halfmove_clock = 0
+    self.fullmove_number = 1
+    self.history = []
+    self.zobrist = 0
+    self.zobrist_history = []
+
+  @classmethod
+  def from_pieces(cls, pieces):
+    """
+    ChessPiece rows carry no side to move, castling or en passant state, so these are inferred:
+    every move bumps exactly one move_count, unmoved kings and rooks keep their castling rights,
+    and a pawn that has moved once onto its fourth rank is the en passant candidate.
+    """
+    board = cls()
+    total_moves = 0
+    for piece in pieces:
+      total_moves += piece.move_count
+      if piece.captured:
+        continue
+      board.place(
+        piece.team,
+        piece.piece_type,
+        square_index(piece.row, piece.column),
+        piece_id=piece.id,
+        move_count=piece.move_count,
+      )
+    board.turn = WHITE if total_moves % 2 == 0 else BLACK
+    board.fullmove_number = total_moves // 2 + 1
+
+    for right, (king_square, _, rook_square, _, _, _) in CASTLING_MOVES.items():
+      team = WHITE if right in CASTLING_BY_TEAM[WHITE] else BLACK
+      if (board.mailbox[king_square] == (team, KING) and board.move_counts[king_square] == 0
+          and board.mailbox[rook_square] == (team, ROOK) and board.move_counts[rook_square] == 0):
+        board.castling |= right
+
+    mover = opponent(board.turn)
+    candidates = [
+      square for square in iter_squares(board.bitboards[mover][PAWN])
+      if square_row(square) == PAWN_START_ROW[mover] + 2 * (FORWARD[mover] // 8) and board.move_counts[square] == 1
+    ]
+    if len(candidates) == 1:
+      board.ep_square = candidates[0] - FORWARD[mover]
+    board.zobrist = board.compute_zobrist()
+    return board
+
+  @classmethod
+  def from_fen(cls, fen):
+    """
+    Builds a board from a FEN string, the packed position stored on ChessMatch. Raises ValueError (KeyError for
+    an unknown piece letter) when it doesn't describe eight ranks of eight squares.
+    """
+    placement, turn, castling, ep_square, halfmove_clock, fullmove_number = fen.split()
+    ranks = placement.split('/')
+    if len(ranks) != 8 or turn not in ('w', 'b'):
+      raise ValueError(f'{fen!r} is not a FEN')
+    board = cls()
+    for row_index, rank in enumerate(ranks):
+      column = 0
+      for letter in rank:
+        if letter.isdigit():
+          column += int(letter)
+          continue
+        team = WHITE if letter.isupper() else BLACK
+        board.place(team, FEN_PIECE_TYPES[letter.lower()], board_square(7 - row_index, column))
+        column += 1
+      if column != 8:
+        raise ValueError(f'rank {8 - row_index} of {fen!r} is not eight squares')
+    board.turn = WHITE if turn == 'w' else BLACK
+    for right, letter in FEN_CASTLING:
+      if letter in castling:
+        board.castling |= right
+    board.ep_square = None if ep_square == '-' else parse_square(ep_square)
+    board.halfmove_clock = int(halfmove_clock)
+    board.fullmove_number = int(fullmove_number)
+    board.zobrist = board.compute_zobrist()
+    return board
+
+  def fen(self):
+    ranks = []
+    for row in range(7, -1, -1):
+      rank = ''
+      empty = 0
+      for column in range(8):
+        piece = self.mailbox[square_index(row, column)]
+        if piece is None:
+          empty += 1
+          continue
+        if empty:
+          rank += str(empty)
+          empty = 0
+        letter = FEN_PIECES[piece[1]]
+        rank += letter.upper() if piece[0] == WHITE else letter
+      if empty:
+        rank += str(empty)
+      ranks.append(rank)
+    castling = ''.join(letter for right, letter in FEN_CASTLING if self.castling & right) or '-'
+    ep_square = '-' if self.ep_square is None else square_name(self.ep_square)
+    return ' '.join((
+      '/'.join(ranks),
+      'w' if self.turn == WHITE else 'b',
+      castling,
+      ep_square,
+      str(self.halfmove_clock),
+      str(self.fullmove_number),
+    ))
+
+  def attach_pieces(self, pieces):
+    """
+    Links ChessPiece rows to the squares they stand on, so moves can be addressed by piece id.
+    """
+    for piece in pieces:
+      if piece.captured:
+        continue
+      square = square_index(piece.row, piece.column)
+      if self.mailbox[square] is not None:
+        self.piece_ids[square] = piece.id
+        self.move_counts[square] = piece.move_count
+
+  def place(self, team, piece_type, square, piece_id=None, move_count=0):
+    self._put(square, (team, PIECE_TYPE_ALIASES.get(piece_type, piece_type)), piece_id, move_count)
+
+  def _remove(self, square):
+    team, piece_type = piece = self.mailbox[square]
+    bit = 1 << square
+    self.bitboards[team][piece_type] ^= bit
+    self.occupancy[team] ^= bit
+    self.mailbox[square] = None
+    self.zobrist ^= PIECE_KEYS[team][piece_type][square]
+    return piece, self.piece_ids.pop(square, None), self.move_counts.pop(square, 0)
+
+  def _put(self, square, piece, piece_id, move_count):
+    team, piece_type = piece
+    bit = 1 << square
+    self.bitboards[team][piece_type] |= bit
+    self.occupancy[team] |= bit
+    self.mailbox[square] = piece
+    self.piece_ids[square] = piece_id
+    self.move_counts[square] = move_count
+    self.zobrist ^= PIECE_KEYS[team][piece_type][square]
+
+  def _en_passant_key(self):
+    # Only hash the en passant square when a pawn can actually take there, otherwise equal positions would differ
+    if self.ep_square is not None and PAWN_ATTACKS[opponent(self.turn)][self.ep_square] & self.bitboards[self.turn][PAWN]:
+      return EN_PASSANT_KEYS[self.ep_square & 7]
+    return 0
+
+  def compute_zobrist(self):
+    """
+    Hash of the position from scratch, push/pop keep it up to date incrementally afterwards.
+    """
+    zobrist = CASTLING_KEYS[self.castling] ^ self._en_passant_key()
+    if self.turn == BLACK:
+      zobrist ^= BLACK_TO_MOVE_KEY
+    for square, piece in enumerate(self.mailbox):
+      if piece is not None:
+        zobrist ^= PIECE_KEYS[piece[0]][piece[1]][square]
+    return zobrist
+
+  def repetition_count(self):
+    """
+    How many times the current position has occurred, looking back only as far as the last capture or pawn move.
+    """
+    count = 1
+    history = self.zobrist_history
+    for plies_back in range(2, min(self.halfmove_clock, len(history)) + 1, 2):
+      if history[-plies_back] == self.zobrist:
+        count += 1
+    return count
+
+  def is_threefold_repetition(self):
+    return self.repetition_count() >= 3
+
+  def is_fifty_move_rule(self):
+    return self.halfmove_clock >= 100
+
+  def is_insufficient_material(self):
+    """
+    Neither side can ever mate: bare kings, a single minor piece, or only bishops that all stand on one colour.
+    """
+    white, black = self.bitboards[WHITE], self.bitboards[BLACK]
+    if white[PAWN] | white[ROOK] | white[QUEEN] | black[PAWN] | black[ROOK] | black[QUEEN]:
+      return False
+    knights = white[KNIGHT] | black[KNIGHT]
+    bishops = white[BISHOP] | black[BISHOP]
+    minors = knights | bishops
+    if not minors & (minors - 1):
+      return True
+    return not knights and (not bishops & DARK_SQUARES or not bishops & ~DARK_SQUARES)
+
+  @property
+  def occupied(self):
+    return self.occupancy[WHITE] | self.occupancy[BLACK]
+
+  def piece_at(self, square):
+    return self.mailbox[square]
+
+  def is_vacant(self, square):
+    return self.mailbox[square] is None
+
+  def is_enemy_occupied(self, square, team):
+    return bool(self.occupancy[opponent(team)] & (1 << square))
+
+  def find_piece(self, piece_id):
+    for square, square_piece_id in self.piece_ids.items():
+      if square_piece_id == piece_id:
+        return self.piece_on(square)
+    return None
+
+  def piece_on(self, square):
+    if self.mailbox[square] is None:
+      return None
+    team, piece_type = self.mailbox[square]
+    return BoardPiece(
+      self.piece_ids.get(square), team, piece_type, square_row(square), square_column(square), self.move_counts.get(square, 0), False
+    )
+
+  def king_square(self, team):
+    king = self.bitboards[team][KING]
+    return king.bit_length() - 1 if king else None
+
+  def attackers(self, square, team, occupied=None):
+    """
+    Bitboard of team's pieces attacking square.
+    """
+    if occupied is None:
+      occupied = self.occupied
+    pieces = self.bitboards[team]
+    return (
+      (KNIGHT_ATTACKS[square] & pieces[KNIGHT])
+      | (KING_ATTACKS[square] & pieces[KING])
+      | (PAWN_ATTACKS[opponent(team)][square] & pieces[PAWN])
+      | (bishop_attacks(square, occupied) & (pieces[BISHOP] | pieces[QUEEN]))
+      | (rook_attacks(square, occupied) & (pieces[ROOK] | pieces[QUEEN]))
+    )
+
+  def is_attacked(self, square, team, occupied=None):
+    return bool(self.attackers(square, team, occupied))
+
+  def in_check(self, team=None):
+    team = team or self.turn
+    king = self.king_square(team)
+    return king is not None and self.is_attacked(king, opponent(team))
+
+  def pseudo_legal_moves(self, team=None, from_mask=None):
+    """
+    Yields moves that follow each piece's movement rules, ignoring whether they leave the king in check.
+    """
+    team = team or self.turn
+    enemy = opponent(team)
+    pieces = self.bitboards[team]
+    own = self.occupancy[team]
+    enemies = self.occupancy[enemy]
+    occupied = own | enemies
+    empty = ~occupied & FULL_BOARD
+    if from_mask is None:
+      from_mask = own
+
+    # PAWNS, PUSHES AND CAPTURES DONE A WHOLE BITBOARD AT A TIME
+    pawns = pieces[PAWN] & from_mask
+    if pawns:
+      forward = FORWARD[team]
+      promotion_row = PROMOTION_ROW[team]
+      if team == WHITE:
+        single = (pawns << 8) & empty
+        double = ((single & 0xFF0000) << 8) & empty
+      else:
+        single = (pawns >> 8) & empty
+        double = ((single & 0xFF0000000000) >> 8) & empty
+      for to_square in iter_squares(single):
+        yield from self._pawn_moves(to_square - forward, to_square, promotion_row)
+      for to_square in iter_squares(double):
+        yield encode_move(to_square - 2 * forward, to_square)
+      capture_targets = enemies
+      if self.ep_square is not None:
+        capture_targets |= 1 << self.ep_square
+      for from_square in iter_squares(pawns):
+        for to_square in iter_squares(PAWN_ATTACKS[team][from_square] & capture_targets):
+          yield from self._pawn_moves(from_square, to_square, promotion_row)
+
+    for from_square in iter_squares(pieces[KNIGHT] & from_mask):
+      for to_square in iter_squares(KNIGHT_ATTACKS[from_square] & ~own):
+        yield from_square | (to_square << 6)
+    for from_square in iter_squares(pieces[BISHOP] & from_mask):
+      for to_square in iter_squares(bishop_attacks(from_square, occupied) & ~own):
+        yield from_square | (to_square << 6)
+    for from_square in iter_squares(pieces[ROOK] & from_mask):
+      for to_square in iter_squares(rook_attacks(from_square, occupied) & ~own):
+        yield from_square | (to_square << 6)
+    for from_square in iter_squares(pieces[QUEEN] & from_mask):
+      for to_square in iter_squares(queen_attacks(from_square, occupied) & ~own):
+        yield from_square | (to_square << 6)
+    for from_square in iter_squares(pieces[KING] & from_mask):
+      for to_square in iter_squares(KING_ATTACKS[from_square] & ~own):
+        yield from_square | (to_square << 6)
+      for right in CASTLING_BY_TEAM[team]:
+        king_from, king_to, _, _, must_be_empty, king_path = CASTLING_MOVES[right]
+        if (self.castling & right and from_square == king_from and not occupied & must_be_empty
+            and not any(self.is_attacked(square, enemy, occupied) for square in king_path)):
+          yield king_from | (king_to << 6)
+
+  @staticmethod
+  def _pawn_moves(from_square, to_square, promotion_row):
+    if square_row(to_square) == promotion_row:
+      for promotion in (QUEEN, ROOK, BISHOP, KNIGHT):
+        yield encode_move(from_square, to_square, promotion)
+    else:
+      yield from_square | (to_square << 6)
+
+  def legal_moves(self, team=None, from_mask=None):
+    """
+    Yields the moves that do not leave team's own king in check.
+    Pins and checkers are worked out once, so only king moves, en passant and moves made while in check
+    need the slower make/unmake test.
+    """
+    team = team or self.turn
+    enemy = opponent(team)
+    king = self.king_square(team)
+    if king is None:
+      yield from self.pseudo_legal_moves(team, from_mask)
+      return
+
+    occupied = self.occupied
+    checkers = self.attackers(king, enemy)
+    pinned = self._pinned(team, king, occupied)
+    for move in self.pseudo_legal_moves(team, from_mask):
+      from_square = move & 63
+      to_square = (move >> 6) & 63
+      if from_square == king:
+        if abs(to_square - from_square) == 2:
+          # castling already checked the king's path
+          yield move
+        elif not self.attackers(to_square, enemy, occupied ^ (1 << from_square)):
+          yield move
+      elif checkers or to_square == self.ep_square and self.mailbox[from_square][1] == PAWN:
+        if self._leaves_king_safe(move, team):
+          yield move
+      elif not pinned & (1 << from_square) or LINE[king][from_square] & (1 << to_square):
+        yield move
+
+  def _pinned(self, team, king, occupied):
+    enemy = self.bitboards[opponent(team)]
+    pinned = 0
+    snipers = (
+      (rook_attacks(king, 0) & (enemy[ROOK] | enemy[QUEEN]))
+      | (bishop_attacks(king, 0) & (enemy[BISHOP] | enemy[QUEEN]))
+    )
+    for sniper in iter_squares(snipers):
+      blockers = BETWEEN[king][sniper] & occupied
+      if blockers and not blockers & (blockers - 1) and blockers & self.occupancy[team]:
+        pinned |= blockers
+    return pinned
+
+  def _leaves_king_safe(self, move, team):
+    self.push(move)
+    safe = not self.in_check(team)
+    self.pop()
+    return safe
+
+  def is_legal(self, move, team=None):
+    return move in self.legal_moves(team, from_mask=1 << (move & 63))
+
+  def push(self, move):
+    """
+    Plays move on the board, which must be at least pseudo-legal. pop() undoes it.
+    """
+    from_square = move & 63
+    to_square = (move >> 6) & 63
+    promotion = PROMOTION_PIECES[move >> 12]
+    team, piece_type = self.mailbox[from_square]
+    undo = [move, self.castling, self.ep_square, self.halfmove_clock, self.turn, None, None]
+    self.zobrist_history.append(self.zobrist)
+    # take out the old castling and en passant keys, _remove/_put toggle the piece keys as they go
+    self.zobrist ^= CASTLING_KEYS[self.castling] ^ self._en_passant_key() ^ BLACK_TO_MOVE_KEY
+
+    capture_square = to_square
+    if piece_type == PAWN and to_square == self.ep_square:
+      capture_square = to_square - FORWARD[team]
+    if self.mailbox[capture_square] is not None:
+      undo[5] = (capture_square,) + self._remove(capture_square)
+
+    piece, piece_id, move_count = self._remove(from_square)
+    if promotion is not None:
+      piece = (team, promotion)
+    self._put(to_square, piece, piece_id, move_count + 1)
+
+    if piece_type == KING and abs(to_square - from_square) == 2:
+      _, _, rook_from, rook_to, _, _ = CASTLING_MOVES[CASTLING_BY_KING_MOVE[(from_square, to_square)]]
+      # the rook keeps its move_count so that move counts still add up to the number of moves played
+      self._put(rook_to, *self._remove(rook_from))
+      undo[6] = (rook_from, rook_to)
+
+    self.castling &= CASTLING_KEEP[from_square] & CASTLING_KEEP[to_square]
+    if piece_type == PAWN and abs(to_square - from_square) == 16:
+      self.ep_square = from_square + FORWARD[team]
+    else:
+      self.ep_square = None
+    if piece_type == PAWN or undo[5] is not None:
+      self.halfmove_clock = 0
+    else:
+      self.halfmove_clock += 1
+    if team == BLACK:
+      self.fullmove_number += 1
+    self.turn = opponent(team)
+    self.zobrist ^= CASTLING_KEYS[self.castling] ^ self._en_passant_key()
+    self.history.append(undo)
+
+  def pop(self):
+    move, self.castling, self.ep_square, self.halfmove_clock, self.turn, captured, castled = self.history.pop()
+    from_square = move & 63
+    to_square = (move >> 6) & 63
+    if self.turn == BLACK:
+      self.fullmove_number -= 1
+
+    if castled is not None:
+      rook_from, rook_to = castled
+      self._put(rook_from, *self._remove(rook_to))
+
+    piece, piece_id, move_count = self._remove(to_square)
+    if move >> 12:
+      piece = (piece[0], PAWN)
+    self._put(from_square, piece, piece_id, move_count - 1)
+
+    if captured is not None:
+      capture_square, captured_piece, captured_id, captured_count = captured
+      self._put(capture_square, captured_piece, captured_id, captured_count)
+    self.zobrist = self.zobrist_history.pop()
+    return move
@@ -0,0 +1,385 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .board import Board, STARTING_FEN, ACTIVE, UNDECIDED
+from .game_state import AttackMaps
+from .models import ChessMatch, ChessMove, ChessPiece
+
+
+logger = logging.getLogger(__name__)
+
+STARTING_ZOBRIST = Board.from_fen(STARTING_FEN).zobrist
+
+
+class StaleMatch(Exception):
+  """
+  A compare-and-set flush found the stored version moved on, another worker wrote the match since it was loaded.
+  """
+
+class LiveMatch:
+  """
+  A cached board plus what is out of date in the database: the packed position, the moves not yet logged and,
+  while pieces are materialized, the ChessPiece rows touched since the last flush.
+  """
+  # deltas kept in memory so reconnecting clients can usually catch up without a query
+  RECENT_MOVES = 200
+
+  def __init__(self, match_id, board, next_seq=1, status=ACTIVE, result=UNDECIDED, version=0):
+    self.match_id = match_id
+    self.board = board
+    self.version = version
+    # version the database row had when it was last loaded or written by this worker
+    self.stored_version = version
+    self.attack_maps = AttackMaps(board)
+    self.status = status
+    self.result = result
+    self.next_seq = next_seq
+    self.recent_moves = deque(maxlen=self.RECENT_MOVES)
+    self.unsaved_moves = []
+    self.lock = threading.RLock()
+    self.flush_lock = threading.Lock()
+    self.dirty_piece_ids = set()
+    # last position of pieces taken since the previous flush, they are no longer on the board
+    self.captured_pieces = {}
+    self.pending_moves = 0
+    self.oldest_pending = None
+    self.last_access = time.monotonic()
+    # set once the match's rows were rewritten elsewhere (e.g. a reset), the board then takes no moves or flushes
+    self.retired = False
+
+  def retire(self):
+    """
+    Throws away what wasn't written yet and stops the board for good. Waits for a flush already under way, so
+    nothing from this board reaches the database afterwards.
+    """
+    with self.flush_lock, self.lock:
+      self.retired = True
+      self.unsaved_moves = []
+      self.dirty_piece_ids = set()
+      self.captured_pieces = {}
+      self.pending_moves = 0
+      self.oldest_pending = None
+
+  def record_move(self, record, delta, piece_ids, captured_piece=None):
+    self.next_seq = record.seq + 1
+    self.version += 1
+    self.unsaved_moves.append(record)
+    self.recent_moves.append(delta)
+    self.dirty_piece_ids.update(piece_id for piece_id in piece_ids if piece_id is not None)
+    if captured_piece is not None:
+      self.captured_pieces[captured_piece.id] = captured_piece
+    self.pending_moves += 1
+    if self.oldest_pending is None:
+      self.oldest_pending = time.monotonic()
+
+  def flush(self, compare_and_set=False):
+    """
+    Writes the packed position as a single row update, plus one bulk update of the dirty pieces.
+    The board lock is only held while the snapshot is taken, so moves are never stuck behind the database.
+    With compare_and_set the row is only written while its version is still stored_version, otherwise
+    nothing is written and StaleMatch is raised.
+    """
+    with self.flush_lock:
+      with self.lock:
+        if self.retired or not self.pending_moves:
+          return 0
+        fen = self.board.fen()
+        status, result = self.status, self.result
+        rows = {}
+        for square, piece_id in self.board.piece_ids.items():
+          if piece_id in self.dirty_piece_ids:
+            team, piece_type = self.board.mailbox[square]
+            rows[piece_id] = ChessPiece(
+              id=piece_id,
+              piece_type=piece_type,
+              row=square >> 3,
+              column=square & 7,
+              move_count=self.board.move_counts[square],
+            )
+        for piece in self.captured_pieces.values():
+          rows[piece.id] = ChessPiece(
+            id=piece.id,
+            piece_type=piece.piece_type,
+            row=piece.row,
+            column=piece.column,
+            move_count=piece.move_count,
+            captured=True,
+          )
+        snapshot = (self.dirty_piece_ids, self.captured_pieces, self.unsaved_moves, self.pending_moves, self.oldest_pending)
+        self.unsaved_moves = []
+        self.dirty_piece_ids = set()
+        self.captured_pieces = {}
+        self.pending_moves = 0
+        self.oldest_pending = None
+
+      try:
+        with transaction.atomic():
+          if compare_and_set:
+            updated = ChessMatch.objects.filter(pk=self.match_id, version=self.stored_version).update(
+              fen=fen, status=status, result=result, version=self.stored_version + snapshot[3], last_activity=timezone.now(),
+            )
+            if not updated:
+              raise StaleMatch(self.match_id)
+          else:
+            ChessMatch.objects.filter(pk=self.match_id).update(
+              fen=fen, status=status, result=result, version=F('version') + snapshot[3], last_activity=timezone.now(),
+            )
+          ChessMove.objects.bulk_create(snapshot[2])
+          if rows:
+            ChessPiece.objects.bulk_update(rows.values(), ['piece_type', 'row', 'column', 'move_count', 'captured'])
+      except Exception:
+        # put the unsaved state back so the next flush retries it
+        with self.lock:
+          dirty_piece_ids, captured_pieces, unsaved_moves, pending_moves, oldest_pending = snapshot
+          self.unsaved_moves = unsaved_moves + self.unsaved_moves
+          self.dirty_piece_ids |= dirty_piece_ids
+          self.captured_pieces = {**captured_pieces, **self.captured_pieces}
+          self.pending_moves += pending_moves
+          self.oldest_pending = oldest_pending
+        raise
+      self.stored_version += snapshot[3]
+      return snapshot[3]
+
+
+class BoardCache:
+  """
+  Process-local LRU of live boards keyed by match id, with write-behind persistence.
+  A match is flushed after flush_every_moves moves, once its oldest unsaved move is flush_interval_ms old,
+  when it is evicted and when its last socket disconnects.
+  With compare_and_set, for several worker processes sharing matches, every move is written straight away and
+  only lands if nobody else wrote the match since this worker loaded it (see LiveMatch.flush).
+  """
+  def __init__(self, max_matches=1000, ttl_seconds=600, flush_every_moves=10, flush_interval_ms=2000, compare_and_set=False):
+    self.max_matches = max_matches
+    self.ttl_seconds = ttl_seconds
+    self.flush_every_moves = flush_every_moves
+    self.flush_interval_ms = flush_interval_ms
+    self.compare_and_set = compare_and_set
+    self.matches = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.flushed_moves = 0
+    self.stale_writes = 0
+    self._flusher = None
+
+  @classmethod
+  def from_settings(cls):
+    return cls(**{key.lower(): value for key, value in getattr(settings, 'CHESS_BOARD_CACHE', {}).items()})
+
+  def get(self, match_id):
+    live = self.peek(match_id)
+    if live is not None:
+      return live
+    match_id = int(match_id)
+    with self.lock:
+      self.misses += 1
+
+    live = self.load(match_id)
+    with self.lock:
+      # another thread may have loaded the same match meanwhile, keep the first one
+      live = self.matches.setdefault(match_id, live)
+      self.matches.move_to_end(match_id)
+      # the least recently used ones stay cached until their flush went through, see _evict
+      overflow = list(self.matches.values())[:max(0, len(self.matches) - self.max_matches)]
+    for evicted in overflow:
+      self._evict(evicted)
+    self._start_flusher()
+    return live
+
+  @staticmethod
+  def load(match_id):
+    fen, start_fen, status, result, version = ChessMatch.objects.values_list(
+      'fen', 'start_fen', 'status', 'result', 'version',
+    ).get(pk=match_id)
+    board = Board.from_fen(fen)
+    if settings.CHESS_MATERIALIZE_PIECES:
+      board.attach_pieces(ChessPiece.objects.filter(chess_match_id=match_id, captured=False))
+    # the last move plus the positions repetition checks can still look back to
+    recent = list(
+      ChessMove.objects.filter(chess_match_id=match_id).order_by('-seq').values_list('seq', 'position_hash')[:board.halfmove_clock + 1]
+    )
+    board.zobrist_history = [position_hash for _, position_hash in reversed(recent[1:]) if position_hash is not None]
+    if recent and recent[-1][0] == 1 and len(recent) <= board.halfmove_clock:
+      # no capture or pawn move yet, so the starting position still counts
+      board.zobrist_history.insert(0, STARTING_ZOBRIST if start_fen == STARTING_FEN else Board.from_fen(start_fen).zobrist)
+    return LiveMatch(match_id, board, recent[0][0] + 1 if recent else 1, status, result, version)
+
+  def peek(self, match_id):
+    """
+    Returns the cached match without ever touching the database, or None on a miss.
+    """
+    with self.lock:
+      live = self.matches.get(int(match_id))
+      if live is not None:
+        self.hits += 1
+        self.matches.move_to_end(live.match_id)
+        live.last_access = time.monotonic()
+    return live
+
+  def flush_due(self, live):
+    if self.compare_and_set:
+      return live.pending_moves > 0
+    # a finished game is written straight away
+    return live.pending_moves >= self.flush_every_moves or live.pending_moves > 0 and live.status != ACTIVE
+
+  def flush(self, live):
+    try:
+      self.flushed_moves += live.flush(self.compare_and_set)
+    except StaleMatch:
+      # the cached board is behind the database now, the next get loads the current one
+      self.stale_writes += 1
+      self.invalidate(live.match_id)
+      raise
+
+  def is_stale(self, live):
+    """
+    Whether another worker wrote the match since live was loaded, in which case live is dropped from the cache.
+    """
+    if ChessMatch.objects.filter(pk=live.match_id, version=live.stored_version).exists():
+      return False
+    self.invalidate(live.match_id)
+    return True
+
+  def flush_before_read(self, live):
+    """
+    Flushes live so its rows can be read from the database. A board another worker moved past is only dropped,
+    the database already holds the newer state and the next get() loads it.
+    """
+    try:
+      self.flush(live)
+    except StaleMatch:
+      logger.warning('Dropped stale board of match %s', live.match_id)
+
+  def flush_match(self, match_id):
+    live = self.matches.get(int(match_id))
+    if live is not None:
+      self.flush_before_read(live)
+
+  def bump_version(self, match_id, expected=None):
+    """
+    Counts a change made outside the move path (e.g. a join) in the stored and the cached version.
+    With expected the stored version is only bumped while it still equals expected, returns whether it was.
+    """
+    matches = ChessMatch.objects.filter(pk=match_id)
+    if expected is None:
+      matches.update(version=F('version') + 1, last_activity=timezone.now())
+    elif not matches.filter(version=expected).update(version=expected + 1, last_activity=timezone.now()):
+      return False
+    live = self.matches.get(int(match_id))
+    if live is not None:
+      with live.lock:
+        live.version += 1
+        live.stored_version += 1
+    return True
+
+  def invalidate(self, match_id):
+    """
+    Drops a match without flushing, for when its rows were rewritten elsewhere (e.g. a reset). The dropped board
+    is retired, so neither the flusher nor a consumer still holding it can write it back over the new rows.
+    """
+    with self.lock:
+      live = self.matches.pop(int(match_id), None)
+    if live is not None:
+      live.retire()
+
+  def flush_overdue(self):
+    """
+    Flushes matches whose oldest unsaved move is due and evicts the ones idle for longer than ttl_seconds.
+    A match that fails to flush is logged and left for the next tick, the others still go ahead.
+    """
+    now = time.monotonic()
+    with self.lock:
+      live_matches = list(self.matches.values())
+    for live in live_matches:
+      if live.oldest_pending is not None and (now - live.oldest_pending) * 1000 >= self.flush_interval_ms:
+        try:
+          self.flush(live)
+        except Exception:
+          logger.exception('Board cache flush of match %s failed', live.match_id)
+    for live in live_matches:
+      if now - live.last_access > self.ttl_seconds:
+        self._evict(live)
+
+  def flush_queryset(self, queryset):
+    """
+    Flushes the cached matches of queryset that have unsaved moves, so an export of a few matches doesn't wait
+    for everybody else's write-behind backlog.
+    """
+    with self.lock:
+      pending = [match_id for match_id, live in self.matches.items() if live.pending_moves]
+    # a few hundred ids per query stays under every backend's parameter limit
+    for start in range(0, len(pending), 500):
+      for match_id in queryset.filter(pk__in=pending[start:start + 500]).values_list('id', flat=True):
+        self.flush_match(match_id)
+
+  def flush_all(self):
+    for live in list(self.matches.values()):
+      self.flush_before_read(live)
+
+  def _evict(self, live):
+    """
+    Flushes live and only then drops it, so its unsaved moves are never held by nothing but a dropped board and
+    no get() can load the rows behind it meanwhile. When the flush fails the match simply stays cached.
+    """
+    started = time.monotonic()
+    try:
+      self.flush(live)
+    except StaleMatch:
+      # flush already dropped it, the database holds another worker's newer state
+      logger.warning('Board cache evicted stale match %s', live.match_id)
+      return
+    except Exception:
+      logger.exception('Board cache could not flush match %s, keeping it cached', live.match_id)
+      return
+    # a move may have landed or the match been looked up since, live.lock keeps moves out while the board is dropped
+    with live.lock, self.lock:
+      if live.pending_moves or live.last_access >= started or self.matches.get(live.match_id) is not live:
+        return
+      del self.matches[live.match_id]
+      self.evictions += 1
+
+  def _start_flusher(self):
+    if self._flusher is not None:
+      return
+    with self.lock:
+      if self._flusher is None:
+        self._flusher = threading.Thread(target=self._flush_loop, name='board-cache-flusher', daemon=True)
+        self._flusher.start()
+
+  def _flush_loop(self):
+    while True:
+      time.sleep(self.flush_interval_ms / 1000 / 2)
+      close_old_connections()
+      try:
+        self.flush_overdue()
+      except Exception:
+        # keep the dirty state and try again on the next tick
+        logger.exception('Board cache flush failed')
+
+  def stats(self):
+    now = time.monotonic()
+    lookups = self.hits + self.misses
+    pending = [live for live in list(self.matches.values()) if live.oldest_pending is not None]
+    return {
+      'matches': len(self.matches),
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_rate': self.hits / lookups if lookups else None,
+      'evictions': self.evictions,
+      'flushed_moves': self.flushed_moves,
+      'stale_writes': self.stale_writes,
+      'pending_moves': sum(live.pending_moves for live in pending),
+      'write_behind_lag_ms': max(((now - live.oldest_pending) * 1000 for live in pending), default=0),
+    }
+
+
+board_cache = BoardCache.from_settings()
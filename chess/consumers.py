@@ -1,108 +1,371 @@
-from channels.generic.websocket import WebsocketConsumer
-from asgiref.sync import async_to_sync
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 import json
 
+from .board import ACTIVE, board_square
+from .board_cache import board_cache, StaleMatch
+from .executor import database_sync_to_async
+from .match_executor import match_executor
+from .matchmaking import matchmaker, user_group
+from .membership import membership_cache, PLAYER_ROLES, SPECTATOR
+from .game_state import game_status
+from .move_log import TEAM_DISPLAY, PIECE_DISPLAY, STATUS_DISPLAY, move_record, move_delta, recent_moves_after, moves_after
 from .move_validation import MoveValidator
-from .models import ChessMatch, ChessPiece
+from .models import ChessMatch
+from .outbox import Outbox
+from .protocol import BINARY_SUBPROTOCOL, HELLO, ProtocolError, pack, encode_result, encode_moves, encode_position, decode_request
+from .spectators import spectator_broadcaster, spectator_group, spectator_shard, match_position
 
 
-class ChessMatchConsumer(WebsocketConsumer):
+class ChessMatchConsumer(AsyncWebsocketConsumer):
+  """
+  Runs on the event loop, only database calls are handed to the bounded pool in executor.py.
+  Moves are validated against the cached board in memory, so a move normally never leaves the loop.
+  Clients offering the binary subprotocol from protocol.py get msgpack frames, everyone else JSON.
+  Moves of one match go through its single-writer queue in match_executor.py, so they are played and broadcast
+  in the order they arrived. Anyone else who connects watches read-only in the spectator tier of spectators.py.
+  """
   #groups = ["broadcast"]
 
+  # Times a move is replayed on a freshly loaded board after losing a compare-and-set to another worker
+  STALE_RETRIES = 3
+
+  @staticmethod
+  def move_piece(pk, piece_pk, row, column, promotion=None, from_row=None, from_column=None, team=None, format=None):
+    # Blocking version for callers outside the event loop
+    for attempt in range(ChessMatchConsumer.STALE_RETRIES + 1):
+      live = board_cache.get(pk)
+      move_result = ChessMatchConsumer.apply_move(live, piece_pk, row, column, promotion, from_row, from_column, team)
+      if not move_result['move_valid']:
+        if live.retired and attempt < ChessMatchConsumer.STALE_RETRIES:
+          continue
+        # a board behind another worker may turn down a move that is fine on the current one
+        if board_cache.compare_and_set and attempt < ChessMatchConsumer.STALE_RETRIES and board_cache.is_stale(live):
+          continue
+        return move_result
+      if not board_cache.flush_due(live):
+        return move_result
+      try:
+        board_cache.flush(live)
+      except StaleMatch:
+        # another worker moved first, flush already dropped the stale board so the move is tried on the new one
+        if attempt == ChessMatchConsumer.STALE_RETRIES:
+          raise
+        continue
+      return move_result
+
   @staticmethod
-  def move_piece(pk, piece_pk, row, column, format=None):
-    match = ChessMatch.objects.get(pk=pk)
-    pieces = ChessPiece.objects.filter(chess_match=match)
-    piece = pieces.get(pk=piece_pk)
-
-    validator = MoveValidator(pieces, piece, row, column)
-    move_valid = validator.move_is_valid()
-    if move_valid:
-      piece.row = row
-      piece.column = column
-      piece.move_count += 1
-      piece.save()
+  def rejection(live, piece=None):
+    """
+    Result of a move that was not played, with the piece as it still stands when there is one.
+    """
+    if piece is None:
+      return {'id': None, 'row': None, 'column': None, 'move_valid': False, 'status': STATUS_DISPLAY[live.status]}
     return {
-      'id': piece.id, 
-      'team': piece.get_team_display(), 
-      'piece_type': piece.get_piece_type_display(), 
-      'row': piece.row, 
-      'column': piece.column, 
+      'id': piece.id,
+      'team': TEAM_DISPLAY[piece.team],
+      'piece_type': PIECE_DISPLAY[piece.piece_type],
+      'row': piece.row,
+      'column': piece.column,
       'move_count': piece.move_count,
-      'move_valid': move_valid,
+      'move_valid': False,
+      'status': STATUS_DISPLAY[live.status],
     }
 
-  def user_has_match_access(self):
-    match = ChessMatch.objects.get(pk=self.match_id)
-    users = match.users.values()
-    for user in users:
-      if self.user['user_id'] == user['id']:  # Changed user['id'] to user['user_id'] for use with JWT middleware
-        return True
-    return False
+  @staticmethod
+  def apply_move(live, piece_pk, row, column, promotion=None, from_row=None, from_column=None, team=None):
+    """
+    Plays a move on the cached board. When team is given the mover may only move that side's pieces.
+    """
+    # The board lives in the cache between moves, the database is only written by the write-behind flush
+    with live.lock:
+      board = live.board
+      if live.retired:
+        # the match was reset under this board, the next lookup loads the new one
+        return ChessMatchConsumer.rejection(live)
+      # Pieces are addressed by id while ChessPiece rows are materialized, or by the square they stand on.
+      # A piece captured a moment ago or an empty square is an ordinary race, not an error.
+      try:
+        if piece_pk is not None:
+          piece = board.find_piece(int(piece_pk))
+        else:
+          piece = board.piece_on(board_square(int(from_row), int(from_column)))
+        row, column = int(row), int(column)
+      except (TypeError, ValueError):
+        piece = None
+      if piece is None:
+        return ChessMatchConsumer.rejection(live)
+
+      validator = MoveValidator(board, piece, row, column, promotion)
+      # GAME STATUS, TURN ORDER AND SIDE OWNERSHIP COME FIRST, ALL ARE PLAIN COMPARISONS
+      move_valid = live.status == ACTIVE and piece.team == board.turn and team in (None, piece.team) and validator.move_is_valid()
+      if not move_valid:
+        return ChessMatchConsumer.rejection(live, piece)
+
+      castling_rook_id = validator.castling_rook[0] if validator.castling_rook else None
+      captured_piece = board.piece_on(validator.captured_square) if validator.captured_square is not None else None
+      record = move_record(live.match_id, live.next_seq, piece, validator, captured_piece)
+      live.attack_maps.push(validator.move)
+      record.position_hash = board.zobrist
+      moved = board.piece_on(validator.new_square)
+      # CHEAP END OF GAME CHECK, THE ATTACK MAPS ONLY RECOMPUTED THE PIECES THIS MOVE TOUCHED
+      live.status, live.result, check = game_status(board, live.attack_maps)
+
+      delta = move_delta(record)
+      delta.update({
+        'id': moved.id,
+        'move_count': moved.move_count,
+        'move_valid': True,
+        'check': check,
+        'status': STATUS_DISPLAY[live.status],
+        'result': live.result,
+      })
+      if captured_piece is not None:
+        delta['captured']['id'] = captured_piece.id
+      if castling_rook_id is not None:
+        delta['rook']['id'] = castling_rook_id
+      live.record_move(record, delta, (piece.id, castling_rook_id), captured_piece)
+      delta['version'] = live.version
+    return delta
+
+  async def get_live_match(self):
+    return board_cache.peek(self.match_id) or await database_sync_to_async(board_cache.get)(self.match_id)
 
-  def connect(self):
+  async def user_has_match_access(self):
+    # Changed user['id'] to user['user_id'] for use with JWT middleware
+    user_id = self.user['user_id']
+    self.role = membership_cache.cached_role(self.match_id, user_id)
+    if self.role is None:
+      self.role = await database_sync_to_async(membership_cache.role)(self.match_id, user_id)
+    return self.role in PLAYER_ROLES
+
+  async def connect(self):
     # Called on connection.
     self.match_id = self.scope['url_route']['kwargs']['match_id']
-    if self.scope['user']:
-      self.user = self.scope['user']
-    else:
-      self.close()
     self.room_group_name = f'match_{self.match_id}'
+    if not self.scope['user']:
+      await self.close()
+      return
+    self.user = self.scope['user']
+    self.binary = BINARY_SUBPROTOCOL in self.scope.get('subprotocols', ())
 
     # Check that user has access to match
-    if self.user_has_match_access():
+    if await self.user_has_match_access():
+      # Warm the board cache so the first move doesn't pay for loading the pieces
+      live = await self.get_live_match()
+      self.outbox = Outbox.from_settings(self, self.match_id, self.binary)
+
       # Join room group
-      async_to_sync(self.channel_layer.group_add)(
+      await self.channel_layer.group_add(
         self.room_group_name,
         self.channel_name
       )
 
       # To accept the connection call:
-      self.accept()
-      self.send(text_data=json.dumps({
-        'message': f'Hello {self.user}!'
-      }))
+      if self.binary:
+        await self.accept(BINARY_SUBPROTOCOL)
+        await self.send(bytes_data=pack([HELLO, live.next_seq - 1]))
+      else:
+        await self.accept()
+        await self.send(text_data=json.dumps({
+          'message': f'Hello {self.user}!',
+          'seq': live.next_seq - 1,
+        }))
+    elif self.role == SPECTATOR:
+      await self.watch()
+    else:
+      await self.close()
+
+  async def watch(self):
+    """
+    Spectators get the current position now and coalesced positions after that, never the players' move frames.
+    Frames carry seq, one older than the position already shown can be ignored.
+    """
+    self.outbox = Outbox.from_settings(self, self.match_id, self.binary, positions=True)
+    self.shard = spectator_shard(self.channel_name)
+    # counted and in the group before the snapshot is taken, so no move can fall between the two
+    await database_sync_to_async(spectator_broadcaster.watch)(self.match_id, self.shard)
+    await self.channel_layer.group_add(spectator_group(self.match_id, self.shard), self.channel_name)
+    try:
+      snapshot = await match_position(self.match_id)
+    except ChessMatch.DoesNotExist:
+      await self.close()
+      return
+    await self.accept(BINARY_SUBPROTOCOL if self.binary else None)
+    await self.send_position(snapshot)
+
+  async def send_position(self, position):
+    if self.binary:
+      await self.send(bytes_data=encode_position(position))
     else:
-      self.close()
-    
+      await self.send(text_data=json.dumps({'type': 'position', **position}))
 
-  def receive(self, text_data=None, bytes_data=None):
+  async def receive(self, text_data=None, bytes_data=None):
     # Called with either text_data or bytes_data for each frame
-    # You can call:
-    #self.send(text_data="Message received!")
-    text_data_json = json.loads(text_data)
-    move_piece_message = text_data_json['message']
-    print(move_piece_message)
+    if bytes_data is not None:
+      if not self.binary:
+        return
+      try:
+        kind, request = decode_request(bytes_data)
+      except ProtocolError:
+        return
+    else:
+      try:
+        text_data_json = json.loads(text_data)
+        if text_data_json.get('type') == 'sync':
+          kind, request = 'sync', int(text_data_json.get('after', 0))
+        elif text_data_json.get('type') == 'ack':
+          kind, request = 'ack', text_data_json.get('seq')
+        else:
+          kind, request = 'move', text_data_json['message']
+          if not isinstance(request, dict):
+            raise TypeError('message must be an object')
+      except (AttributeError, KeyError, TypeError, ValueError):
+        await self.send(text_data=json.dumps({
+          'type': 'error',
+          'message': 'expected {"message": {move}}, {"type": "sync", "after": seq} or {"type": "ack", "seq": seq}',
+        }))
+        return
+
+    if kind == 'ack':
+      # how far behind the client is, the outbox holds frames back while it lags
+      self.outbox.ack(request)
+      return
+
+    if self.role not in PLAYER_ROLES:
+      # spectators are read-only, catching up just means the current position
+      if kind == 'sync':
+        await self.send_position(await match_position(self.match_id))
+      return
+
+    # CATCH UP A RECONNECTING CLIENT WITH THE MOVES IT MISSED
+    if kind == 'sync':
+      live = await self.get_live_match()
+      moves = recent_moves_after(live, request)
+      if moves is None:
+        moves = await database_sync_to_async(moves_after)(self.match_id, request, live)
+      if self.binary:
+        await self.send(bytes_data=encode_moves(moves))
+      else:
+        await self.send(text_data=json.dumps({'type': 'moves', 'moves': moves}))
+      return
 
-    move_result = self.move_piece(self.match_id, move_piece_message['id'], move_piece_message['row'], move_piece_message['column'])
+    live = await match_executor.submit(self.match_id, lambda: self.play_move(request))
+    if live is not None and board_cache.flush_due(live):
+      # write-behind flushes happen outside the match's queue so the next move doesn't wait for the database
+      await database_sync_to_async(board_cache.flush)(live)
 
-    # Send message to room group
-    async_to_sync(self.channel_layer.group_send)(
+  async def play_move(self, move_piece_message):
+    """
+    Runs on the match's queue: plays the move and broadcasts the result before the next move of the match starts.
+    Returns the live match when a write-behind flush may be due.
+    """
+    move_args = (
+      move_piece_message.get('id'),
+      move_piece_message.get('row'),
+      move_piece_message.get('column'),
+      move_piece_message.get('promotion'),
+      move_piece_message.get('from_row'),
+      move_piece_message.get('from_column'),
+      self.role,
+    )
+    if board_cache.compare_and_set:
+      # every move is written before it is announced, other workers may be playing the same match
+      live = None
+      move_result = await database_sync_to_async(self.move_piece)(self.match_id, *move_args)
+    else:
+      live = await self.get_live_match()
+      move_result = self.apply_move(live, *move_args)
+
+    # Send message to room group, encoded once here for both protocols instead of once per recipient
+    await self.channel_layer.group_send(
       self.room_group_name,
       {
         'type': 'match_message',
-        'message': move_result,
+        'text': json.dumps({'message': move_result}),
+        'bytes': encode_result(move_result),
+        'seq': move_result.get('seq'),
       }
     )
-    '''
-    self.send(text_data=json.dumps({
-      'message': str(message)
-    }))
-    '''
+    if move_result['move_valid']:
+      # spectators are served afterwards by their own task, however many of them there are
+      spectator_broadcaster.publish(self.channel_layer, self.match_id)
+    return live
 
   # Receive message from room group
-  def match_message(self, event):
-    message = event['message']
+  async def match_message(self, event):
+    # Queued for the socket's own writer, a slow client never blocks this consumer's handling of group events
+    await self.outbox.put(event)
 
-    # Send message to WebSocket
-    self.send(text_data=json.dumps({
-      'message': message
-    }))
+  async def spectator_message(self, event):
+    await self.outbox.put(event)
 
-  def disconnect(self, close_code):
+  async def disconnect(self, close_code):
     # Called when the socket closes
+    if getattr(self, 'outbox', None) is not None:
+      self.outbox.close()
+    if getattr(self, 'role', None) == SPECTATOR:
+      if getattr(self, 'shard', None) is not None:
+        await database_sync_to_async(spectator_broadcaster.unwatch)(self.match_id, self.shard)
+        await self.channel_layer.group_discard(spectator_group(self.match_id, self.shard), self.channel_name)
+      return
+    await database_sync_to_async(board_cache.flush_match)(self.match_id)
+
     # Leave room group
-    async_to_sync(self.channel_layer.group_discard)(
+    await self.channel_layer.group_discard(
       self.room_group_name,
       self.channel_name
     )
+
+
+class MatchmakingConsumer(AsyncWebsocketConsumer):
+  """
+  Queue for a game with {"type": "join", "time_control": "5+0", "rating": 1500} and leave with {"type": "leave"}.
+  Closing the socket leaves the queue too. Once paired the socket gets
+  {"type": "match_found", "match": id, "team": "White", "opponent": user id, "time_control": "5+0"}
+  and the player connects to the match's own socket.
+  """
+  async def connect(self):
+    if not self.scope['user']:
+      await self.close()
+      return
+    self.user_id = self.scope['user']['user_id']
+    self.queued = False
+    # every socket of the user hears about the match, whichever one queued
+    await self.channel_layer.group_add(user_group(self.user_id), self.channel_name)
+    await self.accept()
+
+  async def receive(self, text_data=None, bytes_data=None):
+    try:
+      request = json.loads(text_data)
+    except (TypeError, ValueError):
+      return
+    if request.get('type') == 'leave':
+      matchmaker.queue.remove(self.user_id)
+      self.queued = False
+      await self.send(text_data=json.dumps({'type': 'left'}))
+      return
+    if request.get('type') != 'join':
+      return
+    limits = settings.CHESS_MATCHMAKING
+    time_control = request.get('time_control', limits['TIME_CONTROLS'][0])
+    rating = request.get('rating', limits['DEFAULT_RATING'])
+    if time_control not in limits['TIME_CONTROLS'] or not isinstance(rating, int) or not 0 <= rating <= 4000:
+      await self.send(text_data=json.dumps({
+        'type': 'error',
+        'message': f'time_control must be one of {", ".join(limits["TIME_CONTROLS"])} and rating between 0 and 4000',
+      }))
+      return
+    matchmaker.enqueue(self.channel_layer, self.user_id, rating, time_control)
+    self.queued = True
+    await self.send(text_data=json.dumps({'type': 'queued', 'time_control': time_control, 'rating': rating}))
+
+  async def match_found(self, event):
+    self.queued = False
+    await self.send(text_data=json.dumps(event))
+
+  async def disconnect(self, close_code):
+    if self.scope['user']:
+      if self.queued:
+        matchmaker.queue.remove(self.user_id)
+      await self.channel_layer.group_discard(user_group(self.user_id), self.channel_name)
@@ -0,0 +1,25 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+
+class BoundedDatabaseSyncToAsync(DatabaseSyncToAsync):
+  """
+  database_sync_to_async that runs on its own fixed-size pool instead of the loop's default executor.
+  Only database work goes through here, so CHESS_DB_THREADS caps concurrent queries per worker
+  without capping the number of open sockets.
+  """
+  executor = ThreadPoolExecutor(max_workers=settings.CHESS_DB_THREADS, thread_name_prefix='chess-db')
+
+  async def __call__(self, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+      self.executor,
+      functools.partial(self.thread_handler, loop, self.get_current_task(), self.func, *args, **kwargs),
+    )
+
+
+database_sync_to_async = BoundedDatabaseSyncToAsync
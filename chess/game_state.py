@@ -0,0 +1,120 @@
+"""
+End-of-game detection for the bitboard engine in board.py.
+
+AttackMaps keeps the attack set of every piece by square. A move only changes the attacks of the pieces on the
+squares it touched and of the sliders whose rays ran through them, so after each move those few are recomputed
+instead of every piece on the board. game_status() then answers check from the maps and, as long as the king has a
+safe flight square, checkmate and stalemate too, falling back to move generation only when the king is boxed in.
+"""
+from .attacks import KNIGHT_ATTACKS, KING_ATTACKS, PAWN_ATTACKS, LINE, rook_attacks, bishop_attacks, queen_attacks
+from .board import (
+  WHITE, TEAMS, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING,
+  ACTIVE, CHECKMATE, STALEMATE, INSUFFICIENT_MATERIAL, THREEFOLD_REPETITION, FIFTY_MOVES,
+  UNDECIDED, WHITE_WINS, BLACK_WINS, DRAW,
+  iter_squares, opponent,
+)
+
+
+class AttackMaps:
+  def __init__(self, board):
+    self.board = board
+    self.attacks = [0] * 64
+    self.refresh()
+
+  def refresh(self):
+    """
+    Recomputes every piece, for a fresh board or after moves were taken back.
+    """
+    occupied = self.board.occupied
+    for square in range(64):
+      self.attacks[square] = self._piece_attacks(square, occupied)
+
+  def _piece_attacks(self, square, occupied):
+    piece = self.board.mailbox[square]
+    if piece is None:
+      return 0
+    team, piece_type = piece
+    if piece_type == PAWN:
+      return PAWN_ATTACKS[team][square]
+    if piece_type == KNIGHT:
+      return KNIGHT_ATTACKS[square]
+    if piece_type == BISHOP:
+      return bishop_attacks(square, occupied)
+    if piece_type == ROOK:
+      return rook_attacks(square, occupied)
+    if piece_type == QUEEN:
+      return queen_attacks(square, occupied)
+    return KING_ATTACKS[square]
+
+  def update(self, changed):
+    """
+    Brings the maps up to date after the occupancy of the squares in the changed bitboard changed.
+    """
+    board = self.board
+    occupied = board.occupied
+    for square in iter_squares(changed):
+      self.attacks[square] = self._piece_attacks(square, occupied)
+    for team in TEAMS:
+      pieces = board.bitboards[team]
+      for square in iter_squares((pieces[BISHOP] | pieces[ROOK] | pieces[QUEEN]) & ~changed):
+        # a ray only changes when one of the squares it reaches, up to and including its first blocker, did
+        if self.attacks[square] & changed:
+          self.attacks[square] = self._piece_attacks(square, occupied)
+
+  def push(self, move):
+    """
+    Plays move on the board and updates the maps for it.
+    """
+    self.board.push(move)
+    _, _, _, _, _, captured, castled = self.board.history[-1]
+    changed = (1 << (move & 63)) | (1 << ((move >> 6) & 63))
+    if captured is not None:
+      changed |= 1 << captured[0]
+    if castled is not None:
+      changed |= (1 << castled[0]) | (1 << castled[1])
+    self.update(changed)
+
+  def attacked(self, team):
+    """
+    Bitboard of every square team attacks.
+    """
+    attacked = 0
+    for square in iter_squares(self.board.occupancy[team]):
+      attacked |= self.attacks[square]
+    return attacked
+
+
+def has_legal_move(board, attack_maps):
+  team = board.turn
+  enemy = opponent(team)
+  king = board.king_square(team)
+  if king is not None:
+    flights = KING_ATTACKS[king] & ~board.occupancy[team] & ~attack_maps.attacked(enemy)
+    if flights:
+      # squares behind the king on a checking ray look safe only because the king itself blocks them
+      enemy_pieces = board.bitboards[enemy]
+      sliders = enemy_pieces[BISHOP] | enemy_pieces[ROOK] | enemy_pieces[QUEEN]
+      for checker in iter_squares(board.attackers(king, enemy) & sliders):
+        flights &= ~LINE[checker][king] | (1 << checker)
+      if flights:
+        return True
+  return next(board.legal_moves(), None) is not None
+
+def game_status(board, attack_maps):
+  """
+  (status, result, check) for the side to move.
+  """
+  team = board.turn
+  king = board.king_square(team)
+  check = king is not None and bool(attack_maps.attacked(opponent(team)) & (1 << king))
+  if not has_legal_move(board, attack_maps):
+    if check:
+      return CHECKMATE, BLACK_WINS if team == WHITE else WHITE_WINS, check
+    return STALEMATE, DRAW, check
+  if board.is_insufficient_material():
+    return INSUFFICIENT_MATERIAL, DRAW, check
+  if board.is_fifty_move_rule():
+    return FIFTY_MOVES, DRAW, check
+  if board.is_threefold_repetition():
+    return THREEFOLD_REPETITION, DRAW, check
+  return ACTIVE, UNDECIDED, check
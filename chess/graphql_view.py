@@ -0,0 +1,93 @@
+from django.conf import settings
+from graphene_django.views import GraphQLView
+from graphql import GraphQLError
+from graphql.execution import ExecutionResult
+from graphql.language import ast
+from graphql.language.parser import parse
+
+
+# Expected length of the plain list fields, connections are sized by their first/last argument instead
+LIST_SIZES = {
+  'users': 2,
+  'chesspieceSet': 32,
+  'chessmatchSet': 20,
+}
+
+
+class QueryCost:
+  """
+  Static cost of a query document, worked out before anything runs: every object or list field costs 1, and
+  everything selected below a list is counted once per expected item. Scalar fields are free.
+  """
+  def __init__(self, document, variables=None):
+    self.variables = variables or {}
+    self.fragments = {
+      definition.name.value: definition
+      for definition in document.definitions if isinstance(definition, ast.FragmentDefinition)
+    }
+    self.cost = 0
+    self.depth = 0
+    for definition in document.definitions:
+      if isinstance(definition, ast.OperationDefinition):
+        cost, depth = self.selection_cost(definition.selection_set, 0, frozenset())
+        self.cost += cost
+        self.depth = max(self.depth, depth)
+
+  def selection_cost(self, selection_set, depth, fragments_seen):
+    cost = 0
+    deepest = depth
+    for selection in selection_set.selections if selection_set else ():
+      if isinstance(selection, ast.FragmentSpread):
+        name = selection.name.value
+        if name in fragments_seen or name not in self.fragments:
+          continue
+        child_cost, child_depth = self.selection_cost(self.fragments[name].selection_set, depth, fragments_seen | {name})
+      elif isinstance(selection, ast.InlineFragment):
+        child_cost, child_depth = self.selection_cost(selection.selection_set, depth, fragments_seen)
+      elif selection.selection_set:
+        child_cost, child_depth = self.selection_cost(selection.selection_set, depth + 1, fragments_seen)
+        child_cost = 1 + self.list_size(selection) * child_cost
+      else:
+        child_cost, child_depth = 0, depth + 1
+      cost += child_cost
+      deepest = max(deepest, child_depth)
+    return cost, deepest
+
+  def list_size(self, field):
+    for argument in field.arguments or ():
+      if argument.name.value in ('first', 'last'):
+        value = self.argument_value(argument.value)
+        if value is not None:
+          return min(value, settings.CHESS_GRAPHQL['MAX_PAGE_SIZE'])
+    if field.name.value.startswith('all'):
+      return settings.CHESS_GRAPHQL['DEFAULT_PAGE_SIZE']
+    return LIST_SIZES.get(field.name.value, 1)
+
+  def argument_value(self, value):
+    if isinstance(value, ast.IntValue):
+      return int(value.value)
+    if isinstance(value, ast.Variable):
+      variable = self.variables.get(value.name.value)
+      return variable if isinstance(variable, int) else None
+    return None
+
+
+class LimitedGraphQLView(GraphQLView):
+  """
+  GraphQLView that turns away queries nested deeper than MAX_DEPTH or costing more than MAX_COST before they run.
+  """
+  def execute_graphql_request(self, request, data, query, variables, operation_name, show_graphiql=False):
+    if query:
+      try:
+        document = parse(query)
+      except Exception:
+        # let the stock view report the syntax error
+        document = None
+      if document is not None:
+        limits = settings.CHESS_GRAPHQL
+        query_cost = QueryCost(document, variables)
+        if query_cost.depth > limits['MAX_DEPTH']:
+          return ExecutionResult(errors=[GraphQLError(f'Query depth {query_cost.depth} exceeds {limits["MAX_DEPTH"]}')], invalid=True)
+        if query_cost.cost > limits['MAX_COST']:
+          return ExecutionResult(errors=[GraphQLError(f'Query cost {query_cost.cost} exceeds {limits["MAX_COST"]}')], invalid=True)
+    return super().execute_graphql_request(request, data, query, variables, operation_name, show_graphiql)
@@ -0,0 +1,36 @@
+"""
+Games per second of the PGN import. Random legal games are played on the engine, written out as PGN and then
+imported with pgn_import.import_games, so parsing, validation and the bulk writes are all measured.
+"""
+import random
+
+from .board import Board, STARTING_FEN, ACTIVE, square_row, square_column, move_promotion
+from .game_state import AttackMaps, game_status
+from .pgn import game_pgn
+from .pgn_import import import_games
+
+
+def random_games(count, plies, seed=0):
+  """
+  Yields the PGN of `count` random games of up to `plies` plies each.
+  """
+  rng = random.Random(seed)
+  for index in range(count):
+    board = Board.from_fen(STARTING_FEN)
+    attack_maps = AttackMaps(board)
+    moves = []
+    status, result = ACTIVE, '*'
+    while len(moves) < plies and status == ACTIVE:
+      move = rng.choice(list(board.legal_moves()))
+      from_square, to_square = move & 63, (move >> 6) & 63
+      moves.append((square_row(from_square), square_column(from_square), square_row(to_square), square_column(to_square), move_promotion(move)))
+      attack_maps.push(move)
+      status, result, _ = game_status(board, attack_maps)
+    yield game_pgn(index + 1, result, ['White', 'Black'], moves)
+
+def run_benchmark(games=1000, plies=80, processes=None, chunk_size=None, seed=0):
+  """
+  Imports `games` random games and returns import_games' totals.
+  """
+  text = ''.join(random_games(games, plies, seed))
+  return import_games(text.splitlines(keepends=True), chunk_size, processes)
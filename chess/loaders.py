@@ -0,0 +1,57 @@
+from collections import defaultdict
+
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from .models import ChessMatch, ChessPiece
+
+
+class MatchUsersLoader(DataLoader):
+  """
+  Players of many matches in a single query, in the order they joined.
+  """
+  def batch_load_fn(self, match_ids):
+    users = defaultdict(list)
+    links = ChessMatch.users.through.objects.filter(chessmatch_id__in=match_ids).select_related('user').order_by('id')
+    for link in links:
+      users[link.chessmatch_id].append(link.user)
+    return Promise.resolve([users[match_id] for match_id in match_ids])
+
+class UserMatchesLoader(DataLoader):
+  def batch_load_fn(self, user_ids):
+    matches = defaultdict(list)
+    links = ChessMatch.users.through.objects.filter(user_id__in=user_ids).select_related('chessmatch').order_by('id')
+    for link in links:
+      matches[link.user_id].append(link.chessmatch)
+    return Promise.resolve([matches[user_id] for user_id in user_ids])
+
+class MatchPiecesLoader(DataLoader):
+  def batch_load_fn(self, match_ids):
+    pieces = defaultdict(list)
+    for piece in ChessPiece.objects.filter(chess_match_id__in=match_ids).order_by('id'):
+      pieces[piece.chess_match_id].append(piece)
+    return Promise.resolve([pieces[match_id] for match_id in match_ids])
+
+class MatchLoader(DataLoader):
+  def batch_load_fn(self, match_ids):
+    matches = ChessMatch.objects.in_bulk(match_ids)
+    return Promise.resolve([matches.get(match_id) for match_id in match_ids])
+
+
+class Loaders:
+  """
+  One set of loaders per GraphQL request, so results are batched and cached within a request but never shared
+  between users or requests.
+  """
+  def __init__(self):
+    self.match_users = MatchUsersLoader()
+    self.user_matches = UserMatchesLoader()
+    self.match_pieces = MatchPiecesLoader()
+    self.match = MatchLoader()
+
+
+def get_loaders(info):
+  loaders = getattr(info.context, 'chess_loaders', None)
+  if loaders is None:
+    loaders = info.context.chess_loaders = Loaders()
+  return loaders
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from chess.bench import bench_database, bench_channel_layer
+from chess.matchmaking_bench import bench_queue, bench_websocket
+
+
+class Command(BaseCommand):
+  help = (
+    'Reports matchmaking pairings per second, for the queue alone and end to end over MatchmakingConsumer '
+    'websockets. The websocket run uses a throwaway test database.'
+  )
+
+  def add_arguments(self, parser):
+    parser.add_argument('--queue-players', type=int, default=100000, help='Players for the queue-only run, 0 to skip it.')
+    parser.add_argument('--players', type=int, default=200, help='Players for the websocket run, 0 to skip it.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--redis', action='store_true', help='Use the configured channel layer instead of the in-memory one.')
+
+  def handle(self, *args, **options):
+    if options['queue_players']:
+      report = bench_queue(options['queue_players'], options['seed'])
+      self.stdout.write(f'queue       {report["pairs"]} pairs in {report["seconds"]:.2f}s, {report["pairs_per_second"]:.0f} pairs/s')
+
+    if not options['players']:
+      return
+    with bench_database(), bench_channel_layer(options['redis']):
+      report = bench_websocket(options['players'], options['seed'], options['timeout'])
+
+    self.stdout.write(f'websocket   {report["pairs"]} pairs in {report["seconds"]:.2f}s, {report["pairs_per_second"]:.1f} pairs/s')
+    if report['pairs']:
+      self.stdout.write(f'latency     p50 {report["p50_ms"]:.2f}ms  p95 {report["p95_ms"]:.2f}ms')
+      self.stdout.write(f'queries     {report["queries"]} total, {report["queries_per_pair"]:.2f} per pairing')
+    if report['unpaired']:
+      self.stdout.write(self.style.WARNING(f'{report["unpaired"]} players were not paired within the timeout'))
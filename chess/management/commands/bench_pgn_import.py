@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chess.bench import bench_database
+from chess.import_bench import run_benchmark
+
+
+class Command(BaseCommand):
+  help = (
+    'Reports games per second of the PGN import on random engine games, for one or more process counts. '
+    'Uses a throwaway test database.'
+  )
+
+  def add_arguments(self, parser):
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--plies', type=int, default=80, help='Plies per game, fewer when the game ends first.')
+    parser.add_argument(
+      '--processes', type=int, action='append',
+      help='Parser processes, may be repeated. Defaults to 1 and CHESS_PGN_IMPORT PROCESSES.',
+    )
+    parser.add_argument('--chunk-size', type=int, default=settings.CHESS_PGN_IMPORT['CHUNK_SIZE'])
+    parser.add_argument('--seed', type=int, default=0)
+
+  def handle(self, *args, **options):
+    processes = options['processes'] or sorted({1, settings.CHESS_PGN_IMPORT['PROCESSES']})
+    with bench_database():
+      for count in processes:
+        report = run_benchmark(options['games'], options['plies'], count, options['chunk_size'], options['seed'])
+        self.stdout.write(
+          f'{connection.vendor:<10} {count} processes  {report["games"]} games, {report["moves"]} moves in '
+          f'{report["seconds"]:.2f}s  {report["games_per_second"]:.0f} games/s  {report["rejected"]} rejected'
+        )
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from chess.bench import bench_database, bench_channel_layer
+from chess.websocket_bench import run_benchmark
+
+
+class Command(BaseCommand):
+  help = (
+    'Plays simulated matches against ChessMatchConsumer over websockets and reports move-to-broadcast latency, '
+    'throughput and queries per move. Runs against a throwaway test database.'
+  )
+
+  def add_arguments(self, parser):
+    parser.add_argument('--matches', type=int, default=10)
+    parser.add_argument('--moves', type=int, default=40, help='Plies per match, fewer when the game ends first.')
+    parser.add_argument('--rate', type=float, default=2.0, help='Moves per second in each match, 0 for as fast as possible.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--spectators', type=int, default=0, help='Spectators watching each match.')
+    parser.add_argument('--redis', action='store_true', help='Use the configured channel layer instead of the in-memory one.')
+
+  def handle(self, *args, **options):
+    with bench_database(), bench_channel_layer(options['redis']):
+      report = run_benchmark(options['matches'], options['moves'], options['rate'], options['seed'], options['timeout'], options['spectators'])
+
+    self.stdout.write(f'{report["matches"]} matches, {report["moves"]} moves in {report["seconds"]:.2f}s')
+    self.stdout.write(f'throughput  {report["moves_per_second"]:.1f} moves/s')
+    if report['moves']:
+      self.stdout.write(f'latency     p50 {report["p50_ms"]:.2f}ms  p95 {report["p95_ms"]:.2f}ms  p99 {report["p99_ms"]:.2f}ms')
+      self.stdout.write(f'queries     {report["queries"]} total, {report["queries_per_move"]:.2f} per move')
+    if report['spectator_frames']:
+      self.stdout.write(f'spectators  {report["spectator_frames"]} frames received')
+    if report['invalid_moves']:
+      self.stdout.write(self.style.WARNING(f'{report["invalid_moves"]} moves were rejected'))
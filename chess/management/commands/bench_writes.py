@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chess.bench import bench_database
+from chess.write_bench import run_benchmark
+
+
+class Command(BaseCommand):
+  help = (
+    'Reports per-move write throughput of the configured database backend (see DATABASE_ENGINE), with moves '
+    'written from several threads at once. Run it once per backend to compare them. Uses a throwaway test database.'
+  )
+
+  def add_arguments(self, parser):
+    parser.add_argument('--matches', type=int, default=20)
+    parser.add_argument('--moves', type=int, default=40, help='Plies per match, fewer when the game ends first.')
+    parser.add_argument('--threads', type=int, default=settings.CHESS_DB_THREADS)
+    parser.add_argument(
+      '--flush-every', type=int, action='append',
+      help='Moves per flush, may be repeated. Defaults to 1 (write-through) and the configured write-behind batch.',
+    )
+    parser.add_argument('--compare-and-set', action='store_true', help='Write with the multi-process compare-and-set.')
+    parser.add_argument('--seed', type=int, default=0)
+
+  def handle(self, *args, **options):
+    flush_every = options['flush_every'] or sorted({1, settings.CHESS_BOARD_CACHE['FLUSH_EVERY_MOVES']})
+    with bench_database():
+      for flush_every_moves in flush_every:
+        report = run_benchmark(
+          options['matches'], options['moves'], options['threads'], flush_every_moves, options['compare_and_set'], options['seed'],
+        )
+        self.stdout.write(
+          f'{report["vendor"]:<10} flush every {flush_every_moves:<3} {report["moves"]} moves in {report["seconds"]:.2f}s  '
+          f'{report["moves_per_second"]:.0f} moves/s  p50 {report["p50_ms"]:.2f}ms  p99 {report["p99_ms"]:.2f}ms'
+        )
+        for error in report['errors']:
+          self.stdout.write(self.style.ERROR(error))
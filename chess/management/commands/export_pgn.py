@@ -0,0 +1,45 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chess.board_cache import board_cache
+from chess.models import ChessMatch
+from chess.pgn import export_games
+
+
+class Command(BaseCommand):
+  help = 'Writes matches as PGN, one match, one user\'s matches or the whole database, a chunk of matches at a time.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--match', type=int, action='append', help='Match id, may be repeated.')
+    parser.add_argument('--user', help='Only matches this user (id or username) played in.')
+    parser.add_argument('--status', choices=[code for code, _ in ChessMatch.STATUS_CHOICES])
+    parser.add_argument('--output', help='File to write, standard output when left out.')
+    parser.add_argument('--chunk-size', type=int, help='Matches read per query, CHESS_EXPORT_CHUNK_SIZE by default.')
+
+  def handle(self, *args, **options):
+    queryset = ChessMatch.objects.all()
+    if options['match']:
+      queryset = queryset.filter(pk__in=options['match'])
+    if options['user']:
+      lookup = {'pk': options['user']} if options['user'].isdigit() else {'username': options['user']}
+      try:
+        queryset = queryset.filter(users=User.objects.get(**lookup))
+      except User.DoesNotExist:
+        raise CommandError(f'Unknown user {options["user"]}')
+    if options['status']:
+      queryset = queryset.filter(status=options['status'])
+
+    # moves still waiting in this process's board cache belong in the export
+    board_cache.flush_all()
+    output = open(options['output'], 'w', encoding='utf-8') if options['output'] else sys.stdout
+    games = 0
+    try:
+      for pgn in export_games(queryset, options['chunk_size']):
+        output.write(pgn)
+        games += 1
+    finally:
+      if output is not sys.stdout:
+        output.close()
+    self.stderr.write(f'{games} games exported')
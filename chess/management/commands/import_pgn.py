@@ -0,0 +1,43 @@
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chess.pgn_import import import_games
+
+
+class Command(BaseCommand):
+  help = (
+    'Imports the games of a PGN file as finished matches with their move log and final position. Games are parsed '
+    'and validated in a process pool and written in bulk, a chunk per transaction.'
+  )
+
+  def add_arguments(self, parser):
+    parser.add_argument('path', help='PGN file, - for standard input.')
+    parser.add_argument('--chunk-size', type=int, default=settings.CHESS_PGN_IMPORT['CHUNK_SIZE'], help='Games per task and transaction.')
+    parser.add_argument('--processes', type=int, default=settings.CHESS_PGN_IMPORT['PROCESSES'])
+    parser.add_argument('--batch-size', type=int, default=settings.CHESS_PGN_IMPORT['BATCH_SIZE'], help='Rows per INSERT.')
+
+  def handle(self, *args, **options):
+    try:
+      stream = sys.stdin if options['path'] == '-' else open(options['path'], encoding='utf-8', errors='replace')
+    except OSError as error:
+      raise CommandError(error)
+
+    def progress(totals):
+      self.stderr.write(
+        f'{totals["games"]} games, {totals["moves"]} moves, {totals["rejected"]} rejected  '
+        f'{totals["games_per_second"]:.0f} games/s'
+      )
+
+    try:
+      totals = import_games(stream, options['chunk_size'], options['processes'], options['batch_size'], progress)
+    finally:
+      if stream is not sys.stdin:
+        stream.close()
+    for number, message in totals['errors']:
+      self.stderr.write(self.style.WARNING(f'game {number}: {message}'))
+    self.stdout.write(
+      f'{totals["games"]} games imported in {totals["seconds"]:.2f}s, {totals["games_per_second"]:.0f} games/s, '
+      f'{totals["rejected"]} rejected'
+    )
@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chess.perft import (
+  PERFT_POSITIONS, PerftError, run_suite, nodes_per_second, check_counts, load_baseline, save_baseline, check_throughput,
+)
+
+
+class Command(BaseCommand):
+  help = 'Counts perft nodes from the standard test positions, checks them and compares nodes/s with the stored baseline.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--depth', type=int, help='Search every position to this depth instead of its default.')
+    parser.add_argument('--position', action='append', choices=[position.name for position in PERFT_POSITIONS])
+    parser.add_argument('--baseline', default=settings.CHESS_PERFT['BASELINE'])
+    parser.add_argument('--tolerance', type=float, default=settings.CHESS_PERFT['TOLERANCE_PERCENT'], help='Allowed slowdown in percent.')
+    parser.add_argument('--save-baseline', action='store_true', help='Store this run\'s positions in the baseline.')
+
+  def handle(self, *args, **options):
+    positions = [position for position in PERFT_POSITIONS if not options['position'] or position.name in options['position']]
+    results = run_suite(positions, options['depth'])
+    for result in results:
+      self.stdout.write(
+        f'{result.name:<10} depth {result.depth}  {result.nodes:>9} nodes  {result.seconds:7.2f}s  '
+        f'{result.nodes / result.seconds:>9.0f} nodes/s'
+      )
+    self.stdout.write(f'total {nodes_per_second(results):.0f} nodes/s')
+
+    try:
+      check_counts(results)
+      if options['save_baseline']:
+        save_baseline(options['baseline'], results)
+        self.stdout.write(self.style.SUCCESS(f'Baseline saved to {options["baseline"]}'))
+        return
+      baseline = load_baseline(options['baseline'])
+      if baseline is None:
+        self.stdout.write(self.style.WARNING(f'No baseline at {options["baseline"]}, throughput not checked'))
+        return
+      speed = check_throughput(results, baseline, options['tolerance'])
+    except PerftError as error:
+      raise CommandError(str(error))
+    if speed is None:
+      self.stdout.write(self.style.WARNING('The baseline has none of these positions at these depths, throughput not checked'))
+      return
+    self.stdout.write(self.style.SUCCESS(f'OK, {speed:.0%} of the baseline'))
@@ -0,0 +1,54 @@
+import asyncio
+
+
+class MatchExecutor:
+  """
+  One single-writer queue per match on the event loop. Jobs submitted for a match run strictly one after another
+  in submission order, jobs for different matches interleave freely. A match's queue and task go away once it has
+  been idle for idle_seconds.
+  """
+  def __init__(self, idle_seconds=30):
+    self.idle_seconds = idle_seconds
+    self.queues = {}
+
+  async def submit(self, match_id, job):
+    """
+    Queues job, an async callable without arguments, behind the match's earlier jobs and returns what it returns.
+    """
+    loop = asyncio.get_event_loop()
+    key = (loop, int(match_id))
+    queue = self.queues.get(key)
+    if queue is None:
+      queue = self.queues[key] = asyncio.Queue()
+      loop.create_task(self._run(key, queue))
+    future = loop.create_future()
+    queue.put_nowait((job, future))
+    return await future
+
+  async def _run(self, key, queue):
+    while True:
+      try:
+        job, future = await asyncio.wait_for(queue.get(), self.idle_seconds)
+      except asyncio.TimeoutError:
+        # nothing can be queued between this check and the removal, both run without yielding
+        if queue.empty():
+          del self.queues[key]
+          return
+        continue
+      try:
+        result = await job()
+      except Exception as error:
+        if not future.cancelled():
+          future.set_exception(error)
+      else:
+        if not future.cancelled():
+          future.set_result(result)
+
+  def stats(self):
+    return {
+      'matches': len(self.queues),
+      'queued': sum(queue.qsize() for queue in self.queues.values()),
+    }
+
+
+match_executor = MatchExecutor()
@@ -0,0 +1,188 @@
+"""
+Matchmaking: players wait in a queue bucketed by time control and rating band, and a pairing loop on the event loop
+turns pairs into matches with CreateNewChessMatch.create_matches and tells both players over their matchmaking
+socket. The queue is process-local, so every matchmaking socket of a deployment has to reach the same worker.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+from .board import WHITE, BLACK
+from .executor import database_sync_to_async
+from .move_log import TEAM_DISPLAY
+from .views import CreateNewChessMatch
+
+
+logger = logging.getLogger(__name__)
+
+Ticket = namedtuple('Ticket', 'user_id rating time_control joined')
+
+
+def user_group(user_id):
+  return f'matchmaking_{user_id}'
+
+
+class MatchmakingQueue:
+  """
+  Waiting players keyed by (time control, rating band), oldest first. A player is in at most one bucket.
+  Pairs are taken within a bucket first; a player left over after waiting widen_after_seconds may also be
+  paired with the leftover of a neighbouring band of the same time control.
+  """
+  def __init__(self, rating_band=200, widen_after_seconds=10, max_pairs_per_tick=500):
+    self.rating_band = rating_band
+    self.widen_after_seconds = widen_after_seconds
+    self.max_pairs_per_tick = max_pairs_per_tick
+    self.buckets = {}
+    self.tickets = {}
+    self.lock = threading.Lock()
+    self.paired = 0
+
+  def add(self, user_id, rating, time_control):
+    ticket = Ticket(user_id, rating, time_control, time.monotonic())
+    key = (time_control, rating // self.rating_band)
+    with self.lock:
+      self._discard(user_id)
+      self.tickets[user_id] = key
+      self.buckets.setdefault(key, OrderedDict())[user_id] = ticket
+    return ticket
+
+  def remove(self, user_id):
+    with self.lock:
+      return self._discard(user_id)
+
+  def requeue(self, tickets):
+    """
+    Puts tickets back at the front of their buckets, for pairs whose match could not be created.
+    """
+    with self.lock:
+      for ticket in reversed(tickets):
+        if ticket.user_id in self.tickets:
+          # queued again meanwhile, the newer ticket wins
+          continue
+        key = (ticket.time_control, ticket.rating // self.rating_band)
+        self.tickets[ticket.user_id] = key
+        bucket = self.buckets.setdefault(key, OrderedDict())
+        bucket[ticket.user_id] = ticket
+        bucket.move_to_end(ticket.user_id, last=False)
+
+  def pair(self):
+    """
+    Takes up to max_pairs_per_tick pairs of tickets out of the queue.
+    """
+    pairs = []
+    now = time.monotonic()
+    with self.lock:
+      for key in sorted(self.buckets):
+        bucket = self.buckets[key]
+        while len(bucket) >= 2 and len(pairs) < self.max_pairs_per_tick:
+          pairs.append((self._pop(bucket), self._pop(bucket)))
+      # buckets now hold at most one player each
+      leftovers = sorted(
+        (key, bucket) for key, bucket in self.buckets.items()
+        if bucket and now - next(iter(bucket.values())).joined >= self.widen_after_seconds
+      )
+      for (key, bucket), (next_key, next_bucket) in zip(leftovers, leftovers[1:]):
+        if len(pairs) >= self.max_pairs_per_tick:
+          break
+        if bucket and next_bucket and key[0] == next_key[0] and next_key[1] - key[1] == 1:
+          pairs.append((self._pop(bucket), self._pop(next_bucket)))
+      for key in [key for key, bucket in self.buckets.items() if not bucket]:
+        del self.buckets[key]
+      self.paired += len(pairs)
+    return pairs
+
+  def _pop(self, bucket):
+    user_id, ticket = bucket.popitem(last=False)
+    del self.tickets[user_id]
+    return ticket
+
+  def _discard(self, user_id):
+    key = self.tickets.pop(user_id, None)
+    if key is None:
+      return False
+    bucket = self.buckets[key]
+    del bucket[user_id]
+    if not bucket:
+      del self.buckets[key]
+    return True
+
+  def __len__(self):
+    return len(self.tickets)
+
+  def stats(self):
+    with self.lock:
+      now = time.monotonic()
+      return {
+        'waiting': len(self.tickets),
+        'buckets': len(self.buckets),
+        'pairs': self.paired,
+        'longest_wait_seconds': max(
+          (now - ticket.joined for bucket in self.buckets.values() for ticket in bucket.values()), default=0
+        ),
+      }
+
+
+class Matchmaker:
+  """
+  Owns the pairing loop. The loop is started by the first enqueue and stops once the queue is empty.
+  """
+  def __init__(self, queue, pair_interval_ms=250):
+    self.queue = queue
+    self.pair_interval_ms = pair_interval_ms
+    self.tasks = {}
+
+  def enqueue(self, channel_layer, user_id, rating, time_control):
+    ticket = self.queue.add(user_id, rating, time_control)
+    loop = asyncio.get_event_loop()
+    task = self.tasks.get(loop)
+    if task is None or task.done():
+      self.tasks[loop] = loop.create_task(self._pair_loop(channel_layer))
+    return ticket
+
+  async def _pair_loop(self, channel_layer):
+    while len(self.queue):
+      await asyncio.sleep(self.pair_interval_ms / 1000)
+      try:
+        await self.pair_once(channel_layer)
+      except Exception:
+        logger.exception('Matchmaking pairing failed')
+
+  async def pair_once(self, channel_layer):
+    pairs = self.queue.pair()
+    if not pairs:
+      return []
+    # either side may play white
+    pairings = [[ticket.user_id for ticket in random.sample(pair, 2)] for pair in pairs]
+    try:
+      matches = await database_sync_to_async(CreateNewChessMatch.create_matches)(pairings)
+    except Exception:
+      self.queue.requeue([ticket for pair in pairs for ticket in pair])
+      raise
+    for match, (white_id, black_id), pair in zip(matches, pairings, pairs):
+      for user_id, team, opponent_id in ((white_id, WHITE, black_id), (black_id, BLACK, white_id)):
+        await channel_layer.group_send(user_group(user_id), {
+          'type': 'match_found',
+          'match': match.id,
+          'team': TEAM_DISPLAY[team],
+          'opponent': opponent_id,
+          'time_control': pair[0].time_control,
+        })
+    return matches
+
+  def stats(self):
+    return self.queue.stats()
+
+
+matchmaker = Matchmaker(
+  MatchmakingQueue(
+    settings.CHESS_MATCHMAKING['RATING_BAND'],
+    settings.CHESS_MATCHMAKING['WIDEN_AFTER_SECONDS'],
+    settings.CHESS_MATCHMAKING['MAX_PAIRS_PER_TICK'],
+  ),
+  settings.CHESS_MATCHMAKING['PAIR_INTERVAL_MS'],
+)
@@ -0,0 +1,102 @@
+"""
+Pairings per second of the matchmaking queue, on its own and end to end: players connect to MatchmakingConsumer
+through chess_backend.routing.application, queue with a random rating and time control, and the time from
+queueing to receiving match_found is recorded per player.
+"""
+import asyncio
+import random
+import time
+import uuid
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from .matchmaking import MatchmakingQueue, matchmaker
+from .membership import membership_cache
+from .websocket_bench import QueryCounter, make_token, percentile
+
+
+def random_tickets(players, rng):
+  limits = settings.CHESS_MATCHMAKING
+  return [
+    (user_id, int(rng.gauss(limits['DEFAULT_RATING'], 300)) % 4000, rng.choice(limits['TIME_CONTROLS']))
+    for user_id in range(players)
+  ]
+
+def bench_queue(players=100000, seed=0):
+  """
+  Queues `players` players and pairs them off, without a database or sockets. Returns pairs per second.
+  """
+  limits = settings.CHESS_MATCHMAKING
+  # widen straight away so odd players out are paired across bands as they would be eventually
+  queue = MatchmakingQueue(limits['RATING_BAND'], 0, limits['MAX_PAIRS_PER_TICK'])
+  tickets = random_tickets(players, random.Random(seed))
+  started = time.perf_counter()
+  for ticket in tickets:
+    queue.add(*ticket)
+  pairs = 0
+  while True:
+    paired = len(queue.pair())
+    if not paired:
+      break
+    pairs += paired
+  seconds = time.perf_counter() - started
+  return {'pairs': pairs, 'seconds': seconds, 'pairs_per_second': pairs / seconds if seconds else 0}
+
+async def queue_player(application, user, rating, time_control, stats, timeout):
+  communicator = WebsocketCommunicator(application, f'/ws/chess/matchmaking/?{make_token(user)}')
+  connected, _ = await communicator.connect(timeout)
+  if not connected:
+    raise RuntimeError(f'{user.username} could not connect to matchmaking')
+  try:
+    sent = time.perf_counter()
+    await communicator.send_json_to({'type': 'join', 'rating': rating, 'time_control': time_control})
+    await communicator.receive_json_from(timeout)
+    try:
+      found = await communicator.receive_json_from(timeout)
+    except asyncio.TimeoutError:
+      stats['unpaired'] += 1
+      return
+    stats['latencies'].append(time.perf_counter() - sent)
+    stats['matches'].add(found['match'])
+  finally:
+    await communicator.disconnect()
+
+def bench_websocket(players=200, seed=0, timeout=30):
+  """
+  Queues `players` players (rounded down to even) over websockets at once and waits for every match_found.
+  Returns pairs per second, queue-to-match latency percentiles in milliseconds and database queries per pairing.
+  """
+  from chess_backend.routing import application
+
+  prefix = f'bench-{uuid.uuid4().hex[:8]}-'
+  User.objects.bulk_create([User(username=f'{prefix}{index}') for index in range(players)])
+  users = list(User.objects.filter(username__startswith=prefix).order_by('id'))
+  # players come in pairs with the same rating and time control, so nobody waits for the neighbouring bands to open
+  tickets = [ticket for ticket in random_tickets(players // 2, random.Random(seed)) for _ in range(2)]
+  stats = {'latencies': [], 'matches': set(), 'unpaired': 0}
+  with QueryCounter() as queries:
+    started = time.perf_counter()
+    asyncio.get_event_loop().run_until_complete(asyncio.gather(*(
+      queue_player(application, user, rating, time_control, stats, timeout)
+      for user, (_, rating, time_control) in zip(users, tickets)
+    )))
+    seconds = time.perf_counter() - started
+  for match_id in stats['matches']:
+    membership_cache.invalidate(match_id)
+
+  latencies = stats['latencies']
+  pairs = len(stats['matches'])
+  return {
+    'players': players,
+    'pairs': pairs,
+    'unpaired': stats['unpaired'],
+    'seconds': seconds,
+    'pairs_per_second': pairs / seconds if seconds else 0,
+    'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+    'p95_ms': percentile(latencies, 95) * 1000 if latencies else None,
+    'queries': queries.count,
+    'queries_per_pair': queries.count / pairs if pairs else None,
+    'waiting': matchmaker.stats()['waiting'],
+  }
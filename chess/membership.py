@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .board import WHITE, BLACK
+from .models import ChessMatch
+
+
+SPECTATOR = 'S'
+PLAYER_ROLES = (WHITE, BLACK)
+
+
+class MembershipCache:
+  """
+  Process-local map of match id -> {user id: team}. The first user linked to a match plays white, the second black,
+  anyone else is a spectator. Players are never removed from a match, so cached players can't go stale; an unknown
+  user in a match that still has a free seat is a spectator for miss_seconds after the seats were read, then triggers
+  one reload in case they joined through another worker.
+  """
+  def __init__(self, max_matches=10000, miss_seconds=5):
+    self.max_matches = max_matches
+    self.miss_seconds = miss_seconds
+    self.matches = OrderedDict()
+    self.lock = threading.Lock()
+
+  def cached_role(self, match_id, user_id):
+    """
+    Returns the role without touching the database, or None when it has to be looked up.
+    """
+    with self.lock:
+      entry = self.matches.get(int(match_id))
+      if entry is None:
+        return None
+      self.matches.move_to_end(int(match_id))
+    roles, loaded_at = entry
+    if user_id in roles:
+      return roles[user_id]
+    if len(roles) >= len(PLAYER_ROLES) or time.monotonic() - loaded_at < self.miss_seconds:
+      return SPECTATOR
+    return None
+
+  def role(self, match_id, user_id):
+    role = self.cached_role(match_id, user_id)
+    if role is None:
+      user_ids = ChessMatch.users.through.objects.filter(chessmatch_id=match_id).order_by('id').values_list('user_id', flat=True)
+      role = self.set_players(match_id, list(user_ids)).get(user_id, SPECTATOR)
+    return role
+
+  def set_players(self, match_id, user_ids):
+    roles = dict(zip(user_ids, PLAYER_ROLES))
+    with self.lock:
+      self.matches[int(match_id)] = (roles, time.monotonic())
+      self.matches.move_to_end(int(match_id))
+      while len(self.matches) > self.max_matches:
+        self.matches.popitem(last=False)
+    return roles
+
+  def invalidate(self, match_id):
+    with self.lock:
+      self.matches.pop(int(match_id), None)
+
+
+membership_cache = MembershipCache(settings.CHESS_MEMBERSHIP_CACHE_MAX_MATCHES, settings.CHESS_MEMBERSHIP_CACHE_MISS_SECONDS)
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.4 on 2026-10-18 15:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess', '0008_chesspiece_captured'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chessmatch',
+            name='fen',
+            field=models.CharField(default='rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1', max_length=100),
+        ),
+    ]
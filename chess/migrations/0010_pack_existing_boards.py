@@ -0,0 +1,86 @@
+from django.db import migrations, models
+
+
+# A frozen copy of Board.from_pieces(pieces).fen() as it was when this migration was written, so later engine
+# changes can't change what it does. Squares are row * 8 + column, white starts on rows 0 and 1.
+FEN_LETTERS = {'P': 'p', 'KN': 'n', 'B': 'b', 'R': 'r', 'Q': 'q', 'KI': 'k', 'K': 'k'}
+# (castling letter, team, king square, rook square)
+CASTLING = (('K', 'W', 4, 7), ('Q', 'W', 4, 0), ('k', 'B', 60, 63), ('q', 'B', 60, 56))
+
+
+def pieces_fen(pieces):
+    """
+    Piece rows don't record the side to move, castling or en passant: every move bumped one move_count, unmoved
+    kings and rooks keep their castling rights and a pawn that moved once onto its fourth rank can be taken en passant.
+    """
+    mailbox = {}
+    total_moves = 0
+    for piece in pieces:
+        total_moves += piece.move_count
+        if not piece.captured:
+            mailbox[piece.row * 8 + piece.column] = (piece.team, FEN_LETTERS[piece.piece_type], piece.move_count)
+    turn = 'W' if total_moves % 2 == 0 else 'B'
+
+    ranks = []
+    for row in range(7, -1, -1):
+        rank = ''
+        empty = 0
+        for column in range(8):
+            piece = mailbox.get(row * 8 + column)
+            if piece is None:
+                empty += 1
+                continue
+            if empty:
+                rank += str(empty)
+                empty = 0
+            rank += piece[1].upper() if piece[0] == 'W' else piece[1]
+        if empty:
+            rank += str(empty)
+        ranks.append(rank)
+
+    castling = ''.join(
+        letter for letter, team, king, rook in CASTLING
+        if mailbox.get(king) == (team, 'k', 0) and mailbox.get(rook) == (team, 'r', 0)
+    ) or '-'
+
+    mover = 'B' if turn == 'W' else 'W'
+    forward = 8 if mover == 'W' else -8
+    double_step_row = 3 if mover == 'W' else 4
+    candidates = [
+        square for square, piece in mailbox.items()
+        if piece == (mover, 'p', 1) and square >> 3 == double_step_row
+    ]
+    en_passant = '-'
+    if len(candidates) == 1:
+        target = candidates[0] - forward
+        en_passant = 'abcdefgh'[target & 7] + str((target >> 3) + 1)
+
+    return ' '.join(('/'.join(ranks), turn.lower(), castling, en_passant, '0', str(total_moves // 2 + 1)))
+
+
+def pack_boards(apps, schema_editor):
+    ChessMatch = apps.get_model('chess', 'ChessMatch')
+    ChessPiece = apps.get_model('chess', 'ChessPiece')
+    for match in ChessMatch.objects.iterator():
+        pieces = list(ChessPiece.objects.filter(chess_match=match))
+        if not pieces:
+            continue
+        # there is no move log before this one, so it starts from the packed position
+        match.fen = match.start_fen = pieces_fen(pieces)
+        match.save(update_fields=['fen', 'start_fen'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess', '0009_chessmatch_fen'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chessmatch',
+            name='start_fen',
+            field=models.CharField(default='rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1', max_length=100),
+        ),
+        migrations.RunPython(pack_boards, migrations.RunPython.noop),
+    ]
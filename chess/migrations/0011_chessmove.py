@@ -0,0 +1,36 @@
+# Generated by Django 2.2.4 on 2026-10-18 16:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess', '0010_pack_existing_boards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChessMove',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField()),
+                ('team', models.CharField(choices=[('B', 'Black'), ('W', 'White')], max_length=1)),
+                ('piece_type', models.CharField(choices=[('P', 'Pawn'), ('R', 'Rook'), ('KN', 'Knight'), ('B', 'Bishop'), ('Q', 'Queen'), ('KI', 'King')], max_length=2)),
+                ('from_row', models.PositiveSmallIntegerField()),
+                ('from_column', models.PositiveSmallIntegerField()),
+                ('to_row', models.PositiveSmallIntegerField()),
+                ('to_column', models.PositiveSmallIntegerField()),
+                ('promotion', models.CharField(blank=True, choices=[('P', 'Pawn'), ('R', 'Rook'), ('KN', 'Knight'), ('B', 'Bishop'), ('Q', 'Queen'), ('KI', 'King')], max_length=2, null=True)),
+                ('captured_piece_type', models.CharField(blank=True, choices=[('P', 'Pawn'), ('R', 'Rook'), ('KN', 'Knight'), ('B', 'Bishop'), ('Q', 'Queen'), ('KI', 'King')], max_length=2, null=True)),
+                ('en_passant', models.BooleanField(default=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('chess_match', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='chess.ChessMatch')),
+            ],
+            options={
+                'ordering': ('chess_match', 'seq'),
+                'unique_together': {('chess_match', 'seq')},
+            },
+        ),
+    ]
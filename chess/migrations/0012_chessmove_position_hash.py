@@ -0,0 +1,18 @@
+# Generated by Django 2.2.4 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess', '0011_chessmove'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chessmove',
+            name='position_hash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,176 @@
+# Generated by Django 2.2.4 on 2026-10-18 16:08
+
+from django.db import migrations, models
+
+
+# A frozen copy of the end-of-game checks in chess/game_state.py as they were when this migration was written,
+# on a plain square -> FEN letter dict, so later engine changes can't change what it does. Boards built from a
+# FEN carry no earlier positions, so threefold repetition never applied here.
+KNIGHT_STEPS = ((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2))
+KING_STEPS = ((1, 1), (1, 0), (1, -1), (0, 1), (0, -1), (-1, 1), (-1, 0), (-1, -1))
+ROOK_RAYS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+BISHOP_RAYS = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+
+
+def parse_fen(fen):
+    placement, turn, _, en_passant, halfmove_clock, _ = fen.split()
+    board = {}
+    for row_index, rank in enumerate(placement.split('/')):
+        column = 0
+        for letter in rank:
+            if letter.isdigit():
+                column += int(letter)
+            else:
+                board[(7 - row_index, column)] = letter
+                column += 1
+    en_passant = None if en_passant == '-' else (int(en_passant[1]) - 1, 'abcdefgh'.index(en_passant[0]))
+    return board, turn == 'w', en_passant, int(halfmove_clock)
+
+
+def is_white(letter):
+    return letter.isupper()
+
+
+def on_board(row, column):
+    return 0 <= row < 8 and 0 <= column < 8
+
+
+def is_attacked(board, square, by_white):
+    row, column = square
+    pawn_row = row - 1 if by_white else row + 1
+    for step in (-1, 1):
+        if board.get((pawn_row, column + step)) == ('P' if by_white else 'p'):
+            return True
+    for steps, letter in ((KNIGHT_STEPS, 'n'), (KING_STEPS, 'k')):
+        for row_step, column_step in steps:
+            piece = board.get((row + row_step, column + column_step))
+            if piece is not None and is_white(piece) == by_white and piece.lower() == letter:
+                return True
+    for rays, letters in ((ROOK_RAYS, 'rq'), (BISHOP_RAYS, 'bq')):
+        for row_step, column_step in rays:
+            target_row, target_column = row + row_step, column + column_step
+            while on_board(target_row, target_column):
+                piece = board.get((target_row, target_column))
+                if piece is not None:
+                    if is_white(piece) == by_white and piece.lower() in letters:
+                        return True
+                    break
+                target_row += row_step
+                target_column += column_step
+    return False
+
+
+def king_square(board, white):
+    king = 'K' if white else 'k'
+    return next((square for square, letter in board.items() if letter == king), None)
+
+
+def in_check(board, white):
+    king = king_square(board, white)
+    return king is not None and is_attacked(board, king, not white)
+
+
+def targets(board, square, white, en_passant):
+    """
+    (target, captured square) of every pseudo-legal move of the piece on square. Castling is left out: whenever
+    a king may castle it may also step onto the square it passes, so it never decides whether a move exists.
+    """
+    row, column = square
+    kind = board[square].lower()
+    if kind == 'p':
+        forward = 1 if white else -1
+        if on_board(row + forward, column) and (row + forward, column) not in board:
+            yield (row + forward, column), None
+            if row == (1 if white else 6) and (row + 2 * forward, column) not in board:
+                yield (row + 2 * forward, column), None
+        for step in (-1, 1):
+            target = (row + forward, column + step)
+            if not on_board(*target):
+                continue
+            if target in board and is_white(board[target]) != white:
+                yield target, target
+            elif target == en_passant:
+                yield target, (row, column + step)
+        return
+    if kind in 'nk':
+        for row_step, column_step in KNIGHT_STEPS if kind == 'n' else KING_STEPS:
+            target = (row + row_step, column + column_step)
+            if on_board(*target) and (target not in board or is_white(board[target]) != white):
+                yield target, target if target in board else None
+        return
+    rays = {'r': ROOK_RAYS, 'b': BISHOP_RAYS, 'q': ROOK_RAYS + BISHOP_RAYS}[kind]
+    for row_step, column_step in rays:
+        target = (row + row_step, column + column_step)
+        while on_board(*target):
+            if target in board:
+                if is_white(board[target]) != white:
+                    yield target, target
+                break
+            yield target, None
+            target = (target[0] + row_step, target[1] + column_step)
+
+
+def has_legal_move(board, white, en_passant):
+    for square, letter in list(board.items()):
+        if is_white(letter) != white:
+            continue
+        for target, captured in targets(board, square, white, en_passant):
+            after = dict(board)
+            if captured is not None:
+                del after[captured]
+            after[target] = after.pop(square)
+            if not in_check(after, white):
+                return True
+    return False
+
+
+def is_insufficient_material(board):
+    letters = [letter.lower() for letter in board.values() if letter.lower() != 'k']
+    if any(letter in 'prq' for letter in letters):
+        return False
+    if len(letters) <= 1:
+        return True
+    bishop_colours = {(row + column) % 2 for (row, column), letter in board.items() if letter.lower() == 'b'}
+    return 'n' not in letters and len(bishop_colours) == 1
+
+
+def game_status(fen):
+    board, white, en_passant, halfmove_clock = parse_fen(fen)
+    if not has_legal_move(board, white, en_passant):
+        if in_check(board, white):
+            return 'CM', '0-1' if white else '1-0'
+        return 'SM', '1/2-1/2'
+    if is_insufficient_material(board):
+        return 'IM', '1/2-1/2'
+    if halfmove_clock >= 100:
+        return 'FM', '1/2-1/2'
+    return 'A', '*'
+
+
+def record_results(apps, schema_editor):
+    ChessMatch = apps.get_model('chess', 'ChessMatch')
+    for match in ChessMatch.objects.iterator():
+        match.status, match.result = game_status(match.fen)
+        if match.status != 'A':
+            match.save(update_fields=['status', 'result'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess', '0012_chessmove_position_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chessmatch',
+            name='result',
+            field=models.CharField(choices=[('*', 'Undecided'), ('1-0', 'White wins'), ('0-1', 'Black wins'), ('1/2-1/2', 'Draw')], default='*', max_length=7),
+        ),
+        migrations.AddField(
+            model_name='chessmatch',
+            name='status',
+            field=models.CharField(choices=[('A', 'Active'), ('CM', 'Checkmate'), ('SM', 'Stalemate'), ('IM', 'Insufficient material'), ('TR', 'Threefold repetition'), ('FM', 'Fifty-move rule')], default='A', max_length=2),
+        ),
+        migrations.RunPython(record_results, migrations.RunPython.noop),
+    ]
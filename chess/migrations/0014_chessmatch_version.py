@@ -0,0 +1,18 @@
+# Generated by Django 2.2.4 on 2026-10-18 16:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess', '0013_chessmatch_status_result'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chessmatch',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
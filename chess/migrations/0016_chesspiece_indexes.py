@@ -0,0 +1,21 @@
+# Generated by Django 2.2.4 on 2026-10-18 16:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chess', '0015_chessmatch_last_activity'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chesspiece',
+            index=models.Index(fields=['chess_match', 'team', 'piece_type'], name='chess_piece_match_team_type'),
+        ),
+        migrations.AddIndex(
+            model_name='chesspiece',
+            index=models.Index(fields=['chess_match', 'captured'], name='chess_piece_match_captured'),
+        ),
+    ]
@@ -1,9 +1,56 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
 
+from .board import STARTING_FEN
+
 
 class ChessMatch(models.Model):
   users = models.ManyToManyField(User)
+  # Authoritative position (placement, side to move, castling, en passant and move counters).
+  # ChessPiece rows are kept in step with it only while CHESS_MATERIALIZE_PIECES is on.
+  fen = models.CharField(max_length=100, default=STARTING_FEN)
+  # Position the move log starts from: STARTING_FEN unless the match was packed from older piece rows or imported
+  # from a set-up position
+  start_fen = models.CharField(max_length=100, default=STARTING_FEN)
+  ACTIVE = 'A'
+  CHECKMATE = 'CM'
+  STALEMATE = 'SM'
+  INSUFFICIENT_MATERIAL = 'IM'
+  THREEFOLD_REPETITION = 'TR'
+  FIFTY_MOVES = 'FM'
+  STATUS_CHOICES = (
+    (ACTIVE, 'Active'),
+    (CHECKMATE, 'Checkmate'),
+    (STALEMATE, 'Stalemate'),
+    (INSUFFICIENT_MATERIAL, 'Insufficient material'),
+    (THREEFOLD_REPETITION, 'Threefold repetition'),
+    (FIFTY_MOVES, 'Fifty-move rule'),
+  )
+  status = models.CharField(
+    max_length=2,
+    choices=STATUS_CHOICES,
+    default=ACTIVE,
+  )
+  UNDECIDED = '*'
+  WHITE_WINS = '1-0'
+  BLACK_WINS = '0-1'
+  DRAW = '1/2-1/2'
+  RESULT_CHOICES = (
+    (UNDECIDED, 'Undecided'),
+    (WHITE_WINS, 'White wins'),
+    (BLACK_WINS, 'Black wins'),
+    (DRAW, 'Draw'),
+  )
+  result = models.CharField(
+    max_length=7,
+    choices=RESULT_CHOICES,
+    default=UNDECIDED,
+  )
+  # Bumped by every move, join and reset, identifies a snapshot of the match for ETags and caching
+  version = models.PositiveIntegerField(default=0)
+  # Time of the last flushed move, join or reset, for "recently active" listings
+  last_activity = models.DateTimeField(default=timezone.now, db_index=True)
 
 class ChessPiece(models.Model):
   chess_match = models.ForeignKey(
@@ -42,3 +89,54 @@ class ChessPiece(models.Model):
   column = models.PositiveSmallIntegerField()
   move_count = models.PositiveSmallIntegerField(default=0)
   captured = models.BooleanField(default=False)
+
+  class Meta:
+    indexes = [
+      # a side's pieces of one kind (?match=&team= listings, piece lookups by type). Nothing looks pieces up by
+      # square since boards are cached, and row and column change with every flush, so they are left unindexed
+      models.Index(fields=['chess_match', 'team', 'piece_type'], name='chess_piece_match_team_type'),
+      # the pieces still on the board, read whenever a match is loaded into the board cache
+      models.Index(fields=['chess_match', 'captured'], name='chess_piece_match_captured'),
+    ]
+
+class ChessMove(models.Model):
+  """
+  Append-only move log, seq counts plies from 1 within a match.
+  """
+  chess_match = models.ForeignKey(
+    ChessMatch,
+    on_delete=models.CASCADE,
+  )
+  seq = models.PositiveIntegerField()
+  team = models.CharField(
+    max_length=1,
+    choices=ChessPiece.TEAM_CHOICES,
+  )
+  piece_type = models.CharField(
+    max_length=2,
+    choices=ChessPiece.PIECE_CHOICES,
+  )
+  from_row = models.PositiveSmallIntegerField()
+  from_column = models.PositiveSmallIntegerField()
+  to_row = models.PositiveSmallIntegerField()
+  to_column = models.PositiveSmallIntegerField()
+  promotion = models.CharField(
+    max_length=2,
+    choices=ChessPiece.PIECE_CHOICES,
+    null=True,
+    blank=True,
+  )
+  captured_piece_type = models.CharField(
+    max_length=2,
+    choices=ChessPiece.PIECE_CHOICES,
+    null=True,
+    blank=True,
+  )
+  en_passant = models.BooleanField(default=False)
+  # Zobrist hash of the position after the move, see chess/zobrist.py
+  position_hash = models.BigIntegerField(null=True, blank=True)
+  created = models.DateTimeField(auto_now_add=True)
+
+  class Meta:
+    unique_together = ('chess_match', 'seq')
+    ordering = ('chess_match', 'seq')
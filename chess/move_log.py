@@ -0,0 +1,84 @@
+from .board import KING, CASTLING_MOVES, CASTLING_BY_KING_MOVE, square_index, square_row, square_column
+from .board_cache import board_cache
+from .models import ChessMatch, ChessMove, ChessPiece
+
+
+TEAM_DISPLAY = dict(ChessPiece.TEAM_CHOICES)
+PIECE_DISPLAY = dict(ChessPiece.PIECE_CHOICES)
+STATUS_DISPLAY = dict(ChessMatch.STATUS_CHOICES)
+
+
+def move_record(match_id, seq, piece, validator, captured_piece=None):
+  """
+  Unsaved ChessMove for a validated move, built before it is pushed on the board.
+  """
+  return ChessMove(
+    chess_match_id=match_id,
+    seq=seq,
+    team=piece.team,
+    piece_type=piece.piece_type,
+    from_row=piece.row,
+    from_column=piece.column,
+    to_row=validator.new_row,
+    to_column=validator.new_column,
+    promotion=validator.promoted_to,
+    captured_piece_type=captured_piece.piece_type if captured_piece else None,
+    en_passant=bool(captured_piece) and (captured_piece.row, captured_piece.column) != (validator.new_row, validator.new_column),
+  )
+
+def move_delta(record):
+  """
+  Everything a client needs to replay a move on its own board: the mover, any capture, the castling rook and promotion.
+  """
+  delta = {
+    'seq': record.seq,
+    'team': TEAM_DISPLAY[record.team],
+    'piece_type': PIECE_DISPLAY[record.piece_type],
+    'from_row': record.from_row,
+    'from_column': record.from_column,
+    'row': record.to_row,
+    'column': record.to_column,
+    'promotion': PIECE_DISPLAY[record.promotion] if record.promotion else None,
+    'captured': None,
+    'rook': None,
+  }
+  if record.captured_piece_type:
+    delta['captured'] = {
+      'piece_type': PIECE_DISPLAY[record.captured_piece_type],
+      'row': record.from_row if record.en_passant else record.to_row,
+      'column': record.to_column,
+    }
+  from_square = square_index(record.from_row, record.from_column)
+  to_square = square_index(record.to_row, record.to_column)
+  if record.piece_type == KING and (from_square, to_square) in CASTLING_BY_KING_MOVE:
+    _, _, rook_from, rook_to, _, _ = CASTLING_MOVES[CASTLING_BY_KING_MOVE[(from_square, to_square)]]
+    delta['rook'] = {
+      'from_row': square_row(rook_from),
+      'from_column': square_column(rook_from),
+      'row': square_row(rook_to),
+      'column': square_column(rook_to),
+    }
+  return delta
+
+def recent_moves_after(live, seq):
+  """
+  Deltas after seq from the moves cached in memory, or None when they don't reach back far enough.
+  """
+  with live.lock:
+    if live.next_seq <= seq + 1:
+      return []
+    if live.recent_moves and live.recent_moves[0]['seq'] <= seq + 1:
+      return [delta for delta in live.recent_moves if delta['seq'] > seq]
+  return None
+
+def moves_after(match_id, seq, live=None):
+  """
+  Deltas of every move after seq. Falls back to the database, flushing the cached match first so the log is complete.
+  """
+  if live is not None:
+    recent = recent_moves_after(live, seq)
+    if recent is not None:
+      return recent
+    # through the cache, so compare-and-set mode never writes over another worker's moves
+    board_cache.flush_before_read(live)
+  return [move_delta(record) for record in ChessMove.objects.filter(chess_match_id=match_id, seq__gt=seq).order_by('seq')]
@@ -1,72 +1,73 @@
-from .models import ChessPiece
-from math import fabs
+from .board import (
+  Board, PAWN, KING, QUEEN, PROMOTION_ROW, CASTLING_MOVES, CASTLING_BY_KING_MOVE, PIECE_TYPE_ALIASES,
+  board_square, square_index, square_row, square_column, encode_move, promotion_type,
+)
+from .position_cache import position_cache
 
 
 class MoveValidator:
-  def __init__(self, all_pieces, piece, new_row, new_column):
-    self.all_pieces = all_pieces
+  def __init__(self, all_pieces, piece, new_row, new_column, promotion=None):
+    # all_pieces may be a prebuilt Board or an iterable of ChessPiece rows, the board is built once either way
+    if isinstance(all_pieces, Board):
+      self.board = all_pieces
+    else:
+      self.board = Board.from_pieces(all_pieces)
     self.piece = piece
     self.new_row = int(new_row)
     self.new_column = int(new_column)
+    self.from_square = square_index(piece.row, piece.column)
+    # off-board targets are turned down, their row * 8 + column would name some other square
+    try:
+      self.new_square = board_square(self.new_row, self.new_column)
+    except ValueError:
+      self.new_square = None
+    # clients send codes or the display names the server broadcasts, anything else makes the move invalid
+    try:
+      self.promotion = promotion_type(promotion)
+      self.promotion_valid = True
+    except ValueError:
+      self.promotion = None
+      self.promotion_valid = False
+    self.move = None
+    self.promoted_to = None
+    self.captured_square = None
     self.captured_piece_id = None
-
-    if self.piece.team == 'B':
-      self.forward_movement = -1
-    else:
-      self.forward_movement = 1
+    # (piece id, row, column) of the rook when the move castles
+    self.castling_rook = None
 
   def move_is_valid(self):
-    if self.piece.piece_type == 'P':
-      # STANDARD 1 SQUARE MOVE
-      print(f'row: {self.piece.row}, new_row: {self.new_row}', self.new_row == self.piece.row + (1 * self.forward_movement))
-      if self.new_row == self.piece.row + (1 * self.forward_movement) and self.new_column == self.piece.column and self.square_is_vacant():
-        return True
-      # DOUBLE JUMP MOVE, MUST BE FIRST MOVE
-      elif self.new_row == self.piece.row + (2 * self.forward_movement) and self.new_column == self.piece.column and self.square_is_vacant() and self.piece.move_count == 0:
-        return True
-      # STANDARD DIAGONAL CAPTURE
-      elif self.new_row == self.piece.row + (1 * self.forward_movement) and int(fabs(self.new_column - self.piece.column)) == 1 and self.square_is_enemy_occupied():
-        return True
-      # EN PASSANT CAPTURE, ENEMY MUST BE DOUBLE JUMPED PAWN
-      elif self.new_row == self.piece.row + (1 * self.forward_movement) and int(fabs(self.new_column - self.piece.column)) == 1 and self.can_en_passant():
-        return True
-      else:
-        return False
-    else:
-      return True
-
-
-  def square_is_vacant(self):
-    try:
-      self.all_pieces.get(row=self.new_row, column=self.new_column)
+    team = self.piece.team
+    piece_type = PIECE_TYPE_ALIASES.get(self.piece.piece_type, self.piece.piece_type)
+    if self.new_square is None or not self.promotion_valid or self.piece.captured or self.board.piece_at(self.from_square) != (team, piece_type):
       return False
-    except ChessPiece.DoesNotExist:
-      return True
 
-  def square_is_enemy_occupied(self):
-    try:
-      enemy_piece = self.all_pieces.exclude(team=self.piece.team).get(row=self.new_row, column=self.new_column)
-      self.captured_piece_id = enemy_piece.id
-      return True
-    except ChessPiece.DoesNotExist:
-      pass
+    # PAWNS REACHING THE LAST ROW PROMOTE TO A QUEEN UNLESS TOLD OTHERWISE
+    promotion = None
+    if piece_type == PAWN and self.new_row == PROMOTION_ROW[team]:
+      promotion = self.promotion or QUEEN
 
-    for piece in self.all_pieces.filter(team=self.piece.team):
-      if piece.row == self.new_row and piece.column == self.new_column:
-        return True
-    return False
-
-  def can_en_passant(self):
-    if self.piece.team == 'B':
-      double_jump_row = 3
+    move = encode_move(self.from_square, self.new_square, promotion)
+    if team == self.board.turn:
+      # Legal move lists are shared by every match that reaches the same position
+      legal = move in position_cache.legal_moves(self.board)
     else:
-      double_jump_row = 4
-    try:
-      double_jumped_pawn = self.all_pieces.exclude(team=self.piece.team).get(piece_type='P', row=double_jump_row, column=self.new_column, move_count=1)
-      self.captured_piece_id = double_jumped_pawn.id
-      return True
-    except ChessPiece.DoesNotExist:
-      return False
+      legal = self.board.is_legal(move, team)
+    if legal:
+      self.move = move
+      self.promoted_to = promotion
+      self.find_side_effects(piece_type)
+    return legal
+
+  def find_side_effects(self, piece_type):
+    if not self.board.is_vacant(self.new_square):
+      self.captured_square = self.new_square
+    elif piece_type == PAWN and self.new_square == self.board.ep_square:
+      self.captured_square = square_index(self.piece.row, self.new_column)
+    if self.captured_square is not None:
+      self.captured_piece_id = self.board.piece_ids.get(self.captured_square)
+    elif piece_type == KING and (self.from_square, self.new_square) in CASTLING_BY_KING_MOVE:
+      _, _, rook_from, rook_to, _, _ = CASTLING_MOVES[CASTLING_BY_KING_MOVE[(self.from_square, self.new_square)]]
+      self.castling_rook = (self.board.piece_ids.get(rook_from), square_row(rook_to), square_column(rook_to))
 
 
 '''
@@ -0,0 +1,186 @@
+"""
+Bounded outbound queues for the match sockets. Broadcasts are queued per socket and written by one task per socket,
+so a socket whose client reads slowly only holds up its own frames.
+
+A socket is behind once high_water frames are queued or, for clients that acknowledge what they applied with
+{"type": "ack", "seq": n} (or [ACK, n]), once the last seq sent is high_water moves past the last one acknowledged.
+Daphne's send never waits for the client, it buffers in the transport where nothing here can see it, so under
+daphne acknowledgements are the only signal; the queue depth only grows on servers that wait (e.g. uvicorn).
+While acknowledgements lag, nothing more is handed to the server. A socket that is behind either has everything
+queued coalesced into one position frame with the latest board, sent once the client catches up, or is closed with
+RESYNC_CLOSE_CODE so the client reconnects and syncs. Clients that never acknowledge are only bounded by the depth.
+"""
+import asyncio
+import json
+import threading
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+from .board_cache import board_cache
+from .protocol import encode_position
+from .spectators import position
+
+
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+
+# Close code telling a client it fell too far behind and has to reconnect and sync
+RESYNC_CLOSE_CODE = 4008
+
+
+class OutboundMetrics:
+  """
+  Per-match totals over this worker's sockets: frames queued right now, the deepest any one queue got, and the
+  frames coalesced away or dropped with a closed socket. Bounded to the max_matches most recently active matches.
+  """
+  def __init__(self, max_matches=1000):
+    self.max_matches = max_matches
+    self.matches = OrderedDict()
+    self.lock = threading.Lock()
+
+  def _entry(self, match_id):
+    entry = self.matches.get(match_id)
+    if entry is None:
+      entry = self.matches[match_id] = {'queued': 0, 'max_depth': 0, 'max_lag': 0, 'coalesced': 0, 'dropped': 0, 'resyncs': 0}
+      while len(self.matches) > self.max_matches:
+        self.matches.popitem(last=False)
+    self.matches.move_to_end(match_id)
+    return entry
+
+  def record(self, match_id, queued=0, depth=0, lag=0, coalesced=0, dropped=0, resyncs=0):
+    with self.lock:
+      entry = self._entry(match_id)
+      entry['queued'] += queued
+      entry['max_depth'] = max(entry['max_depth'], depth)
+      entry['max_lag'] = max(entry['max_lag'], lag)
+      entry['coalesced'] += coalesced
+      entry['dropped'] += dropped
+      entry['resyncs'] += resyncs
+
+  def stats(self):
+    with self.lock:
+      matches = {match_id: dict(entry) for match_id, entry in self.matches.items()}
+    return {
+      'queued': sum(entry['queued'] for entry in matches.values()),
+      'coalesced': sum(entry['coalesced'] for entry in matches.values()),
+      'dropped': sum(entry['dropped'] for entry in matches.values()),
+      'matches': matches,
+    }
+
+
+outbound_metrics = OutboundMetrics()
+
+
+class Outbox:
+  """
+  The frames of one socket not yet handed to the server, oldest first, as (text_data, bytes_data, seq).
+  positions is set for spectators, whose frames each hold a whole board so only the newest one matters.
+  """
+  def __init__(self, consumer, match_id, binary, positions=False, high_water=64, policy=COALESCE):
+    self.consumer = consumer
+    self.match_id = int(match_id)
+    self.binary = binary
+    self.positions = positions
+    self.high_water = high_water
+    self.policy = policy
+    self.frames = deque()
+    # the frame the server hasn't finished taking yet, still counted in the depth
+    self.in_flight = 0
+    # newest seq handed to the server, and newest the client acknowledged, None until it first does
+    self.sent_seq = 0
+    self.acked_seq = None
+    self.task = None
+    self.closed = False
+
+  def depth(self):
+    return len(self.frames) + self.in_flight
+
+  def lag(self):
+    return 0 if self.acked_seq is None else self.sent_seq - self.acked_seq
+
+  def behind(self):
+    return self.depth() >= self.high_water or self.lag() >= self.high_water
+
+  @classmethod
+  def from_settings(cls, consumer, match_id, binary, positions=False):
+    return cls(consumer, match_id, binary, positions, settings.CHESS_OUTBOUND['HIGH_WATER'], settings.CHESS_OUTBOUND['POLICY'])
+
+  async def put(self, event):
+    """
+    Queues a group event carrying pre-encoded 'text' and 'bytes', and the 'seq' of the move it reports if any.
+    """
+    if self.closed:
+      return
+    frame = (None, event['bytes'], event.get('seq')) if self.binary else (event['text'], None, event.get('seq'))
+    if self.behind():
+      if self.policy == COALESCE:
+        frame = self.coalesce(frame)
+      if self.policy != COALESCE or frame is None:
+        await self.resync()
+        return
+    self.frames.append(frame)
+    outbound_metrics.record(self.match_id, queued=1, depth=self.depth())
+    self._start_drain()
+
+  def ack(self, seq):
+    """
+    The client applied everything up to seq, frames held back for it can go out again.
+    """
+    if self.closed or not isinstance(seq, int):
+      return
+    self.acked_seq = max(self.acked_seq or 0, min(seq, self.sent_seq))
+    self._start_drain()
+
+  def _start_drain(self):
+    if self.task is None and self.frames and self.lag() < self.high_water:
+      self.task = asyncio.ensure_future(self._drain())
+
+  def coalesce(self, frame):
+    """
+    Replaces everything queued by one frame with the latest board, or returns None when there is no board to send.
+    """
+    if not self.positions:
+      live = board_cache.peek(self.match_id)
+      if live is None:
+        return None
+      latest = position(live)
+      frame = (
+        (None, encode_position(latest), latest['seq']) if self.binary
+        else (json.dumps({'type': 'position', **latest}), None, latest['seq'])
+      )
+    coalesced = len(self.frames)
+    self.frames.clear()
+    outbound_metrics.record(self.match_id, queued=-coalesced, coalesced=coalesced)
+    return frame
+
+  async def resync(self):
+    dropped = self.depth() + 1
+    self.close()
+    outbound_metrics.record(self.match_id, dropped=dropped, resyncs=1)
+    await self.consumer.close(code=RESYNC_CLOSE_CODE)
+
+  async def _drain(self):
+    try:
+      # a client too far behind on its acknowledgements gets nothing more until it catches up, see ack()
+      while self.frames and self.lag() < self.high_water:
+        text_data, bytes_data, seq = self.frames.popleft()
+        self.in_flight = 1
+        await self.consumer.send(text_data=text_data, bytes_data=bytes_data)
+        self.in_flight = 0
+        if seq is not None:
+          self.sent_seq = max(self.sent_seq, seq)
+        outbound_metrics.record(self.match_id, queued=-1, lag=self.lag())
+    finally:
+      self.task = None
+
+  def close(self):
+    """
+    Forgets the queued frames, for when the socket is closing anyway.
+    """
+    self.closed = True
+    if self.task is not None:
+      self.task.cancel()
+    outbound_metrics.record(self.match_id, queued=-self.depth())
+    self.frames.clear()
+    self.in_flight = 0
@@ -0,0 +1,49 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class MatchCursorPagination(CursorPagination):
+  """
+  Keyset pages ordered by id, newest first. The cursor carries the last id seen, so every page is one indexed
+  range query and deep pages cost the same as the first one.
+  """
+  ordering = '-id'
+  page_size = settings.CHESS_LIST_PAGE_SIZE
+  page_size_query_param = 'page_size'
+  max_page_size = settings.CHESS_LIST_MAX_PAGE_SIZE
+
+class PieceCursorPagination(CursorPagination):
+  ordering = 'id'
+  page_size = settings.CHESS_LIST_PAGE_SIZE
+  page_size_query_param = 'page_size'
+  max_page_size = settings.CHESS_LIST_MAX_PAGE_SIZE
+
+
+def keyset_chunks(queryset, chunk_size):
+  """
+  Yields querysets of at most chunk_size rows in id order, each fetched with its own range query, so a whole
+  table can be walked without holding more than one chunk and prefetch_related still works per chunk.
+  """
+  last_id = None
+  while True:
+    chunk_queryset = queryset.order_by('id')
+    if last_id is not None:
+      chunk_queryset = chunk_queryset.filter(id__gt=last_id)
+    chunk = list(chunk_queryset[:chunk_size])
+    if not chunk:
+      return
+    yield chunk
+    last_id = chunk[-1].id
+
+def stream_json_array(queryset, serialize, chunk_size=None):
+  """
+  A JSON array of serialize(row) for every row, produced chunk by chunk for a StreamingHttpResponse.
+  """
+  encoder = JSONEncoder()
+  yield '['
+  separator = ''
+  for chunk in keyset_chunks(queryset, chunk_size or settings.CHESS_EXPORT_CHUNK_SIZE):
+    yield separator + ','.join(encoder.encode(serialize(row)) for row in chunk)
+    separator = ','
+  yield ']'
@@ -0,0 +1,113 @@
+"""
+Perft: counts the leaf nodes of the legal move tree to a fixed depth. The counts for the positions below are
+well known, so any move generation bug shows up as a wrong number, and timing the walk measures the same
+generator MoveValidator checks moves against.
+"""
+import json
+import time
+from collections import namedtuple
+
+from .board import Board, STARTING_FEN
+
+
+# depth is what the suite searches by default, counts hold the known totals for depth 1, 2, ...
+PerftPosition = namedtuple('PerftPosition', ('name', 'fen', 'counts', 'depth'))
+
+PERFT_POSITIONS = (
+  PerftPosition('start', STARTING_FEN, (20, 400, 8902, 197281, 4865609), 4),
+  PerftPosition(
+    'kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+    (48, 2039, 97862, 4085603), 3,
+  ),
+  PerftPosition('position3', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1', (14, 191, 2812, 43238, 674624), 4),
+  PerftPosition(
+    'position4', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+    (6, 264, 9467, 422333), 3,
+  ),
+  PerftPosition('position5', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8', (44, 1486, 62379, 2103487), 3),
+  PerftPosition(
+    'position6', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+    (46, 2079, 89890, 3894594), 3,
+  ),
+)
+
+PerftResult = namedtuple('PerftResult', ('name', 'depth', 'nodes', 'expected', 'seconds'))
+
+
+class PerftError(Exception):
+  pass
+
+
+def perft(board, depth):
+  if depth == 1:
+    return sum(1 for _ in board.legal_moves())
+  nodes = 0
+  for move in list(board.legal_moves()):
+    board.push(move)
+    nodes += perft(board, depth - 1)
+    board.pop()
+  return nodes
+
+def run_suite(positions=PERFT_POSITIONS, max_depth=None):
+  """
+  Runs perft on every position to its default depth, or to max_depth when that is given and the count is known.
+  """
+  results = []
+  for position in positions:
+    depth = min(max_depth, len(position.counts)) if max_depth else position.depth
+    board = Board.from_fen(position.fen)
+    started = time.perf_counter()
+    nodes = perft(board, depth)
+    results.append(PerftResult(position.name, depth, nodes, position.counts[depth - 1], time.perf_counter() - started))
+  return results
+
+def nodes_per_second(results):
+  seconds = sum(result.seconds for result in results)
+  return sum(result.nodes for result in results) / seconds if seconds else 0
+
+def check_counts(results):
+  wrong = [result for result in results if result.nodes != result.expected]
+  if wrong:
+    raise PerftError(', '.join(f'{result.name} depth {result.depth}: {result.nodes} != {result.expected}' for result in wrong))
+
+def load_baseline(path):
+  try:
+    with open(path) as baseline_file:
+      return json.load(baseline_file)
+  except FileNotFoundError:
+    return None
+
+def save_baseline(path, results):
+  """
+  Stores nodes per second of each result's position and depth, keeping what the baseline has for other positions.
+  """
+  baseline = load_baseline(path) or {}
+  positions = baseline.get('positions', {})
+  positions.update({
+    result.name: {'depth': result.depth, 'nodes_per_second': round(result.nodes / result.seconds)} for result in results
+  })
+  baseline = {'positions': positions}
+  with open(path, 'w') as baseline_file:
+    json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+    baseline_file.write('\n')
+  return baseline
+
+def check_throughput(results, baseline, tolerance_percent):
+  """
+  Compares the results the baseline holds the same position and depth for, so a run narrowed to some positions or
+  another depth is never measured against a different workload. Returns their speed as a fraction of the
+  baseline's, None when no result is comparable, and raises PerftError when it is more than tolerance_percent slower.
+  """
+  positions = baseline.get('positions', {})
+  comparable = [result for result in results if positions.get(result.name, {}).get('depth') == result.depth]
+  if not comparable:
+    return None
+  # the time the baseline would have taken for the same nodes, against the time they took now
+  baseline_seconds = sum(result.nodes / positions[result.name]['nodes_per_second'] for result in comparable)
+  speed = baseline_seconds / sum(result.seconds for result in comparable)
+  if speed < 1 - tolerance_percent / 100:
+    raise PerftError(
+      f'{", ".join(result.name for result in comparable)} ran at {speed:.0%} of the baseline, '
+      f'more than {tolerance_percent}% slower'
+    )
+  return speed
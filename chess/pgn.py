@@ -0,0 +1,181 @@
+"""
+PGN for the move log. Games are replayed on the engine from the match's start_fen to get their SAN, so a game costs a
+board and its moves, and export_games walks any number of matches a chunk at a time without holding more than one.
+parse_san goes the other way for imports, see pgn_import.py.
+"""
+import logging
+import re
+
+from django.conf import settings
+
+from .board import (
+  Board, STARTING_FEN, WHITE, BLACK, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, UNDECIDED,
+  encode_move, move_promotion, parse_square, square_index, square_name,
+)
+from .models import ChessMatch, ChessMove
+from .pagination import keyset_chunks
+
+
+SAN_PIECES = {KNIGHT: 'N', BISHOP: 'B', ROOK: 'R', QUEEN: 'Q', KING: 'K'}
+SAN_PIECE_TYPES = {letter: piece_type for piece_type, letter in SAN_PIECES.items()}
+SAN_MOVE = re.compile(r'([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?')
+# movetext lines are kept under the 80 characters the PGN standard asks for
+LINE_LENGTH = 79
+
+logger = logging.getLogger(__name__)
+
+
+class PGNError(Exception):
+  pass
+
+
+def move_san(board, move):
+  """
+  SAN of a move, which is also played on the board. Raises PGNError when the move isn't legal there.
+  """
+  from_square, to_square = move & 63, (move >> 6) & 63
+  if move not in board.legal_moves(from_mask=1 << from_square):
+    raise PGNError(f'{square_name(from_square)}{square_name(to_square)} is illegal here')
+  team, piece_type = board.mailbox[from_square]
+  if piece_type == KING and abs((to_square & 7) - (from_square & 7)) == 2:
+    san = 'O-O' if to_square & 7 > from_square & 7 else 'O-O-O'
+  elif piece_type == PAWN:
+    san = square_name(to_square)
+    if to_square & 7 != from_square & 7:
+      san = 'abcdefgh'[from_square & 7] + 'x' + san
+    if move >> 12:
+      san += '=' + SAN_PIECES[move_promotion(move)]
+  else:
+    # the same kind of piece reaching the same square has to be told apart by file, rank or both
+    rivals = [
+      other & 63 for other in board.legal_moves()
+      if (other >> 6) & 63 == to_square and other & 63 != from_square and board.mailbox[other & 63] == (team, piece_type)
+    ]
+    disambiguation = ''
+    if rivals:
+      if all(rival & 7 != from_square & 7 for rival in rivals):
+        disambiguation = 'abcdefgh'[from_square & 7]
+      elif all(rival >> 3 != from_square >> 3 for rival in rivals):
+        disambiguation = str((from_square >> 3) + 1)
+      else:
+        disambiguation = square_name(from_square)
+    capture = 'x' if board.mailbox[to_square] is not None else ''
+    san = SAN_PIECES[piece_type] + disambiguation + capture + square_name(to_square)
+  board.push(move)
+  if board.in_check():
+    san += '#' if next(board.legal_moves(), None) is None else '+'
+  return san
+
+def parse_san(board, san):
+  """
+  The legal move san stands for on board. Raises PGNError when it names no legal move or more than one.
+  """
+  san = san.rstrip('+#!?')
+  team = board.turn
+  if san in ('O-O', 'O-O-O', '0-0', '0-0-0'):
+    king = board.king_square(team)
+    if king is None:
+      raise PGNError(f'{san} without a king')
+    to_square = king + (2 if len(san) == 3 else -2)
+    candidates = [move for move in board.legal_moves(from_mask=1 << king) if (move >> 6) & 63 == to_square]
+  else:
+    match = SAN_MOVE.fullmatch(san)
+    if match is None:
+      raise PGNError(f'{san} is not a move')
+    letter, file, rank, to_name, promotion = match.groups()
+    to_square = parse_square(to_name)
+    promotion = SAN_PIECE_TYPES[promotion] if promotion else None
+    # only the moving kind of piece is generated
+    from_mask = board.bitboards[team][SAN_PIECE_TYPES[letter] if letter else PAWN]
+    candidates = [
+      move for move in board.legal_moves(from_mask=from_mask)
+      if (move >> 6) & 63 == to_square and move_promotion(move) == promotion
+      and (file is None or 'abcdefgh'[move & 7] == file) and (rank is None or str(((move & 63) >> 3) + 1) == rank)
+    ]
+  if len(candidates) != 1:
+    raise PGNError(f'{san} is {"ambiguous" if candidates else "illegal"} here')
+  return candidates[0]
+
+def movetext(moves, result, start_fen=STARTING_FEN):
+  """
+  Numbered movetext for (from_row, from_column, to_row, to_column, promotion) tuples played from start_fen.
+  Raises PGNError when a move can't be replayed.
+  """
+  try:
+    board = Board.from_fen(start_fen)
+  except (IndexError, KeyError, ValueError):
+    raise PGNError(f'{start_fen} is not a FEN')
+  tokens = []
+  if moves and board.turn == BLACK:
+    tokens.append(f'{board.fullmove_number}...')
+  for from_row, from_column, to_row, to_column, promotion in moves:
+    if board.turn == WHITE:
+      tokens.append(f'{board.fullmove_number}.')
+    try:
+      move = encode_move(square_index(from_row, from_column), square_index(to_row, to_column), promotion)
+    except KeyError:
+      raise PGNError(f'{promotion} is not a promotion')
+    tokens.append(move_san(board, move))
+  tokens.append(result)
+  lines = []
+  line = ''
+  for token in tokens:
+    if line and len(line) + 1 + len(token) > LINE_LENGTH:
+      lines.append(line)
+      line = token
+    else:
+      line = f'{line} {token}' if line else token
+  lines.append(line)
+  return '\n'.join(lines)
+
+def tag(name, value):
+  value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+  return f'[{name} "{value}"]'
+
+def game_pgn(match_id, result, players, moves, started=None, start_fen=STARTING_FEN):
+  """
+  One game: the seven tag roster, SetUp and FEN when it doesn't start from the standard position, and its
+  movetext, followed by the blank line that separates games. Raises PGNError when the moves can't be replayed.
+  """
+  white, black = (list(players) + ['?', '?'])[:2]
+  headers = [
+    tag('Event', f'Match {match_id}'),
+    tag('Site', 'ChessBackend'),
+    tag('Date', started.strftime('%Y.%m.%d') if started else '????.??.??'),
+    tag('Round', '-'),
+    tag('White', white),
+    tag('Black', black),
+    tag('Result', result or UNDECIDED),
+  ]
+  if start_fen != STARTING_FEN:
+    headers += [tag('SetUp', '1'), tag('FEN', start_fen)]
+  return '\n'.join(headers) + '\n\n' + movetext(moves, result or UNDECIDED, start_fen) + '\n\n'
+
+def export_games(queryset, chunk_size=None):
+  """
+  Yields the PGN of every match in queryset in id order. Each chunk of matches costs three range queries, the
+  matches, their players and their moves, and only that chunk is held in memory. A match whose move log can't be
+  replayed is left out with a warning rather than ending the export halfway through.
+  """
+  for matches in keyset_chunks(queryset.only('id', 'result', 'start_fen'), chunk_size or settings.CHESS_EXPORT_CHUNK_SIZE):
+    match_ids = [match.id for match in matches]
+    players = {match_id: [] for match_id in match_ids}
+    for match_id, username in (
+      ChessMatch.users.through.objects.filter(chessmatch_id__in=match_ids).order_by('id').values_list('chessmatch_id', 'user__username')
+    ):
+      players[match_id].append(username)
+    moves = {match_id: [] for match_id in match_ids}
+    started = {}
+    for match_id, seq, from_row, from_column, to_row, to_column, promotion, created in (
+      ChessMove.objects.filter(chess_match_id__in=match_ids).order_by('chess_match_id', 'seq').values_list(
+        'chess_match_id', 'seq', 'from_row', 'from_column', 'to_row', 'to_column', 'promotion', 'created',
+      ).iterator()
+    ):
+      if seq == 1:
+        started[match_id] = created
+      moves[match_id].append((from_row, from_column, to_row, to_column, promotion))
+    for match in matches:
+      try:
+        yield game_pgn(match.id, match.result, players[match.id], moves[match.id], started.get(match.id), match.start_fen)
+      except PGNError as error:
+        logger.warning('Left match %s out of the PGN export: %s', match.id, error)
@@ -0,0 +1,229 @@
+"""
+Bulk PGN import. read_games streams games out of a PGN file, chunks of them are replayed on the engine in a
+process pool, and the main process writes each chunk's matches, moves and final pieces with bulk_create inside one
+transaction per chunk. Only a few chunks are in flight at any time, so memory stays flat whatever the file size.
+"""
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .board import Board, STARTING_FEN, UNDECIDED, WHITE_WINS, BLACK_WINS, DRAW
+from .game_state import AttackMaps, game_status
+from .models import ChessMatch, ChessMove, ChessPiece
+from .pgn import PGNError, parse_san
+
+
+RESULTS = (WHITE_WINS, BLACK_WINS, DRAW, UNDECIDED)
+TAG = re.compile(r'\[(\w+)\s+"((?:[^"\\]|\\.)*)"\]')
+COMMENT = re.compile(r'\{[^}]*\}|;[^\n]*')
+VARIATION = re.compile(r'\([^()]*\)')
+MOVE_NUMBER = re.compile(r'^\d+\.+')
+
+
+def read_games(lines):
+  """
+  Yields the text of each game in a stream of PGN lines. A game ends with its result or where the next one's tags
+  begin.
+  """
+  game = []
+  in_movetext = False
+  for line in lines:
+    stripped = line.strip()
+    if stripped.startswith('['):
+      if in_movetext:
+        yield ''.join(game)
+        game = []
+        in_movetext = False
+    elif stripped and not stripped.startswith('%'):
+      in_movetext = True
+    game.append(line)
+    if in_movetext and stripped and stripped.split()[-1] in RESULTS:
+      # the result closes the movetext, so games without tags don't run into each other
+      yield ''.join(game)
+      game = []
+      in_movetext = False
+  if any(line.strip() for line in game):
+    yield ''.join(game)
+
+def san_tokens(text):
+  """
+  The moves of a game's movetext, without comments, variations, NAGs, move numbers and the result.
+  """
+  text = COMMENT.sub(' ', text)
+  # variations nest, so innermost ones are taken out until none are left
+  while '(' in text:
+    text, removed = VARIATION.subn(' ', text)
+    if not removed:
+      raise PGNError('unbalanced variation')
+  for token in text.split():
+    token = MOVE_NUMBER.sub('', token)
+    if token and not token.startswith('$') and token not in RESULTS:
+      yield token
+
+def parse_game(text):
+  """
+  Replays a game from its PGN text, from the position in its FEN tag when it has one. Returns (tags, moves, final
+  board, status, result) where every move is the tuple of ChessMove fields from team to position_hash.
+  """
+  tags = dict(TAG.findall(text))
+  movetext = TAG.sub(' ', text)
+  try:
+    board = Board.from_fen(tags.get('FEN', STARTING_FEN))
+  except (IndexError, KeyError, ValueError):
+    # an overlong rank or a stray letter must reject this game, not the whole import
+    raise PGNError(f'{tags["FEN"]} is not a FEN')
+  if 'FEN' in tags:
+    # kept the way the engine writes it, so a tag spelling out the standard position compares equal to STARTING_FEN
+    tags['FEN'] = board.fen()
+  moves = []
+  for san in san_tokens(movetext):
+    move = parse_san(board, san)
+    from_square, to_square = move & 63, (move >> 6) & 63
+    team, piece_type = board.mailbox[from_square]
+    board.push(move)
+    captured = board.history[-1][5]
+    moves.append((
+      team,
+      piece_type,
+      from_square >> 3,
+      from_square & 7,
+      to_square >> 3,
+      to_square & 7,
+      board.mailbox[to_square][1] if move >> 12 else None,
+      captured[1][1] if captured else None,
+      bool(captured) and captured[0] != to_square,
+      board.zobrist,
+    ))
+  status, result, _ = game_status(board, AttackMaps(board))
+  if result == UNDECIDED and tags.get('Result') in RESULTS:
+    # resignations, agreed draws and flag falls only show in the tags
+    result = tags['Result']
+  return tags, moves, board, status, result
+
+def parse_chunk(texts):
+  """
+  Parses a list of game texts. Returns (games, errors), games as (moves, fen, status, result, pieces, start_fen)
+  with pieces the (team, piece_type, row, column, move_count) of everything left on the board, errors as
+  (index, message).
+  """
+  games = []
+  errors = []
+  for index, text in enumerate(texts):
+    try:
+      tags, moves, board, status, result = parse_game(text)
+    except PGNError as error:
+      errors.append((index, str(error)))
+      continue
+    pieces = [
+      (piece[0], piece[1], square >> 3, square & 7, board.move_counts.get(square, 0))
+      for square, piece in enumerate(board.mailbox) if piece is not None
+    ]
+    games.append((moves, board.fen(), status, result, pieces, tags.get('FEN', STARTING_FEN)))
+  return games, errors
+
+def bulk_insert(model, objects, batch_size):
+  """
+  bulk_create with batch_size capped at the rows the backend takes in one INSERT, which Django 2.2 leaves to the
+  caller once a batch_size is given.
+  """
+  fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+  return model.objects.bulk_create(objects, batch_size=min(batch_size, max(connection.ops.bulk_batch_size(fields, objects), 1)))
+
+def write_games(games, batch_size=1000):
+  """
+  Inserts a parsed chunk: the matches, then all their moves and final pieces in bulk, in one transaction.
+  """
+  with transaction.atomic():
+    matches = [
+      ChessMatch(fen=fen, start_fen=start_fen, status=status, result=result, version=len(moves))
+      for moves, fen, status, result, _, start_fen in games
+    ]
+    if connection.features.can_return_ids_from_bulk_insert:
+      matches = bulk_insert(ChessMatch, matches, batch_size)
+    else:
+      for match in matches:
+        match.save(force_insert=True)
+    bulk_insert(ChessMove, [
+      ChessMove(
+        chess_match_id=match.id,
+        seq=seq,
+        team=team,
+        piece_type=piece_type,
+        from_row=from_row,
+        from_column=from_column,
+        to_row=to_row,
+        to_column=to_column,
+        promotion=promotion,
+        captured_piece_type=captured_piece_type,
+        en_passant=en_passant,
+        position_hash=position_hash,
+      )
+      for match, (moves, _, _, _, _, _) in zip(matches, games)
+      for seq, (team, piece_type, from_row, from_column, to_row, to_column, promotion, captured_piece_type, en_passant, position_hash)
+      in enumerate(moves, 1)
+    ], batch_size)
+    if settings.CHESS_MATERIALIZE_PIECES:
+      bulk_insert(ChessPiece, [
+        ChessPiece(chess_match_id=match.id, team=team, piece_type=piece_type, row=row, column=column, move_count=move_count)
+        for match, (_, _, _, _, pieces, _) in zip(matches, games)
+        for team, piece_type, row, column, move_count in pieces
+      ], batch_size)
+  return matches
+
+def chunked(iterable, size):
+  iterator = iter(iterable)
+  while True:
+    chunk = list(islice(iterator, size))
+    if not chunk:
+      return
+    yield chunk
+
+def parsed_chunks(chunks, processes):
+  """
+  parse_chunk over chunks, in order. With several processes at most two chunks per process are queued at once,
+  so a huge file is never read further ahead than the writer can keep up with.
+  """
+  if processes < 2:
+    yield from map(parse_chunk, chunks)
+    return
+  with ProcessPoolExecutor(max_workers=processes) as pool:
+    pending = deque()
+    for chunk in chunks:
+      pending.append(pool.submit(parse_chunk, chunk))
+      if len(pending) >= processes * 2:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+def import_games(lines, chunk_size=None, processes=None, batch_size=None, progress=None):
+  """
+  Imports every game in a stream of PGN lines. progress, when given, is called with the running totals after each
+  chunk is written. Returns the totals: games imported, moves, games rejected with the first error messages, and
+  games per second.
+  """
+  options = settings.CHESS_PGN_IMPORT
+  chunk_size = chunk_size or options['CHUNK_SIZE']
+  processes = processes or options['PROCESSES']
+  batch_size = batch_size or options['BATCH_SIZE']
+  totals = {'games': 0, 'moves': 0, 'rejected': 0, 'errors': [], 'seconds': 0, 'games_per_second': 0}
+  started = time.perf_counter()
+  offset = 0
+  for games, errors in parsed_chunks(chunked(read_games(lines), chunk_size), processes):
+    if games:
+      write_games(games, batch_size)
+    totals['games'] += len(games)
+    totals['moves'] += sum(len(game[0]) for game in games)
+    totals['rejected'] += len(errors)
+    # keep a few messages to show, numbered by the game's position in the file
+    totals['errors'].extend((offset + index + 1, message) for index, message in errors[:max(0, 10 - len(totals['errors']))])
+    offset += len(games) + len(errors)
+    totals['seconds'] = time.perf_counter() - started
+    totals['games_per_second'] = totals['games'] / totals['seconds'] if totals['seconds'] else 0
+    if progress is not None:
+      progress(totals)
+  return totals
@@ -0,0 +1,50 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class PositionCache:
+  """
+  LRU keyed by (kind, Zobrist hash), so anything computed for a position (legal moves, evaluations, ...)
+  is shared by every match that reaches it.
+  """
+  def __init__(self, max_entries=100000):
+    self.max_entries = max_entries
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def memoize(self, kind, board, compute):
+    key = (kind, board.zobrist)
+    with self.lock:
+      if key in self.entries:
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+      self.misses += 1
+    value = compute(board)
+    with self.lock:
+      self.entries[key] = value
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+    return value
+
+  def legal_moves(self, board):
+    """
+    All legal moves of the side to move, as a frozenset of encoded moves.
+    """
+    return self.memoize('legal_moves', board, lambda board: frozenset(board.legal_moves()))
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {
+      'entries': len(self.entries),
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_rate': self.hits / lookups if lookups else None,
+    }
+
+
+position_cache = PositionCache(settings.CHESS_POSITION_CACHE_MAX_ENTRIES)
@@ -0,0 +1,111 @@
+"""
+Binary websocket subprotocol, opted into by offering BINARY_SUBPROTOCOL when connecting. Clients send a move as
+one 16-bit big-endian word laid out like the engine's moves: from square in bits 0-5, to square in bits 6-11 and
+the promotion piece in bits 12-14 (0 none, 1 knight, 2 bishop, 3 rook, 4 queen), squares being row * 8 + column.
+Everything else travels as msgpack arrays whose first item is the frame kind:
+
+  [HELLO, seq]                                             sent after connecting
+  [MOVE, seq, move word, captured square or nil, check, status, result, version]
+  [REJECTED, from square or nil, status]                   the move was not played
+  [SYNC, after]                                            client asks for the moves after seq
+  [MOVES, [MOVE frame, ...]]                               answer to SYNC
+  [POSITION, seq, fen, status, result, version, MOVE frame or nil]   spectators only, the board after seq
+  [ACK, seq]                                               client applied everything up to seq, see outbox.py
+
+Team, piece type, castling rook and en passant follow from the move on the client's own board, so frames carry
+squares only. Status is the ChessMatch status code.
+"""
+import struct
+
+import msgpack
+
+from .board import PROMOTION_CODES, PROMOTION_PIECES, square_index, square_row, square_column
+from .models import ChessMatch, ChessPiece
+
+
+BINARY_SUBPROTOCOL = 'chess.binary.v1'
+
+HELLO = 0
+MOVE = 1
+REJECTED = 2
+SYNC = 3
+MOVES = 4
+POSITION = 5
+ACK = 6
+
+MOVE_WORD = struct.Struct('>H')
+PIECE_TYPES_BY_DISPLAY = {display: piece_type for piece_type, display in ChessPiece.PIECE_CHOICES}
+STATUS_BY_DISPLAY = {display: code for code, display in ChessMatch.STATUS_CHOICES}
+
+
+class ProtocolError(Exception):
+  pass
+
+
+def pack(frame):
+  return msgpack.packb(frame, use_bin_type=True)
+
+def move_word(from_row, from_column, row, column, promotion=None):
+  return square_index(from_row, from_column) | (square_index(row, column) << 6) | (PROMOTION_CODES[promotion] << 12)
+
+def move_frame(delta):
+  promotion = PIECE_TYPES_BY_DISPLAY[delta['promotion']] if delta['promotion'] else None
+  captured = delta['captured']
+  return [
+    MOVE,
+    delta['seq'],
+    move_word(delta['from_row'], delta['from_column'], delta['row'], delta['column'], promotion),
+    square_index(captured['row'], captured['column']) if captured else None,
+    delta.get('check', False),
+    STATUS_BY_DISPLAY.get(delta.get('status'), ChessMatch.ACTIVE),
+    delta.get('result', ChessMatch.UNDECIDED),
+    delta.get('version'),
+  ]
+
+def encode_result(move_result):
+  """
+  Binary frame for what apply_move returned, a played move's delta or a rejection.
+  """
+  if move_result['move_valid']:
+    return pack(move_frame(move_result))
+  from_square = square_index(move_result['row'], move_result['column']) if move_result['row'] is not None else None
+  return pack([REJECTED, from_square, STATUS_BY_DISPLAY[move_result['status']]])
+
+def encode_moves(deltas):
+  return pack([MOVES, [move_frame(delta) for delta in deltas]])
+
+def encode_position(position):
+  last_move = position['last_move']
+  return pack([
+    POSITION,
+    position['seq'],
+    position['fen'],
+    STATUS_BY_DISPLAY[position['status']],
+    position['result'],
+    position['version'],
+    move_frame(last_move) if last_move else None,
+  ])
+
+def decode_request(bytes_data):
+  """
+  ('move', message dict like the JSON protocol's), ('sync', after) or ('ack', seq). Raises ProtocolError for anything else.
+  """
+  if len(bytes_data) == MOVE_WORD.size:
+    word, = MOVE_WORD.unpack(bytes_data)
+    if word >> 12 not in PROMOTION_PIECES:
+      raise ProtocolError('unknown promotion piece')
+    from_square, to_square = word & 63, (word >> 6) & 63
+    return 'move', {
+      'from_row': square_row(from_square),
+      'from_column': square_column(from_square),
+      'row': square_row(to_square),
+      'column': square_column(to_square),
+      'promotion': PROMOTION_PIECES[word >> 12],
+    }
+  try:
+    frame = msgpack.unpackb(bytes_data, raw=False)
+  except Exception:
+    raise ProtocolError('not a msgpack frame')
+  if isinstance(frame, list) and len(frame) == 2 and frame[0] in (SYNC, ACK) and isinstance(frame[1], int):
+    return 'sync' if frame[0] == SYNC else 'ack', frame[1]
+  raise ProtocolError('unknown frame')
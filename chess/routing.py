@@ -3,4 +3,5 @@ from . import consumers
 
 websocket_urlpatterns = [
   url(r'^ws/chess/matches/lobby/(?P<match_id>[0-9]+)/$', consumers.ChessMatchConsumer),
+  url(r'^ws/chess/matchmaking/$', consumers.MatchmakingConsumer),
 ]
@@ -1,32 +1,118 @@
+import base64
+
 import graphene
+from django.conf import settings
+from django.contrib.auth.models import User
+from graphene import relay
 from graphene_django.types import DjangoObjectType
+from graphql import GraphQLError
 
+from .loaders import get_loaders
 from .models import ChessMatch, ChessPiece
-from django.contrib.auth.models import User
 
 
 class UserType(DjangoObjectType):
   class Meta:
     model = User
 
+  chessmatch_set = graphene.List(lambda: ChessMatchType)
+
+  def resolve_chessmatch_set(self, info, **kwargs):
+    return get_loaders(info).user_matches.load(self.id)
+
 class ChessMatchType(DjangoObjectType):
   class Meta:
     model = ChessMatch
 
+  # Nested lists go through the request's DataLoaders, one query per relation however many matches are listed
+  users = graphene.List(UserType)
+  chesspiece_set = graphene.List(lambda: ChessPieceType)
+
+  def resolve_users(self, info, **kwargs):
+    return get_loaders(info).match_users.load(self.id)
+
+  def resolve_chesspiece_set(self, info, **kwargs):
+    return get_loaders(info).match_pieces.load(self.id)
+
 class ChessPieceType(DjangoObjectType):
   class Meta:
     model = ChessPiece
 
+  def resolve_chess_match(self, info, **kwargs):
+    return get_loaders(info).match.load(self.chess_match_id)
+
+
+class UserConnection(relay.Connection):
+  class Meta:
+    node = UserType
+
+class ChessMatchConnection(relay.Connection):
+  class Meta:
+    node = ChessMatchType
+
+class ChessPieceConnection(relay.Connection):
+  class Meta:
+    node = ChessPieceType
+
+
+def encode_cursor(pk):
+  return base64.b64encode(f'pk:{pk}'.encode()).decode()
+
+def decode_cursor(cursor):
+  try:
+    prefix, pk = base64.b64decode(cursor.encode()).decode().split(':')
+    if prefix != 'pk':
+      raise ValueError
+    return int(pk)
+  except ValueError:
+    raise GraphQLError(f'Invalid cursor {cursor!r}')
+
+def keyset_page(queryset, connection_type, first=None, last=None, after=None, before=None, **kwargs):
+  """
+  One page of a connection ordered by primary key. Cursors hold the last primary key seen, so a page is a
+  single indexed range query however deep into the list it is, and there is no COUNT or OFFSET.
+  """
+  max_page_size = settings.CHESS_GRAPHQL['MAX_PAGE_SIZE']
+  if any(size is not None and size < 0 for size in (first, last)):
+    raise GraphQLError('first and last must not be negative')
+  if after is not None:
+    queryset = queryset.filter(pk__gt=decode_cursor(after))
+  if before is not None:
+    queryset = queryset.filter(pk__lt=decode_cursor(before))
+
+  if last is not None and first is None:
+    size = min(last, max_page_size)
+    rows = list(queryset.order_by('-pk')[:size + 1])
+    has_previous_page, has_next_page = len(rows) > size, before is not None
+    rows = rows[:size][::-1]
+  else:
+    size = min(settings.CHESS_GRAPHQL['DEFAULT_PAGE_SIZE'] if first is None else first, max_page_size)
+    rows = list(queryset.order_by('pk')[:size + 1])
+    has_previous_page, has_next_page = after is not None, len(rows) > size
+    rows = rows[:size]
+
+  edges = [connection_type.Edge(node=row, cursor=encode_cursor(row.pk)) for row in rows]
+  return connection_type(
+    edges=edges,
+    page_info=relay.PageInfo(
+      start_cursor=edges[0].cursor if edges else None,
+      end_cursor=edges[-1].cursor if edges else None,
+      has_previous_page=has_previous_page,
+      has_next_page=has_next_page,
+    ),
+  )
+
+
 class Query(object):
-  all_users = graphene.List(UserType)
-  all_chess_matches = graphene.List(ChessMatchType)
-  all_chess_pieces = graphene.List(ChessPieceType)
+  all_users = relay.ConnectionField(UserConnection)
+  all_chess_matches = relay.ConnectionField(ChessMatchConnection)
+  all_chess_pieces = relay.ConnectionField(ChessPieceConnection)
 
   def resolve_all_users(self, info, **kwargs):
-    return User.objects.all()
+    return keyset_page(User.objects.all(), UserConnection, **kwargs)
 
   def resolve_all_chess_matches(self, info, **kwargs):
-    return ChessMatch.objects.all()
+    return keyset_page(ChessMatch.objects.all(), ChessMatchConnection, **kwargs)
 
   def resolve_all_chess_pieces(self, info, **kwargs):
-    return ChessPiece.objects.all()
+    return keyset_page(ChessPiece.objects.all(), ChessPieceConnection, **kwargs)
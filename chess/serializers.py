@@ -11,9 +11,36 @@ class UserSerializer(serializers.ModelSerializer):
 class ChessMatchSerializer(serializers.ModelSerializer):
   class Meta:
     model = ChessMatch
-    fields = ('id', 'users',)
+    fields = ('id', 'users', 'fen', 'status', 'result', 'version', 'last_activity',)
+    read_only_fields = ('fen', 'status', 'result', 'version', 'last_activity',)
 
 class ChessPieceSerializer(serializers.ModelSerializer):
   class Meta:
     model = ChessPiece
     fields = ('id', 'chess_match', 'piece_type', 'team',)
+
+class MatchBatchSerializer(serializers.Serializer):
+  """
+  Either pairings, lists of at most two distinct user ids, or a count of empty matches, up to MAX_MATCHES.
+  """
+  MAX_MATCHES = 500
+
+  pairings = serializers.ListField(
+    child=serializers.ListField(child=serializers.IntegerField(min_value=1), max_length=2),
+    min_length=1,
+    max_length=MAX_MATCHES,
+    required=False,
+  )
+  count = serializers.IntegerField(min_value=1, max_value=MAX_MATCHES, required=False)
+
+  def validate_pairings(self, pairings):
+    if any(len(set(user_ids)) != len(user_ids) for user_ids in pairings):
+      raise serializers.ValidationError('each pairing is a list of at most 2 distinct user ids')
+    return pairings
+
+  def validate(self, data):
+    if 'pairings' not in data:
+      if 'count' not in data:
+        raise serializers.ValidationError('pairings or count is required')
+      data['pairings'] = [[] for _ in range(data['count'])]
+    return data
@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from .board_cache import board_cache
+from .models import ChessMatch, ChessPiece
+
+
+def match_version(match_id):
+  """
+  Current version of a match: from the cached board when this worker has one, otherwise a single-column query.
+  With compare-and-set other workers move the same matches, so only the database knows the current version.
+  Raises ChessMatch.DoesNotExist for unknown matches.
+  """
+  live = None if board_cache.compare_and_set else board_cache.peek(match_id)
+  if live is not None:
+    return live.version
+  return ChessMatch.objects.values_list('version', flat=True).get(pk=match_id)
+
+def match_etag(match_id, version):
+  return f'"match-{match_id}-{version}"'
+
+def snapshot_key(match_id, version):
+  return f'chess:match-snapshot:{match_id}:{version}'
+
+def match_snapshot(match_id, version):
+  """
+  What ChessMatchDetail returns for a match at version. A version never changes once reached, so snapshots are
+  cached under (match id, version) and never invalidated, a newer version simply misses.
+  """
+  snapshot = cache.get(snapshot_key(match_id, version))
+  if snapshot is None:
+    # unsaved moves have to reach the pieces table before it is read
+    board_cache.flush_match(match_id)
+    match = ChessMatch.objects.get(pk=match_id)
+    snapshot = {
+      'id': match.id,
+      # a move may have landed since version was read, label the snapshot with what was actually loaded
+      'version': match.version,
+      'users': [{'id': user.id, 'username': user.username} for user in match.users.all()],
+      'fen': match.fen,
+      'status': match.get_status_display(),
+      'result': match.result,
+      'pieces': list(ChessPiece.objects.filter(chess_match=match).values()),
+    }
+    cache.set(snapshot_key(match_id, match.version), snapshot, settings.CHESS_SNAPSHOT_CACHE_SECONDS)
+  return snapshot
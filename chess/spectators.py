@@ -0,0 +1,174 @@
+"""
+Spectator tier of the match broadcasts. Spectators sit in their own groups next to the players' one and are sent
+whole positions instead of moves, so any of them can be skipped: after a move the match is only marked dirty, and
+a per-match task sends the latest position at most once every interval_ms, encoded once for every spectator.
+Spectators are spread over `shards` groups that are sent to one after another across the first half of the
+interval, so a big audience never takes the worker in one burst and players' frames get through in between.
+How many spectators sit in each shard is counted in the CHESS_SPECTATORS['CACHE'] cache, and only shards someone
+watches are sent to, so a match nobody watches costs its moves no channel layer traffic. With several workers the
+counts have to be shared between them, so the broadcaster refuses a per-process cache (locmem, dummy) when
+CHESS_BOARD_CACHE['COMPARE_AND_SET'] says several workers serve the same matches.
+"""
+import asyncio
+import json
+import logging
+import zlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+from .board_cache import board_cache
+from .executor import database_sync_to_async
+from .move_log import STATUS_DISPLAY
+from .protocol import encode_position
+
+
+logger = logging.getLogger(__name__)
+
+# caches every worker process keeps its own copy of
+PROCESS_LOCAL_CACHES = (LocMemCache, DummyCache)
+
+
+def spectator_group(match_id, shard):
+  return f'match_{match_id}_spectators_{shard}'
+
+def spectator_shard(channel_name):
+  return zlib.crc32(channel_name.encode('utf-8')) % settings.CHESS_SPECTATORS['SHARDS']
+
+def audience_key(match_id, shard):
+  return f'chess:spectators:{match_id}:{shard}'
+
+def position(live):
+  """
+  The board after the last move, with that move when this worker still has it.
+  """
+  with live.lock:
+    seq = live.next_seq - 1
+    last_move = live.recent_moves[-1] if live.recent_moves else None
+    return {
+      'seq': seq,
+      'fen': live.board.fen(),
+      'status': STATUS_DISPLAY[live.status],
+      'result': live.result,
+      'version': live.version,
+      'last_move': last_move if last_move is not None and last_move['seq'] == seq else None,
+    }
+
+async def match_position(match_id):
+  live = board_cache.peek(match_id) or await database_sync_to_async(board_cache.get)(match_id)
+  return position(live)
+
+
+class SpectatorBroadcaster:
+  """
+  Coalesces spectator frames per match: the first move after a quiet spell goes out straight away, moves arriving
+  within interval_ms of a frame are folded into a single frame with the position after the last of them.
+  """
+  def __init__(self, interval_ms=500, shards=16, cache_alias='default', several_workers=False):
+    if several_workers and isinstance(caches[cache_alias], PROCESS_LOCAL_CACHES):
+      raise ImproperlyConfigured(
+        f"Spectator counts need a cache shared between workers, {cache_alias!r} is "
+        f"{type(caches[cache_alias]).__name__}: point CHESS_SPECTATORS['CACHE'] at Redis or memcached"
+      )
+    self.interval_ms = interval_ms
+    self.shards = shards
+    self.cache_alias = cache_alias
+    self.tasks = {}
+    self.dirty = set()
+    self.frames = 0
+    self.coalesced = 0
+    self.unwatched = 0
+
+  def watch(self, match_id, shard):
+    """
+    Counts a spectator in, before it joins the shard's group so no frame can be skipped meanwhile.
+    """
+    cache = caches[self.cache_alias]
+    key = audience_key(match_id, shard)
+    cache.add(key, 0, None)
+    try:
+      cache.incr(key)
+    except ValueError:
+      # evicted in between
+      cache.set(key, 1, None)
+
+  def unwatch(self, match_id, shard):
+    try:
+      caches[self.cache_alias].decr(audience_key(match_id, shard))
+    except ValueError:
+      pass
+
+  def watched_shards(self, match_id):
+    keys = [audience_key(match_id, shard) for shard in range(self.shards)]
+    counts = caches[self.cache_alias].get_many(keys)
+    return [shard for shard, key in enumerate(keys) if counts.get(key, 0) > 0]
+
+  def publish(self, channel_layer, match_id):
+    """
+    Marks the match's position as changed. Never waits, so it can be called straight from the move path.
+    """
+    loop = asyncio.get_event_loop()
+    key = (loop, int(match_id))
+    if key not in self.tasks:
+      self.tasks[key] = loop.create_task(self._run(key, channel_layer))
+    elif key in self.dirty:
+      # the position this replaces was never sent
+      self.coalesced += 1
+    else:
+      self.dirty.add(key)
+
+  async def _run(self, key, channel_layer):
+    match_id = key[1]
+    try:
+      while True:
+        self.dirty.discard(key)
+        try:
+          await self.send(channel_layer, match_id)
+        except Exception:
+          logger.exception('Spectator broadcast for match %s failed', match_id)
+        if key not in self.dirty:
+          return
+    finally:
+      del self.tasks[key]
+
+  async def send(self, channel_layer, match_id):
+    """
+    Sends the current position to every watched shard, taking interval_ms in all. Returns straight away when
+    nobody watches.
+    """
+    shards = await database_sync_to_async(self.watched_shards)(match_id)
+    if not shards:
+      self.unwatched += 1
+      return
+    frame = await match_position(match_id)
+    self.frames += 1
+    event = {
+      'type': 'spectator_message',
+      'text': json.dumps({'type': 'position', **frame}),
+      'bytes': encode_position(frame),
+      'seq': frame['seq'],
+    }
+    pause = self.interval_ms / 1000 / 2 / len(shards)
+    for shard in shards:
+      await channel_layer.group_send(spectator_group(match_id, shard), event)
+      await asyncio.sleep(pause)
+    await asyncio.sleep(self.interval_ms / 1000 / 2)
+
+  def stats(self):
+    return {
+      'broadcasting': len(self.tasks),
+      'frames': self.frames,
+      'coalesced': self.coalesced,
+      'unwatched': self.unwatched,
+    }
+
+
+spectator_broadcaster = SpectatorBroadcaster(
+  settings.CHESS_SPECTATORS['INTERVAL_MS'],
+  settings.CHESS_SPECTATORS['SHARDS'],
+  settings.CHESS_SPECTATORS['CACHE'],
+  settings.CHESS_BOARD_CACHE['COMPARE_AND_SET'],
+)
@@ -1,3 +1,1131 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import json
+import random
+import time
+from unittest import mock
 
-# Create your tests here.
+import jwt
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, connection
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from chess_backend import middleware
+
+from . import protocol
+from . import batch_validation
+from .batch_validation import validate_chunk, validate_moves
+from .bench import IN_MEMORY_CHANNEL_LAYERS
+from .board import Board, STARTING_FEN, WHITE, BLACK, QUEEN, KNIGHT, encode_move, parse_square, square_row, square_column
+from .board_cache import BoardCache, LiveMatch, board_cache
+from .consumers import ChessMatchConsumer
+from .game_state import AttackMaps, game_status
+from .membership import MembershipCache, membership_cache, SPECTATOR
+from .models import ChessMatch, ChessMove, ChessPiece
+from .move_log import moves_after
+from .outbox import Outbox, DISCONNECT, RESYNC_CLOSE_CODE
+from .pagination import keyset_chunks, stream_json_array
+from .pgn import export_games
+from .pgn_import import import_games
+from .perft import PerftResult, run_suite, load_baseline, check_throughput, PerftError
+from .position_cache import PositionCache
+from .snapshots import match_version
+from .spectators import SpectatorBroadcaster, spectator_group
+from .views import CreateNewChessMatch
+from .websocket_bench import make_token
+
+
+def play(live, *moves, team=None):
+  """
+  Plays UCI moves ('e2e4') on a live match the way the consumer does, returns the last result.
+  """
+  for move in moves:
+    from_square, to_square = parse_square(move[0:2]), parse_square(move[2:4])
+    result = ChessMatchConsumer.apply_move(
+      live, None, square_row(to_square), square_column(to_square), move[4:5] or None,
+      square_row(from_square), square_column(from_square), team,
+    )
+  return result
+
+
+class PerftTests(SimpleTestCase):
+  """
+  Move generator correctness against the known perft counts, and throughput against the stored baseline.
+  Refresh the baseline with `manage.py perft --save-baseline` after a deliberate change or on new hardware.
+  """
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    cls.results = run_suite()
+
+  def test_node_counts(self):
+    for result in self.results:
+      with self.subTest(position=result.name, depth=result.depth):
+        self.assertEqual(result.nodes, result.expected)
+
+  def test_throughput(self):
+    baseline = load_baseline(settings.CHESS_PERFT['BASELINE'])
+    if baseline is None:
+      self.skipTest('no perft baseline stored')
+    try:
+      check_throughput(self.results, baseline, settings.CHESS_PERFT['TOLERANCE_PERCENT'])
+    except PerftError as error:
+      self.fail(str(error))
+
+  def test_throughput_compares_like_with_like(self):
+    baseline = {'positions': {'start': {'depth': 4, 'nodes_per_second': 1000}, 'kiwipete': {'depth': 3, 'nodes_per_second': 100}}}
+    # a narrowed run is only held against its own positions, however fast the others were
+    self.assertEqual(check_throughput([PerftResult('kiwipete', 3, 100, 100, 1.0)], baseline, 10), 1.0)
+    self.assertIsNone(check_throughput([PerftResult('start', 2, 400, 400, 0.001)], baseline, 10))
+    self.assertAlmostEqual(check_throughput([
+      PerftResult('start', 4, 1000, 1000, 1.0), PerftResult('kiwipete', 3, 100, 100, 1.2), PerftResult('position3', 4, 5, 5, 9.0),
+    ], baseline, 10), 2 / 2.2)
+    with self.assertRaises(PerftError):
+      check_throughput([PerftResult('kiwipete', 3, 100, 100, 1.2)], baseline, 10)
+
+
+class PromotionTests(SimpleTestCase):
+  """
+  Promotion pieces arrive as codes, FEN letters or the display names the server broadcasts.
+  """
+  FEN = '7k/P7/8/8/8/8/8/K7 w - - 0 1'
+
+  def promote(self, promotion):
+    live = LiveMatch(1, Board.from_fen(self.FEN))
+    return live, ChessMatchConsumer.apply_move(live, None, 7, 0, promotion, 6, 0)
+
+  def test_names(self):
+    for promotion, piece_type in (('Queen', QUEEN), ('Q', QUEEN), ('n', KNIGHT), ('KN', KNIGHT), (None, QUEEN)):
+      with self.subTest(promotion=promotion):
+        live, result = self.promote(promotion)
+        self.assertTrue(result['move_valid'])
+        self.assertEqual(live.board.mailbox[56][1], piece_type)
+
+  def test_invalid_pieces(self):
+    for promotion in ('P', 'K', 'King', 'Dragon', 7):
+      with self.subTest(promotion=promotion):
+        live, result = self.promote(promotion)
+        self.assertFalse(result['move_valid'])
+        self.assertEqual(live.version, 0)
+
+
+class GameStatusTests(TestCase):
+  """
+  End of game detection on the engine, and in the frozen copy migration 0013 backfilled status and result with,
+  which must agree with it.
+  """
+  POSITIONS = (
+    ('rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/PPPPP2P/RNBQKBNR w KQkq - 1 3', 'CM', '0-1'),
+    ('R5k1/5ppp/8/8/8/8/8/K7 b - - 0 1', 'CM', '1-0'),
+    ('7k/5Q2/6K1/8/8/8/8/8 b - - 0 1', 'SM', '1/2-1/2'),
+    ('k7/8/8/8/8/8/8/K7 w - - 0 1', 'IM', '1/2-1/2'),
+    ('k7/8/8/8/8/8/8/KN6 b - - 0 1', 'IM', '1/2-1/2'),
+    ('k7/8/8/8/8/8/B7/KB6 w - - 0 1', 'IM', '1/2-1/2'),
+    ('kn6/8/8/8/8/8/8/KN6 w - - 0 1', 'A', '*'),
+    ('kb6/8/8/8/8/8/8/KB6 w - - 0 1', 'A', '*'),
+    ('k7/8/8/8/8/8/8/KR6 w - - 100 80', 'FM', '1/2-1/2'),
+    ('k7/8/8/8/8/8/8/KR6 w - - 99 80', 'A', '*'),
+    ('4k3/8/8/8/8/8/8/4R1K1 b - - 0 1', 'A', '*'),
+    (STARTING_FEN, 'A', '*'),
+  )
+
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    cls.migration = importlib.import_module('chess.migrations.0013_chessmatch_status_result')
+
+  def test_engine(self):
+    for fen, status, result in self.POSITIONS:
+      with self.subTest(fen=fen):
+        board = Board.from_fen(fen)
+        self.assertEqual(game_status(board, AttackMaps(board))[:2], (status, result))
+
+  def test_migration(self):
+    for fen, status, result in self.POSITIONS:
+      with self.subTest(fen=fen):
+        self.assertEqual(self.migration.game_status(fen), (status, result))
+
+  def test_backfill(self):
+    matches = [ChessMatch.objects.create(fen=fen) for fen, _, _ in self.POSITIONS]
+    self.migration.record_results(django_apps, None)
+    self.assertEqual(
+      [(match.status, match.result) for match in ChessMatch.objects.filter(pk__in=[match.id for match in matches]).order_by('id')],
+      [(status, result) for _, status, result in self.POSITIONS],
+    )
+
+
+class ZobristTests(SimpleTestCase):
+  """
+  The incrementally updated hash against one computed from scratch, and the repetition, fifty-move and position
+  cache logic keyed by it.
+  """
+  def test_incremental_hash(self):
+    rng = random.Random(7)
+    for fen in (STARTING_FEN, 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1', '7k/P7/8/8/8/8/1p6/K7 w - - 0 1'):
+      board = Board.from_fen(fen)
+      hashes = []
+      for ply in range(120):
+        moves = list(board.legal_moves())
+        if not moves:
+          break
+        hashes.append(board.zobrist)
+        board.push(rng.choice(moves))
+        with self.subTest(fen=fen, ply=ply):
+          self.assertEqual(board.zobrist, board.compute_zobrist())
+          self.assertEqual(board.zobrist, Board.from_fen(board.fen()).zobrist)
+      while hashes:
+        board.pop()
+        self.assertEqual(board.zobrist, hashes.pop())
+      self.assertEqual(board.fen(), Board.from_fen(fen).fen())
+
+  def test_threefold_repetition(self):
+    live = LiveMatch(1, Board.from_fen(STARTING_FEN))
+    play(live, 'g1f3', 'g8f6', 'f3g1', 'f6g8', 'g1f3', 'g8f6', 'f3g1')
+    self.assertEqual(live.status, ChessMatch.ACTIVE)
+    result = play(live, 'f6g8')
+    self.assertEqual((live.status, live.result, result['result']), (ChessMatch.THREEFOLD_REPETITION, '1/2-1/2', '1/2-1/2'))
+    self.assertFalse(play(live, 'e2e4')['move_valid'])
+
+  def test_repetition_count(self):
+    live = LiveMatch(1, Board.from_fen('k7/8/8/8/8/8/8/K6R w - - 0 1'))
+    play(live, 'h1h2', 'a8b8', 'h2h1', 'b8a8', 'h1h2', 'a8b8', 'h2h1')
+    self.assertEqual((live.board.repetition_count(), live.status), (2, ChessMatch.ACTIVE))
+    play(live, 'b8a8')
+    self.assertEqual(live.status, ChessMatch.THREEFOLD_REPETITION)
+
+  def test_capture_resets_repetition(self):
+    live = LiveMatch(1, Board.from_fen('k7/7p/8/8/8/8/8/K6R w - - 0 1'))
+    play(live, 'h1h2', 'a8b8', 'h2h1', 'b8a8', 'h1h7', 'a8b8', 'h7h1', 'b8a8', 'h1h2', 'a8b8', 'h2h1')
+    # the same squares before the capture on h7 were a different position, only the one after it repeats
+    self.assertEqual((live.board.halfmove_clock, live.board.repetition_count()), (6, 2))
+    self.assertEqual(live.status, ChessMatch.ACTIVE)
+
+  def test_fifty_move_rule(self):
+    live = LiveMatch(1, Board.from_fen('k7/8/8/8/8/8/8/KR6 w - - 98 80'))
+    play(live, 'b1b2')
+    self.assertEqual(live.status, ChessMatch.ACTIVE)
+    play(live, 'a8a7')
+    self.assertEqual((live.status, live.result), (ChessMatch.FIFTY_MOVES, '1/2-1/2'))
+
+  def test_position_cache(self):
+    cache = PositionCache(max_entries=2)
+    first, second = Board.from_fen(STARTING_FEN), Board.from_fen(STARTING_FEN)
+    for move in ('g1f3', 'g8f6', 'b1c3'):
+      first.push(encode_move(parse_square(move[:2]), parse_square(move[2:])))
+    # the same position by another move order
+    for move in ('b1c3', 'g8f6', 'g1f3'):
+      second.push(encode_move(parse_square(move[:2]), parse_square(move[2:])))
+    moves = cache.legal_moves(first)
+    self.assertIs(cache.legal_moves(second), moves)
+    self.assertEqual(moves, frozenset(second.legal_moves()))
+    self.assertEqual((cache.hits, cache.misses), (1, 1))
+    cache.legal_moves(Board.from_fen(STARTING_FEN))
+    cache.legal_moves(Board.from_fen('k7/8/8/8/8/8/8/KR6 w - - 0 1'))
+    self.assertEqual(len(cache.entries), 2)
+    cache.legal_moves(first)
+    self.assertEqual(cache.misses, 4)
+
+
+class OffBoardTargetTests(SimpleTestCase):
+  """
+  Targets off the board are turned down instead of aliasing onto the square row * 8 + column names.
+  """
+  def assert_rejected(self, fen, from_square, row, column):
+    live = LiveMatch(1, Board.from_fen(fen))
+    result = ChessMatchConsumer.apply_move(live, None, row, column, None, square_row(from_square), square_column(from_square))
+    self.assertFalse(result['move_valid'])
+    self.assertEqual((live.board.fen(), live.version), (fen, 0))
+
+  def test_column_past_the_edge(self):
+    # (1, 10) would be c3 for the b1 knight
+    self.assert_rejected(STARTING_FEN, parse_square('b1'), 1, 10)
+
+  def test_row_past_the_edge(self):
+    # (8, 0) would encode as b2xa1=N
+    self.assert_rejected('4k3/8/8/8/8/8/1p6/R3K3 b - - 0 1', parse_square('b2'), 8, 0)
+
+  def test_negative(self):
+    self.assert_rejected(STARTING_FEN, parse_square('e2'), 3, -4)
+
+
+class ProtocolTests(SimpleTestCase):
+  """
+  Binary frames decode to the requests the JSON protocol sends, and anything else is a ProtocolError.
+  """
+  def test_move_word_round_trip(self):
+    for from_row, from_column, row, column, promotion in ((1, 4, 3, 4, None), (6, 0, 7, 0, KNIGHT), (6, 7, 7, 6, QUEEN)):
+      with self.subTest(row=row, column=column, promotion=promotion):
+        word = protocol.move_word(from_row, from_column, row, column, promotion)
+        self.assertEqual(protocol.decode_request(protocol.MOVE_WORD.pack(word)), ('move', {
+          'from_row': from_row, 'from_column': from_column, 'row': row, 'column': column, 'promotion': promotion,
+        }))
+
+  def test_results(self):
+    live = LiveMatch(1, Board.from_fen(STARTING_FEN))
+    kind, seq, word, captured, check, status, result, version = msgpack.unpackb(protocol.encode_result(play(live, 'e2e4')), raw=False)
+    self.assertEqual((kind, seq, captured, check, status, result, version), (protocol.MOVE, 1, None, False, 'A', '*', 1))
+    self.assertEqual(protocol.decode_request(protocol.MOVE_WORD.pack(word))[1]['row'], 3)
+    self.assertEqual(
+      msgpack.unpackb(protocol.encode_result(play(live, 'd2d4')), raw=False), [protocol.REJECTED, parse_square('d2'), 'A'],
+    )
+    self.assertEqual(
+      msgpack.unpackb(protocol.encode_result(play(live, 'd5d4')), raw=False), [protocol.REJECTED, None, 'A'],
+    )
+
+  def test_requests(self):
+    self.assertEqual(protocol.decode_request(protocol.pack([protocol.SYNC, 4])), ('sync', 4))
+    self.assertEqual(protocol.decode_request(protocol.pack([protocol.ACK, 7])), ('ack', 7))
+
+  def test_bad_frames(self):
+    for frame in (
+      protocol.MOVE_WORD.pack(7 << 12 | 12 | 28 << 6),
+      b'\xc1',
+      b'',
+      protocol.pack([protocol.SYNC, 'x']),
+      protocol.pack([protocol.SYNC]),
+      protocol.pack([protocol.MOVE, 1]),
+      protocol.pack({'type': 'sync'}),
+    ):
+      with self.subTest(frame=frame):
+        with self.assertRaises(protocol.ProtocolError):
+          protocol.decode_request(frame)
+
+
+class WriteBehindCache(BoardCache):
+  # the background flusher would write from another connection, outside the test's transaction
+  def _start_flusher(self):
+    pass
+
+
+class BoardCacheTests(TestCase):
+  """
+  Write-behind flushes and eviction, including flushes that fail.
+  """
+  def setUp(self):
+    self.first, self.second = (match.id for match in CreateNewChessMatch.create_matches([[], []]))
+
+  def stored(self, match_id):
+    return (
+      ChessMatch.objects.values_list('fen', 'version').get(pk=match_id),
+      ChessMove.objects.filter(chess_match_id=match_id).count(),
+    )
+
+  def test_flush_every_moves(self):
+    cache = WriteBehindCache(flush_every_moves=3, flush_interval_ms=3600 * 1000)
+    live = cache.get(self.first)
+    play(live, 'e2e4', 'e7e5')
+    self.assertFalse(cache.flush_due(live))
+    self.assertEqual(self.stored(self.first)[1], 0)
+    play(live, 'g1f3')
+    self.assertTrue(cache.flush_due(live))
+    cache.flush(live)
+    self.assertEqual(self.stored(self.first), ((live.board.fen(), 3), 3))
+    self.assertEqual(live.pending_moves, 0)
+
+  def test_eviction_flushes_first(self):
+    cache = WriteBehindCache(max_matches=1, flush_interval_ms=3600 * 1000)
+    play(cache.get(self.first), 'e2e4')
+    cache.get(self.second)
+    self.assertIsNone(cache.peek(self.first))
+    self.assertEqual(self.stored(self.first)[1], 1)
+    self.assertEqual(cache.evictions, 1)
+
+  def test_failed_eviction_keeps_the_match(self):
+    cache = WriteBehindCache(max_matches=1, flush_interval_ms=3600 * 1000)
+    live = cache.get(self.first)
+    play(live, 'e2e4')
+    with mock.patch.object(ChessMove.objects, 'bulk_create', side_effect=DatabaseError('down')), self.assertLogs('chess.board_cache'):
+      # the failure stays with the cache, the caller still gets its match
+      self.assertEqual(cache.get(self.second).match_id, self.second)
+    self.assertIs(cache.peek(self.first), live)
+    self.assertEqual(live.pending_moves, 1)
+    self.assertEqual(self.stored(self.first)[1], 0)
+    # the next miss retries the eviction
+    cache.get(CreateNewChessMatch.create_matches([[]])[0].id)
+    self.assertIsNone(cache.peek(self.first))
+    self.assertEqual(self.stored(self.first)[1], 1)
+
+  def test_flush_overdue_goes_on_after_a_failure(self):
+    cache = WriteBehindCache(flush_interval_ms=0)
+    lives = [cache.get(self.first), cache.get(self.second)]
+    for live in lives:
+      play(live, 'd2d4')
+    with mock.patch.object(lives[0], 'flush', side_effect=DatabaseError('down')), self.assertLogs('chess.board_cache'):
+      cache.flush_overdue()
+    self.assertEqual(self.stored(self.second)[1], 1)
+    self.assertEqual(lives[0].pending_moves, 1)
+    cache.flush_overdue()
+    self.assertEqual(self.stored(self.first)[1], 1)
+
+  def test_expired_matches_are_flushed_and_dropped(self):
+    cache = WriteBehindCache(ttl_seconds=0, flush_interval_ms=3600 * 1000)
+    live = cache.get(self.first)
+    play(live, 'e2e4', 'c7c5')
+    live.last_access -= 1
+    cache.flush_overdue()
+    self.assertIsNone(cache.peek(self.first))
+    self.assertEqual(self.stored(self.first), ((live.board.fen(), 2), 2))
+
+  def test_reset_discards_unflushed_moves(self):
+    cache = WriteBehindCache(flush_interval_ms=0)
+    live = cache.get(self.first)
+    play(live, 'e2e4', 'e7e5')
+    client = APIClient()
+    client.force_authenticate(User.objects.create(username='player'))
+    with mock.patch('chess.views.board_cache', cache):
+      self.assertEqual(client.post(f'/chess/matches/{self.first}/reset_pieces/').status_code, 205)
+    cache.flush_overdue()
+    self.assertEqual(self.stored(self.first), ((STARTING_FEN, 1), 0))
+    # a consumer still holding the old board can't move on it either
+    self.assertFalse(play(live, 'g1f3')['move_valid'])
+    cache.flush(live)
+    self.assertEqual(self.stored(self.first)[1], 0)
+    self.assertEqual(cache.get(self.first).board.fen(), STARTING_FEN)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class MatchAccessTests(TransactionTestCase):
+  """
+  Seats, turn order and side ownership, on the cached board and over the match's websocket.
+  The consumers query from their own threads, so the rows have to be committed.
+  """
+  def setUp(self):
+    self.white, self.black, self.watcher = (User.objects.create(username=name) for name in ('white', 'black', 'watcher'))
+    self.match = CreateNewChessMatch.create_matches([[self.white.id, self.black.id]])[0]
+    membership_cache.invalidate(self.match.id)
+
+  def tearDown(self):
+    board_cache.invalidate(self.match.id)
+    membership_cache.invalidate(self.match.id)
+
+  def test_roles(self):
+    self.assertEqual(
+      [membership_cache.role(self.match.id, user.id) for user in (self.white, self.black, self.watcher)],
+      [WHITE, BLACK, SPECTATOR],
+    )
+
+  def test_matches_without_players_are_cached(self):
+    empty = CreateNewChessMatch.create_matches([[]])[0]
+    membership = MembershipCache(miss_seconds=60)
+    self.assertEqual(membership.role(empty.id, self.watcher.id), SPECTATOR)
+    with self.assertNumQueries(0):
+      self.assertEqual(membership.role(empty.id, self.white.id), SPECTATOR)
+
+    # joined through another worker, seen once the miss expires
+    empty.users.add(self.white)
+    membership.miss_seconds = 0
+    self.assertIsNone(membership.cached_role(empty.id, self.white.id))
+    self.assertEqual(membership.role(empty.id, self.white.id), WHITE)
+
+  def test_turn_order_and_sides(self):
+    live = board_cache.get(self.match.id)
+    self.assertFalse(play(live, 'e7e5', team=BLACK)['move_valid'])
+    self.assertFalse(play(live, 'e2e4', team=BLACK)['move_valid'])
+    self.assertFalse(play(live, 'e2e4', team=SPECTATOR)['move_valid'])
+    self.assertTrue(play(live, 'e2e4', team=WHITE)['move_valid'])
+    self.assertFalse(play(live, 'd2d4', team=WHITE)['move_valid'])
+    self.assertEqual(live.version, 1)
+
+  def connect(self, user):
+    from chess_backend.routing import application
+    return WebsocketCommunicator(application, f'/ws/chess/matches/lobby/{self.match.id}/?{make_token(user)}')
+
+  @async_to_sync
+  async def test_players_move_in_turn(self):
+    white, black = self.connect(self.white), self.connect(self.black)
+    for communicator in (white, black):
+      self.assertTrue((await communicator.connect())[0])
+      await communicator.receive_json_from()
+    try:
+      # every result goes to both players
+      await black.send_json_to({'message': {'from_row': 6, 'from_column': 4, 'row': 4, 'column': 4}})
+      for communicator in (white, black):
+        self.assertFalse((await communicator.receive_json_from())['message']['move_valid'])
+      await white.send_json_to({'message': {'from_row': 1, 'from_column': 4, 'row': 3, 'column': 4}})
+      for communicator in (white, black):
+        self.assertTrue((await communicator.receive_json_from())['message']['move_valid'])
+    finally:
+      await white.disconnect()
+      await black.disconnect()
+
+  @async_to_sync
+  async def test_spectators_see_moves(self):
+    white, watcher = self.connect(self.white), self.connect(self.watcher)
+    self.assertTrue((await watcher.connect())[0])
+    self.assertEqual((await watcher.receive_json_from())['seq'], 0)
+    self.assertTrue((await white.connect())[0])
+    await white.receive_json_from()
+    try:
+      await white.send_json_to({'message': {'from_row': 1, 'from_column': 4, 'row': 3, 'column': 4}})
+      frame = await watcher.receive_json_from()
+      self.assertEqual((frame['type'], frame['seq'], frame['last_move']['row']), ('position', 1, 3))
+    finally:
+      await white.disconnect()
+      await watcher.disconnect()
+
+  @async_to_sync
+  async def test_spectators_cannot_move(self):
+    white, watcher = self.connect(self.white), self.connect(self.watcher)
+    self.assertTrue((await white.connect())[0])
+    await white.receive_json_from()
+    self.assertTrue((await watcher.connect())[0])
+    self.assertEqual((await watcher.receive_json_from())['type'], 'position')
+    try:
+      await watcher.send_json_to({'message': {'from_row': 1, 'from_column': 4, 'row': 3, 'column': 4}})
+      self.assertTrue(await white.receive_nothing(0.2))
+      self.assertEqual(board_cache.peek(self.match.id).version, 0)
+    finally:
+      await white.disconnect()
+      await watcher.disconnect()
+
+  @async_to_sync
+  async def test_binary_move_from_an_empty_square(self):
+    from chess_backend.routing import application
+    white = WebsocketCommunicator(
+      application, f'/ws/chess/matches/lobby/{self.match.id}/?{make_token(self.white)}', subprotocols=[protocol.BINARY_SUBPROTOCOL],
+    )
+    self.assertEqual(await white.connect(), (True, protocol.BINARY_SUBPROTOCOL))
+    self.assertEqual(msgpack.unpackb(await white.receive_from(), raw=False), [protocol.HELLO, 0])
+    try:
+      await white.send_to(bytes_data=protocol.MOVE_WORD.pack(protocol.move_word(3, 3, 4, 3)))
+      self.assertEqual(msgpack.unpackb(await white.receive_from(), raw=False), [protocol.REJECTED, None, 'A'])
+      await white.send_to(bytes_data=protocol.MOVE_WORD.pack(protocol.move_word(1, 4, 3, 4)))
+      self.assertEqual(msgpack.unpackb(await white.receive_from(), raw=False)[0], protocol.MOVE)
+    finally:
+      await white.disconnect()
+
+  @async_to_sync
+  async def test_bad_requests_keep_the_socket(self):
+    white = self.connect(self.white)
+    self.assertTrue((await white.connect())[0])
+    await white.receive_json_from()
+    try:
+      # an empty from-square, a piece id nobody has and coordinates that aren't numbers are turned down
+      for message in (
+        {'from_row': 3, 'from_column': 3, 'row': 4, 'column': 3},
+        {'id': 999999, 'row': 2, 'column': 0},
+        {'from_row': 'e', 'from_column': 2, 'row': 3, 'column': 4},
+      ):
+        await white.send_json_to({'message': message})
+        result = (await white.receive_json_from())['message']
+        self.assertEqual((result['move_valid'], result['id']), (False, None))
+      # frames that aren't requests at all get an error frame
+      for text in ('not json', '{"nope": 1}', '{"message": 5}', '[]'):
+        await white.send_to(text_data=text)
+        self.assertEqual((await white.receive_json_from())['type'], 'error')
+      await white.send_json_to({'message': {'from_row': 1, 'from_column': 4, 'row': 3, 'column': 4}})
+      self.assertTrue((await white.receive_json_from())['message']['move_valid'])
+    finally:
+      await white.disconnect()
+
+
+class ChessMatchDetailTests(TestCase):
+  """
+  ETags carry the match version, an unchanged match answers If-None-Match with 304.
+  """
+  def setUp(self):
+    self.match = CreateNewChessMatch.create_matches([[]])[0]
+    self.url = f'/chess/matches/{self.match.id}/'
+
+  def tearDown(self):
+    board_cache.invalidate(self.match.id)
+
+  def test_not_modified_until_a_move(self):
+    response = self.client.get(self.url)
+    self.assertEqual(response.status_code, 200)
+    etag = response['ETag']
+    self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    # a move still waiting in the board cache changes the version all the same
+    play(board_cache.get(self.match.id), 'e2e4')
+    response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 200)
+    self.assertNotEqual(response['ETag'], etag)
+    self.assertEqual(response.data['version'], 1)
+    self.assertIn('4P3', response.data['fen'])
+    self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+  def test_unknown_match(self):
+    self.assertEqual(self.client.get('/chess/matches/0/').status_code, 404)
+
+
+class VerifiedTokenCacheTests(SimpleTestCase):
+  """
+  Verified and rejected JWTs are both remembered, so a repeated token is never decoded twice.
+  """
+  def setUp(self):
+    patcher = mock.patch.object(middleware, 'token_cache', middleware.VerifiedTokenCache(reject_ttl_seconds=30))
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def decodes(self, token, times=2):
+    with mock.patch.object(middleware.jwt, 'decode', wraps=middleware.jwt.decode) as decode:
+      payloads = [middleware.verify_jwt(token) for _ in range(times)]
+    return payloads, decode.call_count
+
+  def test_rejections_are_cached(self):
+    self.assertEqual(self.decodes('not-a-token'), ([None, None], 1))
+    forged = jwt.encode({'user_id': 1}, 'another key', algorithm='HS256').decode('utf-8')
+    self.assertEqual(self.decodes(forged), ([None, None], 1))
+
+  def test_rejections_expire(self):
+    middleware.token_cache.reject_ttl_seconds = 0
+    self.assertEqual(self.decodes('not-a-token'), ([None, None], 2))
+
+  def test_expired_tokens(self):
+    expired = jwt.encode({'user_id': 1, 'exp': int(time.time()) - 10}, settings.SECRET_KEY, algorithm='HS256').decode('utf-8')
+    self.assertEqual(self.decodes(expired), ([None, None], 1))
+
+  def test_verified_tokens_are_cached(self):
+    token = jwt.encode({'user_id': 1}, settings.SECRET_KEY, algorithm='HS256').decode('utf-8')
+    self.assertEqual(self.decodes(token), ([{'user_id': 1}, {'user_id': 1}], 1))
+
+  def test_oversized_tokens_are_not_decoded(self):
+    self.assertEqual(self.decodes('x' * (settings.CHESS_JWT_MAX_LENGTH + 1)), ([None, None], 0))
+
+
+class CompareAndSetTests(TestCase):
+  """
+  Several workers share matches: what one worker cached may be behind what another one wrote.
+  """
+  def setUp(self):
+    self.match = CreateNewChessMatch.create_matches([[]])[0]
+
+  def tearDown(self):
+    board_cache.invalidate(self.match.id)
+
+  def written_elsewhere(self):
+    ChessMatch.objects.filter(pk=self.match.id).update(version=F('version') + 5)
+
+  def test_version_comes_from_the_database(self):
+    board_cache.get(self.match.id)
+    self.written_elsewhere()
+    with mock.patch.object(board_cache, 'compare_and_set', True):
+      self.assertEqual(match_version(self.match.id), 5)
+
+  def test_reads_drop_stale_boards(self):
+    cache = WriteBehindCache(compare_and_set=True)
+    live = cache.get(self.match.id)
+    play(live, 'e2e4')
+    self.written_elsewhere()
+    with self.assertLogs('chess.board_cache', 'WARNING'):
+      cache.flush_match(self.match.id)
+    self.assertIsNone(cache.peek(self.match.id))
+    self.assertEqual(cache.stale_writes, 1)
+    self.assertEqual(ChessMove.objects.filter(chess_match=self.match).count(), 0)
+
+  def test_moves_after_a_stale_board(self):
+    live = board_cache.get(self.match.id)
+    play(live, 'e2e4')
+    # older than the deltas kept in memory, so the log has to be read from the database
+    live.recent_moves.clear()
+    self.written_elsewhere()
+    with mock.patch.object(board_cache, 'compare_and_set', True), self.assertLogs('chess.board_cache', 'WARNING'):
+      self.assertEqual(moves_after(self.match.id, 0, live), [])
+    self.assertEqual(ChessMatch.objects.get(pk=self.match.id).version, 5)
+
+
+class JoinChessMatchTests(TestCase):
+  """
+  Two players going for the last seat at once: exactly one gets it.
+  """
+  def setUp(self):
+    self.owner, self.first, self.second = (User.objects.create(username=name) for name in ('owner', 'first', 'second'))
+    self.match = CreateNewChessMatch.create_matches([[self.owner.id]])[0]
+
+  def join(self, user):
+    client = APIClient()
+    client.force_authenticate(user)
+    return client.post(f'/chess/matches/{self.match.id}/join/')
+
+  def test_join(self):
+    self.assertTrue(self.join(self.first).data['joined_match'])
+    self.assertTrue(self.join(self.first).data['joined_match'])
+    self.assertEqual(self.join(self.second).status_code, 400)
+
+  def test_last_seat_goes_to_one_player(self):
+    bump_version = board_cache.bump_version
+    raced = {}
+
+    def join_second_first(match_id, expected=None):
+      # the second player takes the seat after the first one read the seats and before it claims one
+      if 'second' not in raced:
+        raced['second'] = None
+        raced['second'] = self.join(self.second)
+      return bump_version(match_id, expected)
+
+    with mock.patch.object(board_cache, 'bump_version', side_effect=join_second_first):
+      response = self.join(self.first)
+    self.assertTrue(raced['second'].data['joined_match'])
+    self.assertEqual(response.status_code, 400)
+    self.assertFalse(response.data['joined_match'])
+    self.assertEqual(sorted(self.match.users.values_list('id', flat=True)), [self.owner.id, self.second.id])
+
+
+class CreateChessMatchBatchTests(TestCase):
+  """
+  Pairings are validated before anything is written, and a round costs the same queries however many matches it has.
+  """
+  def setUp(self):
+    self.users = [User.objects.create(username=f'player{index}') for index in range(40)]
+    self.client = APIClient()
+    self.client.force_authenticate(User.objects.create(username='admin', is_staff=True))
+
+  def create(self, data):
+    return self.client.post('/chess/matches/new/batch/', data, format='json')
+
+  def test_pairings(self):
+    pairings = [[self.users[0].id, self.users[1].id], [self.users[2].id], []]
+    response = self.create({'pairings': pairings})
+    self.assertEqual(response.status_code, 201)
+    self.assertEqual([match['users'] for match in response.data], pairings)
+    for match, user_ids in zip(response.data, pairings):
+      self.assertEqual(sorted(ChessMatch.objects.get(pk=match['id']).users.values_list('id', flat=True)), user_ids)
+
+  def test_count(self):
+    response = self.create({'count': 3})
+    self.assertEqual(response.status_code, 201)
+    self.assertEqual(ChessMatch.objects.filter(pk__in=[match['id'] for match in response.data]).count(), 3)
+
+  def test_bad_requests(self):
+    user_id = self.users[0].id
+    for data in (
+      {},
+      [],
+      {'count': 'many'},
+      {'count': 0},
+      {'count': 501},
+      {'pairings': []},
+      {'pairings': 'x'},
+      {'pairings': [user_id]},
+      {'pairings': [['x']]},
+      {'pairings': [[[user_id]]]},
+      {'pairings': [[{'id': user_id}]]},
+      {'pairings': [[user_id, user_id]]},
+      {'pairings': [[user_id, user_id + 1, user_id + 2]]},
+      {'pairings': [[10 ** 6]]},
+    ):
+      with self.subTest(data=data):
+        self.assertEqual(self.create(data).status_code, 400)
+    self.assertFalse(ChessMatch.objects.exists())
+
+  # piece rows go in as many INSERTs as the backend's parameter limit needs, so they are left out here
+  @override_settings(CHESS_MATERIALIZE_PIECES=False)
+  def test_query_count(self):
+    def queries(pairings):
+      with CaptureQueriesContext(connection) as context:
+        self.assertEqual(self.create({'pairings': pairings}).status_code, 201)
+      return len(context)
+
+    few = queries([[self.users[0].id, self.users[1].id]] * 2)
+    many = queries([[user.id, other.id] for user, other in zip(self.users[::2], self.users[1::2])])
+    # backends that can't return ids from a bulk insert create the matches one by one, everything else is bulk
+    self.assertEqual(many - few, 0 if connection.features.can_return_ids_from_bulk_insert else 20 - 2)
+
+
+class BatchValidationTests(TestCase):
+  """
+  Every item gets its own result in order, a malformed one included, and big batches are spread over the pool.
+  """
+  AFTER_E4 = 'rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1'
+  EN_PASSANT = 'k7/8/8/3Pp3/8/8/8/K7 w - e6 0 1'
+
+  def test_results(self):
+    results = validate_chunk([
+      {'fen': STARTING_FEN, 'move': 'e2e4'},
+      {'fen': STARTING_FEN, 'move': 'e2e5'},
+      {'fen': self.EN_PASSANT, 'move': 'd5e6'},
+      {'fen': '7k/P7/8/8/8/8/8/K7 w - - 0 1', 'from_row': 6, 'from_column': 0, 'row': 7, 'column': 0},
+      {'fen': '7k/P7/8/8/8/8/8/K7 w - - 0 1', 'move': 'a7a8n'},
+      {'fen': 'rnbqkbnr/pppp1ppp/8/4p3/6P1/5P2/PPPPP2P/RNBQKBNR b KQkq - 0 2', 'move': 'd8h4'},
+    ])
+    self.assertEqual(results[0]['fen'], self.AFTER_E4)
+    self.assertEqual(results[1], {'valid': False})
+    self.assertEqual(results[2]['captured'], {'piece_type': 'P', 'row': 4, 'column': 4})
+    self.assertEqual((results[3]['promotion'], results[4]['promotion']), (QUEEN, KNIGHT))
+    self.assertEqual((results[5]['status'], results[5]['result'], results[5]['check']), ('CM', '0-1', True))
+
+  def test_malformed_items(self):
+    results = validate_chunk([
+      {'move': 'e2e4'},
+      {'fen': STARTING_FEN, 'move': 'e2'},
+      {'fen': STARTING_FEN, 'from_row': 'x', 'from_column': 4, 'row': 3, 'column': 4},
+      {'fen': STARTING_FEN, 'from_row': 1, 'from_column': 4, 'row': 9, 'column': 4},
+      {'fen': STARTING_FEN, 'from_row': 1, 'from_column': 0, 'row': 3, 'column': 0, 'promotion': 'Dragon'},
+      {'fen': 'not a fen', 'move': 'e2e4'},
+      {'fen': None, 'move': 'e2e4'},
+      {'fen': ['list'], 'move': 'e2e4'},
+      {'fen': STARTING_FEN, 'move': 'e2e4'},
+    ])
+    for result in results[:-1]:
+      self.assertFalse(result['valid'])
+    self.assertEqual([result['error'].split(':')[0] for result in results if 'error' in result], [
+      'KeyError', 'ValueError', 'ValueError', 'ValueError', 'ValueError', 'ValueError', 'TypeError', 'TypeError',
+    ])
+    # the good item after the bad ones is still validated, and the shared board was put back each time
+    self.assertEqual(results[-1]['fen'], self.AFTER_E4)
+
+  @override_settings(CHESS_BATCH_VALIDATION={'MAX_ITEMS': 100, 'POOL_THRESHOLD': 5, 'CHUNK_SIZE': 4, 'PROCESSES': 2})
+  def test_pool(self):
+    items = [{'fen': STARTING_FEN, 'move': move} for move in ('e2e4', 'e2e5', 'g1f3', 'b1a3', 'h2h4', 'a1a2', 'd2d4', 'x')]
+    pool = mock.Mock()
+    pool.map.side_effect = map
+    with mock.patch('chess.batch_validation._get_pool', return_value=pool):
+      self.assertEqual(validate_moves(items), validate_chunk(items))
+      self.assertEqual([len(chunk) for chunk in pool.map.call_args[0][1]], [4, 4])
+      validate_moves(items[:4])
+      # below POOL_THRESHOLD everything is validated in the request's own process
+      self.assertEqual(pool.map.call_count, 1)
+    # and through real worker processes
+    with mock.patch('chess.batch_validation._pool', None):
+      try:
+        self.assertEqual(validate_moves(items), validate_chunk(items))
+      finally:
+        batch_validation._pool.shutdown()
+
+  @override_settings(CHESS_BATCH_VALIDATION={'MAX_ITEMS': 3, 'POOL_THRESHOLD': 100, 'CHUNK_SIZE': 4, 'PROCESSES': 1})
+  def test_view(self):
+    client = APIClient()
+    client.force_authenticate(User.objects.create(username='player'))
+    response = client.post('/chess/moves/validate/', {'moves': [
+      {'fen': STARTING_FEN, 'move': 'e2e4'}, {'fen': STARTING_FEN, 'move': 'e7e5'},
+    ]}, format='json')
+    self.assertEqual([result['valid'] for result in response.data['results']], [True, False])
+    for moves in (None, 'e2e4', [1], [{'fen': STARTING_FEN, 'move': 'e2e4'}] * 4):
+      with self.subTest(moves=moves):
+        self.assertEqual(client.post('/chess/moves/validate/', {'moves': moves}, format='json').status_code, 400)
+
+
+class GraphQLTests(TestCase):
+  """
+  Nested lists are batched by the request's DataLoaders, and queries over the depth or cost limits never run.
+  """
+  NESTED = '''{
+    allChessMatches(first: 10) { edges { node {
+      id users { username } chesspieceSet { pieceType chessMatch { id } }
+    } } }
+  }'''
+
+  def query(self, query):
+    return self.client.post('/chess/graphql/', json.dumps({'query': query}), content_type='application/json')
+
+  def create_matches(self, count):
+    users = [User.objects.create(username=f'player{User.objects.count()}') for _ in range(count * 2)]
+    CreateNewChessMatch.create_matches([[users[index * 2].id, users[index * 2 + 1].id] for index in range(count)])
+
+  def test_nested_lists_are_batched(self):
+    def queries():
+      with CaptureQueriesContext(connection) as context:
+        response = self.query(self.NESTED)
+      self.assertNotIn('errors', response.json())
+      return len(context), response.json()['data']['allChessMatches']['edges']
+
+    self.create_matches(1)
+    few, edges = queries()
+    self.assertEqual([len(edge['node']['users']) for edge in edges], [2])
+    self.create_matches(4)
+    many, edges = queries()
+    self.assertEqual(len(edges), 5)
+    self.assertEqual({edge['node']['chesspieceSet'][0]['chessMatch']['id'] for edge in edges}, {edge['node']['id'] for edge in edges})
+    # the page, the players, the pieces and the pieces' matches, one query each
+    self.assertEqual((few, many), (4, 4))
+
+  @override_settings(CHESS_GRAPHQL={'DEFAULT_PAGE_SIZE': 20, 'MAX_PAGE_SIZE': 100, 'MAX_DEPTH': 8, 'MAX_COST': 200})
+  def test_over_budget(self):
+    self.create_matches(1)
+    with self.assertNumQueries(0):
+      response = self.query('''{ allChessMatches(first: 100) { edges { node { chesspieceSet { pieceType } } } } }''')
+    self.assertEqual(response.status_code, 400)
+    self.assertIn('Query cost', response.json()['errors'][0]['message'])
+    # a smaller page of the same shape fits
+    response = self.query('''{ allChessMatches(first: 5) { edges { node { chesspieceSet { pieceType } } } } }''')
+    self.assertEqual(response.status_code, 200)
+
+  @override_settings(CHESS_GRAPHQL={'DEFAULT_PAGE_SIZE': 20, 'MAX_PAGE_SIZE': 100, 'MAX_DEPTH': 4, 'MAX_COST': 10000})
+  def test_too_deep(self):
+    with self.assertNumQueries(0):
+      response = self.query('''{ allChessPieces(first: 1) { edges { node { chessMatch { users { username } } } } } }''')
+    self.assertEqual(response.status_code, 400)
+    self.assertIn('Query depth', response.json()['errors'][0]['message'])
+
+
+class PaginationTests(TestCase):
+  """
+  Cursor pages stay stable while rows are added, keep their filters, and exports stream every row exactly once.
+  """
+  def setUp(self):
+    self.client = APIClient()
+    self.client.force_authenticate(User.objects.create(username='admin', is_staff=True))
+
+  def walk(self, url):
+    ids = []
+    while url:
+      page = self.client.get(url).data
+      ids += [row['id'] for row in page['results']]
+      url = page['next']
+    return ids
+
+  def test_cursor_is_stable(self):
+    matches = CreateNewChessMatch.create_matches([[]] * 7)
+    first = self.client.get('/chess/matches/?page_size=3').data
+    # newer matches sort first and must not push rows already seen onto the next page
+    CreateNewChessMatch.create_matches([[]] * 2)
+    ids = [row['id'] for row in first['results']] + self.walk(first['next'])
+    self.assertEqual(ids, sorted((match.id for match in matches), reverse=True))
+
+  def test_filters_stay_with_the_cursor(self):
+    matches = CreateNewChessMatch.create_matches([[]] * 9)
+    checkmates = [match.id for match in matches[::2]]
+    ChessMatch.objects.filter(pk__in=checkmates).update(status=ChessMatch.CHECKMATE)
+    self.assertEqual(self.walk('/chess/matches/?status=CM&page_size=2'), sorted(checkmates, reverse=True))
+    match = matches[0]
+    white = list(ChessPiece.objects.filter(chess_match=match, team=WHITE).order_by('id').values_list('id', flat=True))
+    self.assertEqual(self.walk(f'/chess/pieces/?match={match.id}&team=W&page_size=5'), white)
+
+  def test_keyset_chunks(self):
+    ids = [match.id for match in CreateNewChessMatch.create_matches([[]] * 5)]
+    chunks = keyset_chunks(ChessMatch.objects.all(), 2)
+    self.assertEqual([match.id for match in next(chunks)], ids[:2])
+    # rows deleted or added behind the last id seen don't shift the rest
+    ChessMatch.objects.filter(pk=ids[0]).delete()
+    self.assertEqual([[match.id for match in chunk] for chunk in chunks], [ids[2:4], ids[4:]])
+
+  def test_stream_json_array(self):
+    self.assertEqual(''.join(stream_json_array(ChessMatch.objects.all(), lambda match: match.id)), '[]')
+    ids = [match.id for match in CreateNewChessMatch.create_matches([[]] * 5)]
+    self.assertEqual(json.loads(''.join(stream_json_array(ChessMatch.objects.all(), lambda match: {'id': match.id}, 2))), [
+      {'id': match_id} for match_id in ids
+    ])
+    ChessMatch.objects.filter(pk=ids[1]).update(status=ChessMatch.STALEMATE)
+    response = self.client.get('/chess/matches/export/?status=SM')
+    self.assertEqual([match['id'] for match in json.loads(b''.join(response.streaming_content))], [ids[1]])
+
+
+class RecordingChannelLayer:
+  def __init__(self):
+    self.groups = []
+
+  async def group_send(self, group, event):
+    self.groups.append(group)
+
+
+class SpectatorBroadcasterTests(TransactionTestCase):
+  """
+  Positions only go to the shards somebody watches.
+  """
+  def setUp(self):
+    self.match = CreateNewChessMatch.create_matches([[]])[0]
+    self.broadcaster = SpectatorBroadcaster(interval_ms=0, shards=4)
+    self.layer = RecordingChannelLayer()
+
+  def tearDown(self):
+    board_cache.invalidate(self.match.id)
+    caches['default'].clear()
+
+  def test_watched_shards_only(self):
+    send = async_to_sync(self.broadcaster.send)
+    send(self.layer, self.match.id)
+    self.assertEqual((self.layer.groups, self.broadcaster.unwatched), ([], 1))
+
+    self.broadcaster.watch(self.match.id, 2)
+    self.broadcaster.watch(self.match.id, 2)
+    self.broadcaster.unwatch(self.match.id, 2)
+    send(self.layer, self.match.id)
+    self.assertEqual(self.layer.groups, [spectator_group(self.match.id, 2)])
+
+    self.broadcaster.unwatch(self.match.id, 2)
+    send(self.layer, self.match.id)
+    self.assertEqual((len(self.layer.groups), self.broadcaster.frames), (1, 1))
+
+  def test_fan_out_over_several_shards(self):
+    for shard in (3, 0, 1, 3):
+      self.broadcaster.watch(self.match.id, shard)
+    async_to_sync(self.broadcaster.send)(self.layer, self.match.id)
+    self.assertEqual(self.layer.groups, [spectator_group(self.match.id, shard) for shard in (0, 1, 3)])
+    self.assertEqual(self.broadcaster.frames, 1)
+
+  def test_several_workers_need_a_shared_cache(self):
+    with self.assertRaises(ImproperlyConfigured):
+      SpectatorBroadcaster(interval_ms=0, shards=4, several_workers=True)
+    with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'chess_cache'}}):
+      SpectatorBroadcaster(interval_ms=0, shards=4, several_workers=True)
+
+
+class InstantSocket:
+  """
+  Stands in for a consumer under daphne, whose send hands the frame to the transport without ever waiting.
+  """
+  def __init__(self):
+    self.sent = []
+    self.close_code = None
+
+  async def send(self, text_data=None, bytes_data=None):
+    self.sent.append(json.loads(text_data)['seq'])
+
+  async def close(self, code=None):
+    self.close_code = code
+
+
+class OutboxTests(SimpleTestCase):
+  """
+  Backpressure from the client's acknowledgements, the only signal there is when send never waits.
+  """
+  def setUp(self):
+    self.socket = InstantSocket()
+
+  async def put(self, outbox, *seqs):
+    for seq in seqs:
+      await outbox.put({'text': json.dumps({'seq': seq}), 'bytes': b'', 'seq': seq})
+      # let the drain task run
+      await asyncio.sleep(0)
+
+  @async_to_sync
+  async def test_without_acks_everything_goes_out(self):
+    outbox = Outbox(self.socket, 1, False, high_water=4)
+    await self.put(outbox, *range(1, 21))
+    self.assertEqual(self.socket.sent, list(range(1, 21)))
+
+  @async_to_sync
+  async def test_lagging_acks_coalesce(self):
+    outbox = Outbox(self.socket, 1, False, positions=True, high_water=4)
+    outbox.ack(0)
+    await self.put(outbox, *range(1, 11))
+    self.assertEqual(self.socket.sent, [1, 2, 3, 4])
+    self.assertEqual(outbox.depth(), 1)
+    outbox.ack(4)
+    await asyncio.sleep(0)
+    self.assertEqual(self.socket.sent, [1, 2, 3, 4, 10])
+    self.assertEqual(outbox.lag(), 6)
+    self.assertIsNone(self.socket.close_code)
+
+  @async_to_sync
+  async def test_lagging_acks_disconnect(self):
+    outbox = Outbox(self.socket, 1, False, high_water=2, policy=DISCONNECT)
+    outbox.ack(0)
+    await self.put(outbox, 1, 2)
+    outbox.ack(1)
+    await self.put(outbox, 3)
+    self.assertIsNone(self.socket.close_code)
+    await self.put(outbox, 4)
+    self.assertEqual(self.socket.close_code, RESYNC_CLOSE_CODE)
+    self.assertEqual(self.socket.sent, [1, 2, 3])
+
+
+class PGNExportTests(TestCase):
+  """
+  Games are replayed from the position their move log starts from, and one that can't be replayed doesn't end
+  the export.
+  """
+  # the layout matches were created with before the board was packed into a FEN: black's king and queen swapped
+  SWAPPED_FEN = 'rnbkqbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQ - 0 1'
+
+  def setUp(self):
+    self.match = ChessMatch.objects.create(fen=self.SWAPPED_FEN, start_fen=self.SWAPPED_FEN)
+
+  def play_and_flush(self, match, *moves):
+    cache = WriteBehindCache()
+    play(cache.get(match.id), *moves)
+    cache.flush_all()
+
+  def test_set_up_position(self):
+    self.play_and_flush(self.match, 'e2e4', 'e7e5', 'g1f3', 'd8e7')
+    pgn = ''.join(export_games(ChessMatch.objects.filter(pk=self.match.id)))
+    self.assertIn('[SetUp "1"]\n[FEN "rnbkqbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQ - 0 1"]', pgn)
+    self.assertIn('1. e4 e5 2. Nf3 Ke7 *', pgn)
+
+  def test_standard_start_has_no_fen(self):
+    match = CreateNewChessMatch.create_matches([[]])[0]
+    self.play_and_flush(match, 'e2e4')
+    pgn = ''.join(export_games(ChessMatch.objects.filter(pk=match.id)))
+    self.assertNotIn('[FEN ', pgn)
+    self.assertIn('1. e4 *', pgn)
+
+  def test_unreplayable_game_is_left_out(self):
+    broken = ChessMatch.objects.create()
+    ChessMove.objects.create(
+      chess_match=broken, seq=1, team=WHITE, piece_type='P', from_row=2, from_column=4, to_row=3, to_column=4,
+    )
+    self.play_and_flush(self.match, 'e2e4')
+    with self.assertLogs('chess.pgn', 'WARNING'):
+      pgn = ''.join(export_games(ChessMatch.objects.filter(pk__in=[broken.id, self.match.id])))
+    self.assertNotIn(f'Match {broken.id}"', pgn)
+    self.assertIn(f'Match {self.match.id}"', pgn)
+
+  def test_export_only_flushes_its_matches(self):
+    player = User.objects.create(username='player')
+    own, other = CreateNewChessMatch.create_matches([[player.id], []])
+    cache = WriteBehindCache(flush_interval_ms=3600 * 1000)
+    for match in (own, other):
+      play(cache.get(match.id), 'e2e4')
+    client = APIClient()
+    client.force_authenticate(player)
+    with mock.patch('chess.views.board_cache', cache):
+      response = client.get('/chess/matches/export/pgn/')
+    self.assertIn('1. e4 *', b''.join(response.streaming_content).decode())
+    self.assertEqual((cache.peek(own.id).pending_moves, cache.peek(other.id).pending_moves), (0, 1))
+
+
+class PGNRoundTripTests(TestCase):
+  """
+  Exported games import back to the same start, moves and final position, set-up positions included.
+  """
+  SET_UP_FEN = '7k/P7/8/8/8/8/8/K7 b - - 0 1'
+
+  def export(self, match_ids):
+    return ''.join(export_games(ChessMatch.objects.filter(pk__in=match_ids)))
+
+  def logged_moves(self, match_id):
+    return list(ChessMove.objects.filter(chess_match_id=match_id).values_list(
+      'team', 'piece_type', 'from_row', 'from_column', 'to_row', 'to_column', 'promotion', 'captured_piece_type', 'en_passant',
+    ))
+
+  def test_round_trip(self):
+    standard = CreateNewChessMatch.create_matches([[]])[0]
+    set_up = ChessMatch.objects.create(fen=self.SET_UP_FEN, start_fen=self.SET_UP_FEN)
+    cache = WriteBehindCache()
+    play(cache.get(standard.id), 'e2e4', 'd7d5', 'e4d5', 'g8f6', 'f1b5', 'c7c6', 'g1f3', 'c6b5', 'e1g1')
+    play(cache.get(set_up.id), 'h8g8', 'a7a8q')
+    cache.flush_all()
+    exported = self.export([standard.id, set_up.id])
+    self.assertIn('4. Nf3 cxb5 5. O-O *', exported)
+    self.assertIn('1... Kg8 2. a8=Q+', exported)
+
+    totals = import_games(exported.splitlines(keepends=True), processes=1)
+    self.assertEqual((totals['games'], totals['rejected']), (2, 0))
+    imported = list(ChessMatch.objects.exclude(pk__in=[standard.id, set_up.id]).order_by('id'))
+    for original, copy in zip(ChessMatch.objects.filter(pk__in=[standard.id, set_up.id]).order_by('id'), imported):
+      with self.subTest(match=original.id):
+        self.assertEqual((copy.start_fen, copy.fen), (original.start_fen, original.fen))
+        self.assertEqual(self.logged_moves(copy.id), self.logged_moves(original.id))
+    # the same movetext comes out again, only the event names the new matches
+    self.assertEqual(
+      self.export([match.id for match in imported]).split('\n\n')[1::2], exported.split('\n\n')[1::2],
+    )
+
+  def test_malformed_fens_are_rejected(self):
+    for fen in (
+      'not a position',
+      'rnbqkbnrr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+      '9/8/8/8/8/8/8/8 w - - 0 1',
+      'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP w KQkq - 0 1',
+      'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNX w KQkq - 0 1',
+    ):
+      with self.subTest(fen=fen):
+        # the games around the broken one still go in
+        totals = import_games(['1. e4 *\n', '\n', f'[FEN "{fen}"]\n', '\n', '1. e4 *\n', '\n', '1. d4 *\n'], processes=1)
+        self.assertEqual((totals['games'], totals['rejected']), (2, 1))
+
+  def test_games_without_tags(self):
+    totals = import_games(['1. e4 e5 2. Qh5 Nc6 1-0\n', '1. d4 d5\n', '2. c4 *\n', '1. f3 e5 2. g4 Qh4# 0-1\n'], processes=1)
+    self.assertEqual((totals['games'], totals['moves'], totals['rejected']), (3, 11, 0))
+    self.assertEqual(ChessMatch.objects.filter(status=ChessMatch.CHECKMATE, result='0-1').count(), 1)
@@ -1,7 +1,7 @@
 from django.urls import path, include
 from . import views
 
-from graphene_django.views import GraphQLView
+from .graphql_view import LimitedGraphQLView
 
 
 urlpatterns = [
@@ -9,11 +9,19 @@ urlpatterns = [
   path('users/', views.UserList.as_view()),
   #path('users/register/', views.RegisterUser.as_view()),
   path('matches/', views.ChessMatchList.as_view()),
+  path('matches/export/', views.ChessMatchExport.as_view()),
+  path('matches/export/pgn/', views.ChessMatchPGNExport.as_view()),
   path('matches/<int:pk>/', views.ChessMatchDetail.as_view()),
   path('matches/new/', views.CreateNewChessMatch.as_view()),
+  path('matches/new/batch/', views.CreateChessMatchBatch.as_view()),
   path('matches/<int:pk>/join/', views.JoinChessMatch.as_view()),
   path('matches/<int:pk>/reset_pieces/', views.ResetMatch.as_view()),
+  path('matches/<int:pk>/moves/', views.ChessMatchMoves.as_view()),
+  path('matches/<int:pk>/pgn/', views.ChessMatchPGN.as_view()),
   path('pieces/', views.ChessPieceList.as_view()),
+  path('pieces/export/', views.ChessPieceExport.as_view()),
+  path('moves/validate/', views.ValidateMoves.as_view()),
+  path('cache/stats/', views.BoardCacheStats.as_view()),
   #path('matches/<int:pk>/move_piece/<int:piece_pk>/new_position/<int:row>/<int:column>/', views.MovePiece.as_view()),
-  path('graphql/', GraphQLView.as_view(graphiql=True)),
+  path('graphql/', LimitedGraphQLView.as_view(graphiql=True)),
 ]
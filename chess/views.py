@@ -1,18 +1,51 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.shortcuts import render
+from django.db import connection, transaction
+from django.db.models import F
 from django.db.utils import IntegrityError
 from django.contrib.auth.models import User
-from .models import ChessMatch, ChessPiece
-from .serializers import UserSerializer, ChessMatchSerializer, ChessPieceSerializer
-from django.http import Http404
+from django.utils import timezone
+from .models import ChessMatch, ChessMove, ChessPiece
+from .serializers import UserSerializer, ChessMatchSerializer, ChessPieceSerializer, MatchBatchSerializer
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework import generics
 from rest_framework import permissions, authentication
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
+from .board import Board, STARTING_FEN, square_row, square_column
+from .batch_validation import validate_moves
+from .board_cache import board_cache
+from .membership import membership_cache
+from .move_log import moves_after
 from .move_validation import MoveValidator
+from .pgn import export_games
+from .pagination import MatchCursorPagination, PieceCursorPagination, stream_json_array
+from .position_cache import position_cache
+from .snapshots import match_version, match_etag, match_snapshot
+from .outbox import outbound_metrics
+from .spectators import spectator_broadcaster
+
+
+# The 32 pieces of STARTING_FEN as (team, piece_type, row, column), shared by match creation and reset
+STARTING_PIECES = [
+  (piece[0], piece[1], square_row(square), square_column(square))
+  for square, piece in enumerate(Board.from_fen(STARTING_FEN).mailbox)
+  if piece is not None
+]
 
 
+def starting_pieces(match):
+  return [
+    ChessPiece(chess_match=match, team=team, piece_type=piece_type, row=row, column=column)
+    for team, piece_type, row, column in STARTING_PIECES
+  ]
+
 def lobby(request, pk):
   return render(request, 'matches/lobby.html', {})
 
@@ -71,12 +104,116 @@ class RegisterUser(generics.CreateAPIView):
   permission_classes = (permissions.AllowAny,)
 '''
 
+def int_param(request, name):
+  value = request.query_params.get(name)
+  if value is None:
+    return None
+  try:
+    return int(value)
+  except ValueError:
+    raise ValidationError({name: 'must be an integer'})
+
+def filter_matches(queryset, request):
+  """
+  ?user=<id>, ?status=<code> and ?active_since=<ISO datetime> or ?active_within=<seconds>.
+  """
+  user_id = int_param(request, 'user')
+  if user_id is not None:
+    queryset = queryset.filter(users=user_id)
+  match_status = request.query_params.get('status')
+  if match_status is not None:
+    if match_status not in dict(ChessMatch.STATUS_CHOICES):
+      raise ValidationError({'status': f'must be one of {", ".join(dict(ChessMatch.STATUS_CHOICES))}'})
+    queryset = queryset.filter(status=match_status)
+  active_since = request.query_params.get('active_since')
+  if active_since is not None:
+    since = parse_datetime(active_since)
+    if since is None:
+      raise ValidationError({'active_since': 'must be an ISO 8601 datetime'})
+    queryset = queryset.filter(last_activity__gte=since)
+  active_within = int_param(request, 'active_within')
+  if active_within is not None:
+    queryset = queryset.filter(last_activity__gte=timezone.now() - timedelta(seconds=active_within))
+  return queryset
+
+def filter_pieces(queryset, request):
+  """
+  ?match=<id>, ?team=<W|B> and ?captured=<true|false>.
+  """
+  match_id = int_param(request, 'match')
+  if match_id is not None:
+    queryset = queryset.filter(chess_match_id=match_id)
+  team = request.query_params.get('team')
+  if team is not None:
+    queryset = queryset.filter(team=team)
+  captured = request.query_params.get('captured')
+  if captured is not None:
+    queryset = queryset.filter(captured=captured.lower() in ('1', 'true'))
+  return queryset
+
+
 class ChessMatchList(generics.ListAPIView):
+  """
+  GET matches/?user=&status=&active_since=&active_within=&cursor=&page_size=
+  """
   queryset = ChessMatch.objects.all()
   serializer_class = ChessMatchSerializer
+  pagination_class = MatchCursorPagination
+
+  def get_queryset(self):
+    return filter_matches(ChessMatch.objects.prefetch_related('users'), self.request)
 
   permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
+class ChessMatchExport(APIView):
+  """
+  GET matches/export/
+  Every match (same filters as the list) as one JSON array, streamed in keyset chunks so memory stays flat.
+  """
+  def get(self, request, format=None):
+    queryset = filter_matches(ChessMatch.objects.prefetch_related('users'), request)
+    response = StreamingHttpResponse(
+      stream_json_array(queryset, lambda match: ChessMatchSerializer(match).data), content_type='application/json'
+    )
+    response['Content-Disposition'] = 'attachment; filename="matches.json"'
+    return response
+
+  permission_classes = (permissions.IsAdminUser,)
+
+class ChessMatchPGN(APIView):
+  """
+  GET matches/<int:pk>/pgn/
+  """
+  def get(self, request, pk, format=None):
+    # unsaved moves have to reach the move log before it is read
+    board_cache.flush_match(pk)
+    pgn = ''.join(export_games(ChessMatch.objects.filter(pk=pk)))
+    if not pgn:
+      raise Http404
+    response = HttpResponse(pgn, content_type='application/x-chess-pgn')
+    response['Content-Disposition'] = f'attachment; filename="match-{pk}.pgn"'
+    return response
+
+  permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+
+class ChessMatchPGNExport(APIView):
+  """
+  GET matches/export/pgn/
+  The matches (same filters as the list) as one PGN file, streamed in keyset chunks so memory stays flat however
+  many games there are. Anyone but staff only gets their own matches.
+  """
+  def get(self, request, format=None):
+    queryset = filter_matches(ChessMatch.objects.all(), request)
+    if not request.user.is_staff:
+      queryset = queryset.filter(users=request.user)
+    # only the exported matches' unsaved moves have to reach the move log first
+    board_cache.flush_queryset(queryset)
+    response = StreamingHttpResponse(export_games(queryset), content_type='application/x-chess-pgn')
+    response['Content-Disposition'] = 'attachment; filename="matches.pgn"'
+    return response
+
+  permission_classes = (permissions.IsAuthenticated,)
+
 
 class ResetMatch(APIView):
   @staticmethod
@@ -87,177 +224,93 @@ class ResetMatch(APIView):
       raise Http404
 
   @staticmethod
-  def reset_pieces(pieces):
-    black_pawns = pieces.filter(team='B', piece_type='P')
-    white_pawns = pieces.filter(team='W', piece_type='P')
-    
-    for x in range(8):
-      pawn = black_pawns[x]
-      pawn.row = 6
-      pawn.column = x
-      pawn.save()
-
-      pawn = white_pawns[x]
-      pawn.row = 1
-      pawn.column = x
-      pawn.save()
-      
-    black_rooks = pieces.filter(team='B', piece_type='R')
-    white_rooks = pieces.filter(team='W', piece_type='R')
-
-    rook = black_rooks[0]
-    rook.row = 7
-    rook.column = 0
-    rook.save()
-    rook = black_rooks[1]
-    rook.row = 7
-    rook.column = 7
-    rook.save()
-
-    rook = white_rooks[0]
-    rook.row = 0
-    rook.column = 0
-    rook.save()
-    rook = white_rooks[1]
-    rook.row = 0
-    rook.column = 7
-    rook.save()
-
-    black_knights = pieces.filter(team='B', piece_type='KN')
-    white_knights = pieces.filter(team='W', piece_type='KN')
-
-    knight = black_knights[0]
-    knight.row = 7
-    knight.column = 1
-    knight.save()
-    knight = black_knights[1]
-    knight.row = 7
-    knight.column = 6
-    knight.save()
-
-    knight = white_knights[0]
-    knight.row = 0
-    knight.column = 1
-    knight.save()
-    knight = white_knights[1]
-    knight.row = 0
-    knight.column = 6
-    knight.save()
-    
-    black_bishops = pieces.filter(team='B', piece_type='B')
-    white_bishops = pieces.filter(team='W', piece_type='B')
-
-    bishop = black_bishops[0]
-    bishop.row = 7
-    bishop.column = 2
-    bishop.save()
-    bishop = black_bishops[1]
-    bishop.row = 7
-    bishop.column = 5
-    bishop.save()
-
-    bishop = white_bishops[0]
-    bishop.row = 0
-    bishop.column = 2
-    bishop.save()
-    bishop = white_bishops[1]
-    bishop.row = 0
-    bishop.column = 5
-    bishop.save()
-
-    black_queen = pieces.get(team='B', piece_type='Q')
-    white_queen = pieces.get(team='W', piece_type='Q')
-
-    black_queen.row = 7
-    black_queen.column = 4
-    black_queen.save()
-
-    white_queen.row = 0
-    white_queen.column = 3
-    white_queen.save()
-
-    black_king = pieces.get(team='B', piece_type='K')
-    white_king = pieces.get(team='W', piece_type='K')
-
-    black_king.row = 7
-    black_king.column = 3
-    black_king.save()
-
-    white_king.row = 0
-    white_king.column = 4
-    white_king.save()
-
-    for piece in pieces:
-      piece.captured = False
-      piece.move_count = 0
-      piece.save()
+  def reset_pieces(match):
+    # Promoted and captured pieces make matching old rows to starting squares messy, replace them instead
+    ChessPiece.objects.filter(chess_match=match).delete()
+    ChessPiece.objects.bulk_create(starting_pieces(match))
 
   def post(self, request, pk, format=None):
     match = self.get_object(pk)
-    pieces = ChessPiece.objects.filter(chess_match=match)
-    self.reset_pieces(pieces)
+    # unsaved moves of the old game must not be flushed over the reset
+    board_cache.invalidate(match.id)
+    with transaction.atomic():
+      match.fen = match.start_fen = STARTING_FEN
+      match.status = ChessMatch.ACTIVE
+      match.result = ChessMatch.UNDECIDED
+      match.version = F('version') + 1
+      match.last_activity = timezone.now()
+      match.save(update_fields=['fen', 'start_fen', 'status', 'result', 'version', 'last_activity'])
+      ChessMove.objects.filter(chess_match=match).delete()
+      if settings.CHESS_MATERIALIZE_PIECES:
+        self.reset_pieces(match)
+    # and neither may a board loaded while the reset was being written
+    board_cache.invalidate(match.id)
     return Response({'id': match.id, 'match_reset': True}, status=status.HTTP_205_RESET_CONTENT)
 
 class CreateNewChessMatch(APIView):
   @staticmethod
   def create_pieces(match):
-    for col in range(8):
-      black_pawn = ChessPiece(chess_match=match, piece_type='P', team='B', row=6, column=col)
-      black_pawn.save()
-      white_pawn = ChessPiece(chess_match=match, piece_type='P', team='W', row=1, column=col)
-      white_pawn.save()
-
-    black_rook_1 = ChessPiece(chess_match=match, piece_type='R', team='B', row=7, column=0)
-    black_rook_1.save()
-    black_rook_2 = ChessPiece(chess_match=match, piece_type='R', team='B', row=7, column=7)
-    black_rook_2.save()
-    white_rook_1 = ChessPiece(chess_match=match, piece_type='R', team='W', row=0, column=0)
-    white_rook_1.save()
-    white_rook_2 = ChessPiece(chess_match=match, piece_type='R', team='W', row=0, column=7)
-    white_rook_2.save()
-
-    black_knight_1 = ChessPiece(chess_match=match, piece_type='KN', team='B', row=7, column=1)
-    black_knight_1.save()
-    black_knight_2 = ChessPiece(chess_match=match, piece_type='KN', team='B', row=7, column=6)
-    black_knight_2.save()
-    white_knight_1 = ChessPiece(chess_match=match, piece_type='KN', team='W', row=0, column=1)
-    white_knight_1.save()
-    white_knight_2 = ChessPiece(chess_match=match, piece_type='KN', team='W', row=0, column=6)
-    white_knight_2.save()
-
-    black_bishop_1 = ChessPiece(chess_match=match, piece_type='B', team='B', row=7, column=2)
-    black_bishop_1.save()
-    black_bishop_2 = ChessPiece(chess_match=match, piece_type='B', team='B', row=7, column=5)
-    black_bishop_2.save()
-    white_bishop_1 = ChessPiece(chess_match=match, piece_type='B', team='W', row=0, column=2)
-    white_bishop_1.save()
-    white_bishop_2 = ChessPiece(chess_match=match, piece_type='B', team='W', row=0, column=5)
-    white_bishop_2.save()
-
-    black_queen = ChessPiece(chess_match=match, piece_type='Q', team='B', row=7, column=4)
-    black_queen.save()
-    white_queen = ChessPiece(chess_match=match, piece_type='Q', team='W', row=0, column=3)
-    white_queen.save()
-
-    black_king = ChessPiece(chess_match=match, piece_type='K', team='B', row=7, column=3)
-    black_king.save()
-    white_king = ChessPiece(chess_match=match, piece_type='K', team='W', row=0, column=4)
-    white_king.save()
+    ChessPiece.objects.bulk_create(starting_pieces(match))
+
+  @staticmethod
+  def create_matches(pairings):
+    """
+    Creates one match per list of user ids, with users and pieces inserted in bulk.
+    """
+    with transaction.atomic():
+      if connection.features.can_return_ids_from_bulk_insert:
+        matches = ChessMatch.objects.bulk_create([ChessMatch() for _ in pairings])
+      else:
+        matches = [ChessMatch.objects.create() for _ in pairings]
+      ChessMatch.users.through.objects.bulk_create([
+        ChessMatch.users.through(chessmatch_id=match.id, user_id=user_id)
+        for match, user_ids in zip(matches, pairings)
+        for user_id in user_ids
+      ])
+      if settings.CHESS_MATERIALIZE_PIECES:
+        ChessPiece.objects.bulk_create([piece for match in matches for piece in starting_pieces(match)])
+    for match, user_ids in zip(matches, pairings):
+      membership_cache.set_players(match.id, user_ids)
+    return matches
 
   def post(self, request, format=None):
     request_data = request.data.copy()
     request_data.update({'users': [request.user.id]})
     serializer = ChessMatchSerializer(data=request_data)
     if serializer.is_valid():
-      serializer.save()
-      match = ChessMatch.objects.get(pk=serializer.data['id'])
-      self.create_pieces(match)
-      match.save()
+      with transaction.atomic():
+        match = serializer.save()
+        if settings.CHESS_MATERIALIZE_PIECES:
+          self.create_pieces(match)
+      membership_cache.set_players(match.id, [request.user.id])
       return Response(serializer.data, status=status.HTTP_201_CREATED)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
   permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
+class CreateChessMatchBatch(APIView):
+  """
+  POST matches/new/batch/
+  Creates a whole tournament round at once, either {"pairings": [[user_id, user_id], ...]} or {"count": K} empty matches.
+  """
+  def post(self, request, format=None):
+    serializer = MatchBatchSerializer(data=request.data)
+    if not serializer.is_valid():
+      return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    pairings = serializer.validated_data['pairings']
+
+    user_ids = {user_id for user_ids in pairings for user_id in user_ids}
+    if User.objects.filter(pk__in=user_ids).count() != len(user_ids):
+      return Response(data={'message': 'unknown user id in pairings'}, status=status.HTTP_400_BAD_REQUEST)
+
+    matches = CreateNewChessMatch.create_matches(pairings)
+    return Response(
+      [{'id': match.id, 'users': user_ids} for match, user_ids in zip(matches, pairings)],
+      status=status.HTTP_201_CREATED
+    )
+
+  permission_classes = (permissions.IsAdminUser,)
+
 class JoinChessMatch(APIView):
   """
   POST matches/<int:pk>/join/
@@ -269,40 +322,122 @@ class JoinChessMatch(APIView):
     except ChessMatch.DoesNotExist:
       raise Http404
   
+  # Attempts when the match keeps changing between reading its seats and taking one
+  JOIN_ATTEMPTS = 5
+
   def post(self, request, pk, format=None):
     match = self.get_object(pk)
-    if len(match.users.values()) < 2:
-      match.users.add(request.user)
-      match.save()
-      return Response({'id': match.id, 'joined_match': True}, status=status.HTTP_200_OK) # Add status codes
+    for _ in range(self.JOIN_ATTEMPTS):
+      # version first: a join landing after it was read fails the compare-and-set below even if the seats read fine
+      version = ChessMatch.objects.values_list('version', flat=True).get(pk=match.id)
+      user_ids = list(match.users.values_list('id', flat=True))
+      if request.user.id in user_ids:
+        return Response({'id': match.id, 'joined_match': True}, status=status.HTTP_200_OK)
+      if len(user_ids) >= 2:
+        break
+      # The seat is only taken if nobody changed the match since its seats were read, so two players can't both
+      # get the last one
+      with transaction.atomic():
+        if board_cache.bump_version(match.id, expected=version):
+          match.users.add(request.user)
+          membership_cache.invalidate(match.id)
+          return Response({'id': match.id, 'joined_match': True}, status=status.HTTP_200_OK) # Add status codes
     return Response({'id': match.id, 'joined_match': False}, status=status.HTTP_400_BAD_REQUEST)
 
 class ChessPieceList(generics.ListAPIView):
+  """
+  GET pieces/?match=&team=&captured=&cursor=&page_size=
+  """
   queryset = ChessPiece.objects.all()
   serializer_class = ChessPieceSerializer
+  pagination_class = PieceCursorPagination
+
+  def get_queryset(self):
+    return filter_pieces(ChessPiece.objects.all(), self.request)
 
   permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
-class ChessMatchDetail(APIView):
-  @staticmethod
-  def get_object(pk):
+class ChessPieceExport(APIView):
+  """
+  GET pieces/export/
+  """
+  def get(self, request, format=None):
+    queryset = filter_pieces(ChessPiece.objects.all(), request)
+    response = StreamingHttpResponse(
+      stream_json_array(queryset, lambda piece: ChessPieceSerializer(piece).data), content_type='application/json'
+    )
+    response['Content-Disposition'] = 'attachment; filename="pieces.json"'
+    return response
+
+  permission_classes = (permissions.IsAdminUser,)
+
+class ChessMatchMoves(APIView):
+  """
+  GET matches/<int:pk>/moves/?after=<seq>
+  Moves played after seq, so a client that missed frames can catch up without reloading the board.
+  """
+  def get(self, request, pk, format=None):
     try:
-      return ChessMatch.objects.get(pk=pk)
-    except ChessMatch.DoesNotExist:
-      raise Http404
+      after = int(request.query_params.get('after', 0))
+    except ValueError:
+      return Response(data={'message': 'after must be a move sequence number'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({'id': pk, 'moves': moves_after(pk, after, board_cache.peek(pk))})
+
+  permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
+class ValidateMoves(APIView):
+  """
+  POST moves/validate/ {"moves": [{"fen": ..., "move": "e2e4"}, ...]}
+  Moves may also be given as from_row, from_column, row, column and promotion. Results come back in the same order.
+  """
+  def post(self, request, format=None):
+    moves = request.data.get('moves')
+    if not isinstance(moves, list) or not all(isinstance(move, dict) for move in moves):
+      return Response(data={'message': 'moves must be a list of objects'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(moves) > settings.CHESS_BATCH_VALIDATION['MAX_ITEMS']:
+      return Response(
+        data={'message': f'at most {settings.CHESS_BATCH_VALIDATION["MAX_ITEMS"]} moves per request'},
+        status=status.HTTP_400_BAD_REQUEST
+      )
+    return Response({'results': validate_moves(moves)})
+
+  permission_classes = (permissions.IsAuthenticated,)
+
+class BoardCacheStats(APIView):
+  """
+  GET cache/stats/
+  Hit rate and write-behind lag of the board cache, plus the position cache, spectator broadcasts and per-match
+  outbound queues, in the worker that serves the request.
+  """
+  def get(self, request, format=None):
+    return Response({
+      **board_cache.stats(),
+      'positions': position_cache.stats(),
+      'spectators': spectator_broadcaster.stats(),
+      'outbound': outbound_metrics.stats(),
+    })
+
+  permission_classes = (permissions.IsAdminUser,)
+
+class ChessMatchDetail(APIView):
+  """
+  GET matches/<int:pk>/
+  Sends an ETag with the match version and answers If-None-Match with 304 while the match is unchanged.
+  """
   queryset = ChessMatch.objects.all()
   serializer_class = ChessMatchSerializer
 
   def get(self, request, pk, format=None):
-    match = self.get_object(pk)
-    users = []
-    for user in match.users.all():
-      users.append({'id': user.id, 'username': user.username})
-
-    pieces = ChessPiece.objects.filter(chess_match=match).values()
+    try:
+      version = match_version(pk)
+    except ChessMatch.DoesNotExist:
+      raise Http404
+    etag = match_etag(pk, version)
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+      return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
 
-    return Response({'id': match.id, 'users': users, 'pieces': pieces})
+    snapshot = match_snapshot(pk, version)
+    return Response(snapshot, headers={'ETag': match_etag(pk, snapshot['version'])})
 
   permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
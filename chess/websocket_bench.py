@@ -0,0 +1,174 @@
+"""
+Load generator for ChessMatchConsumer. Every simulated match has two players connected through
+chess_backend.routing.application, JWTAuthMiddleware included, who take turns sending random legal moves at a
+fixed rate. The time from a move being sent to the opponent receiving its broadcast is recorded per move.
+Optional spectators watch each match meanwhile, to show what they cost the players.
+"""
+import asyncio
+import random
+import threading
+import time
+import uuid
+
+import jwt
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+from .board import Board, STARTING_FEN, WHITE, BLACK, PROMOTION_PIECES, square_row, square_column
+from .board_cache import board_cache
+from .membership import membership_cache
+from .views import CreateNewChessMatch
+
+
+class QueryCounter:
+  """
+  Counts queries on every connection, including the ones the consumers open in the database thread pool.
+  """
+  def __init__(self):
+    self.count = 0
+    self.lock = threading.Lock()
+    self.connections = []
+
+  def __call__(self, execute, sql, params, many, context):
+    with self.lock:
+      self.count += 1
+    return execute(sql, params, many, context)
+
+  def _watch(self, sender, connection, **kwargs):
+    # connection_created fires again whenever a thread reconnects, count each query once
+    if self not in connection.execute_wrappers:
+      connection.execute_wrappers.append(self)
+      self.connections.append(connection)
+
+  def __enter__(self):
+    connection_created.connect(self._watch)
+    self._watch(None, connection)
+    return self
+
+  def __exit__(self, *exc_info):
+    connection_created.disconnect(self._watch)
+    for watched in self.connections:
+      if self in watched.execute_wrappers:
+        watched.execute_wrappers.remove(self)
+
+
+def make_token(user):
+  return jwt.encode({'user_id': user.id, 'username': user.username}, settings.SECRET_KEY, algorithm='HS256').decode('utf-8')
+
+def percentile(values, percent):
+  if not values:
+    return None
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+def create_matches(count):
+  prefix = f'bench-{uuid.uuid4().hex[:8]}-'
+  User.objects.bulk_create([User(username=f'{prefix}{index}') for index in range(count * 2)])
+  # bulk_create only returns ids on some backends
+  users = list(User.objects.filter(username__startswith=prefix).order_by('id'))
+  pairings = [[users[index * 2].id, users[index * 2 + 1].id] for index in range(count)]
+  matches = CreateNewChessMatch.create_matches(pairings)
+  return [(match, users[index * 2], users[index * 2 + 1]) for index, match in enumerate(matches)]
+
+async def watch_match(communicator, stats):
+  while True:
+    await communicator.receive_output(None)
+    stats['spectator_frames'] += 1
+
+async def play_match(application, match, white, black, moves, interval, rng, stats, timeout, spectators=()):
+  watchers = []
+  for user in spectators:
+    communicator = WebsocketCommunicator(application, f'/ws/chess/matches/lobby/{match.id}/?{make_token(user)}')
+    connected, _ = await communicator.connect(timeout)
+    if not connected:
+      raise RuntimeError(f'{user.username} could not watch match {match.id}')
+    watchers.append((communicator, asyncio.ensure_future(watch_match(communicator, stats))))
+  players = {}
+  for team, user in ((WHITE, white), (BLACK, black)):
+    communicator = WebsocketCommunicator(application, f'/ws/chess/matches/lobby/{match.id}/?{make_token(user)}')
+    connected, _ = await communicator.connect(timeout)
+    if not connected:
+      raise RuntimeError(f'{user.username} could not connect to match {match.id}')
+    await communicator.receive_json_from(timeout)
+    players[team] = communicator
+
+  board = Board.from_fen(STARTING_FEN)
+  next_move_at = time.perf_counter()
+  try:
+    for _ in range(moves):
+      legal_moves = list(board.legal_moves())
+      if not legal_moves:
+        break
+      move = rng.choice(legal_moves)
+      mover, opponent = players[board.turn], players[BLACK if board.turn == WHITE else WHITE]
+      sent = time.perf_counter()
+      await mover.send_json_to({'message': {
+        'from_row': square_row(move & 63),
+        'from_column': square_column(move & 63),
+        'row': square_row((move >> 6) & 63),
+        'column': square_column((move >> 6) & 63),
+        'promotion': PROMOTION_PIECES[move >> 12],
+      }})
+      message = (await opponent.receive_json_from(timeout))['message']
+      stats['latencies'].append(time.perf_counter() - sent)
+      await mover.receive_json_from(timeout)
+      if not message['move_valid']:
+        stats['invalid'] += 1
+        break
+      board.push(move)
+      if message['status'] != 'Active':
+        break
+      next_move_at += interval
+      await asyncio.sleep(max(0, next_move_at - time.perf_counter()))
+  finally:
+    for communicator in players.values():
+      await communicator.disconnect()
+    for communicator, watcher in watchers:
+      watcher.cancel()
+      await communicator.disconnect()
+
+async def run_matches(matches, moves, rate, seed, timeout, spectators=()):
+  from chess_backend.routing import application
+
+  stats = {'latencies': [], 'invalid': 0, 'spectator_frames': 0}
+  interval = 1 / rate if rate else 0
+  await asyncio.gather(*(
+    play_match(application, match, white, black, moves, interval, random.Random(seed + index), stats, timeout, spectators)
+    for index, (match, white, black) in enumerate(matches)
+  ))
+  return stats
+
+def run_benchmark(matches=10, moves=40, rate=2.0, seed=0, timeout=10, spectators=0):
+  """
+  Plays `matches` matches of up to `moves` plies, each match moving `rate` times a second and watched by
+  `spectators` spectators, and returns latency percentiles in milliseconds, throughput and database queries per move.
+  """
+  created = create_matches(matches)
+  # one user is enough, nobody but the two players of a match is anything but a spectator
+  watchers = [User.objects.create(username=f'bench-{uuid.uuid4().hex[:8]}-spectator')] * spectators
+  with QueryCounter() as queries:
+    started = time.perf_counter()
+    stats = asyncio.get_event_loop().run_until_complete(run_matches(created, moves, rate, seed, timeout, watchers))
+    seconds = time.perf_counter() - started
+  for match, _, _ in created:
+    board_cache.invalidate(match.id)
+    membership_cache.invalidate(match.id)
+
+  latencies = stats['latencies']
+  played = len(latencies)
+  return {
+    'matches': matches,
+    'moves': played,
+    'invalid_moves': stats['invalid'],
+    'seconds': seconds,
+    'moves_per_second': played / seconds if seconds else 0,
+    'p50_ms': percentile(latencies, 50) * 1000 if played else None,
+    'p95_ms': percentile(latencies, 95) * 1000 if played else None,
+    'p99_ms': percentile(latencies, 99) * 1000 if played else None,
+    'queries': queries.count,
+    'queries_per_move': queries.count / played if played else None,
+    'spectator_frames': stats['spectator_frames'],
+  }
@@ -0,0 +1,82 @@
+"""
+Per-move write throughput of the configured database. Worker threads, standing in for the consumers' database
+pool, each play random legal moves on their own matches through ChessMatchConsumer.apply_move and write them
+with the board cache's flush, so the numbers cover exactly what the move path writes: the match row, the move
+log and, while pieces are materialized, the ChessPiece rows.
+"""
+import random
+import threading
+import time
+
+from django.db import close_old_connections, connection
+
+from .board import ACTIVE, PROMOTION_PIECES, square_row, square_column
+from .board_cache import BoardCache
+from .consumers import ChessMatchConsumer
+from .views import CreateNewChessMatch
+
+
+def play_moves(cache, match_ids, moves, rng, stats):
+  try:
+    lives = [cache.get(match_id) for match_id in match_ids]
+    for _ in range(moves):
+      for live in lives:
+        if live.status != ACTIVE:
+          continue
+        legal_moves = list(live.board.legal_moves())
+        move = rng.choice(legal_moves)
+        from_square, to_square = move & 63, (move >> 6) & 63
+        started = time.perf_counter()
+        result = ChessMatchConsumer.apply_move(
+          live, None, square_row(to_square), square_column(to_square), PROMOTION_PIECES[move >> 12],
+          square_row(from_square), square_column(from_square),
+        )
+        if cache.flush_due(live):
+          cache.flush(live)
+        with stats['lock']:
+          stats['latencies'].append(time.perf_counter() - started)
+          stats['moves'] += result['move_valid']
+    for live in lives:
+      cache.flush(live)
+  except Exception as error:
+    with stats['lock']:
+      stats['errors'].append(repr(error))
+  finally:
+    close_old_connections()
+
+def run_benchmark(matches=20, moves=40, threads=8, flush_every_moves=1, compare_and_set=False, seed=0):
+  """
+  Plays `moves` plies in each of `matches` matches spread over `threads` threads, flushing every
+  `flush_every_moves` moves, and returns moves per second and write latency percentiles in milliseconds.
+  """
+  # ended games are flushed straight away, the interval flusher never gets a say
+  cache = BoardCache(
+    max_matches=matches, flush_every_moves=flush_every_moves, flush_interval_ms=3600 * 1000, compare_and_set=compare_and_set,
+  )
+  match_ids = [match.id for match in CreateNewChessMatch.create_matches([[] for _ in range(matches)])]
+  stats = {'lock': threading.Lock(), 'latencies': [], 'moves': 0, 'errors': []}
+  workers = [
+    threading.Thread(target=play_moves, args=(cache, match_ids[index::threads], moves, random.Random(seed + index), stats))
+    for index in range(threads)
+  ]
+  started = time.perf_counter()
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  seconds = time.perf_counter() - started
+
+  latencies = sorted(stats['latencies'])
+  return {
+    'vendor': connection.vendor,
+    'matches': matches,
+    'threads': threads,
+    'flush_every_moves': flush_every_moves,
+    'moves': stats['moves'],
+    'seconds': seconds,
+    'moves_per_second': stats['moves'] / seconds if seconds else 0,
+    'p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else None,
+    'p99_ms': latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000 if latencies else None,
+    'flushed_moves': cache.flushed_moves,
+    'errors': stats['errors'],
+  }
@@ -0,0 +1,23 @@
+"""
+Zobrist keys for the bitboard engine in board.py.
+
+Keys are 63 bits wide so a position hash always fits a signed BIGINT column. They come from a fixed seed,
+which keeps hashes stable across processes and restarts and lets them be stored and shared as cache keys.
+"""
+import random
+
+WHITE = 'W'
+BLACK = 'B'
+PIECE_TYPES = ('P', 'KN', 'B', 'R', 'Q', 'KI')
+
+_random = random.Random(0x5EED)
+
+def _key():
+  return _random.getrandbits(63)
+
+
+PIECE_KEYS = {team: {piece_type: [_key() for _ in range(64)] for piece_type in PIECE_TYPES} for team in (WHITE, BLACK)}
+# One key per combination of the four castling flags
+CASTLING_KEYS = [_key() for _ in range(16)]
+EN_PASSANT_KEYS = [_key() for _ in range(8)]
+BLACK_TO_MOVE_KEY = _key()
@@ -1,48 +1,116 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
 import jwt
 from .settings import SECRET_KEY
-from django.db import close_old_connections
+from django.conf import settings
 
+from channels.auth import UserLazyObject
+from channels.middleware import BaseMiddleware
 from rest_framework.authtoken.models import Token
-from django.contrib.auth.models import User
+
+from chess.executor import database_sync_to_async
 
 
-class JWTAuthMiddleware:
+class VerifiedTokenCache:
   """
-  Custom middleware that finds the user by decoding the JWT (JSON Web Token) in the query string.
-  The user is then added to the URLRouter scope.
+  Bounded LRU of JWT verification results keyed by the token's SHA-256 digest. A verified payload is reused
+  until the token's exp or ttl_seconds, whichever comes first, so a reconnect storm verifies each token once.
+  Rejections are remembered for reject_ttl_seconds so a flood of bad tokens costs a hash each, not an HMAC.
   """
-  def __init__(self, inner):
-    self.inner = inner
+  def __init__(self, max_entries=10000, ttl_seconds=300, reject_ttl_seconds=30):
+    self.max_entries = max_entries
+    self.ttl_seconds = ttl_seconds
+    self.reject_ttl_seconds = reject_ttl_seconds
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, digest):
+    """
+    (hit, payload), payload is None for a remembered rejection.
+    """
+    with self.lock:
+      entry = self.entries.get(digest)
+      if entry is None:
+        return False, None
+      payload, expires = entry
+      if expires <= time.time():
+        del self.entries[digest]
+        return False, None
+      self.entries.move_to_end(digest)
+      return True, payload
 
-  def __call__(self, scope):
+  def set(self, digest, payload):
+    now = time.time()
+    if payload is None:
+      expires = now + self.reject_ttl_seconds
+    else:
+      expires = now + self.ttl_seconds
+      if isinstance(payload.get('exp'), (int, float)):
+        expires = min(expires, payload['exp'])
+    with self.lock:
+      self.entries[digest] = (payload, expires)
+      self.entries.move_to_end(digest)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+
+token_cache = VerifiedTokenCache(**{key.lower(): value for key, value in settings.CHESS_JWT_CACHE.items()})
+
+
+def verify_jwt(jwt_token):
+  """
+  The token's payload, or None when it is missing, malformed, expired or badly signed.
+  """
+  if not jwt_token or len(jwt_token) > settings.CHESS_JWT_MAX_LENGTH:
+    return None
+  digest = hashlib.sha256(jwt_token.encode('utf-8')).digest()
+  hit, payload = token_cache.get(digest)
+  if not hit:
     try:
-      jwt_token = scope['query_string'].decode('utf-8')
-      user = jwt.decode(jwt_token, SECRET_KEY, algorithms=['HS256'])
-    except jwt.exceptions.ExpiredSignatureError:
-      user = None
-    except jwt.exceptions.InvalidSignatureError:
-      user = None
+      payload = jwt.decode(jwt_token, SECRET_KEY, algorithms=['HS256'])
+    except jwt.exceptions.InvalidTokenError:
+      payload = None
+    if not isinstance(payload, dict):
+      payload = None
+    token_cache.set(digest, payload)
+  return payload
+
+def query_token(scope):
+  try:
+    return scope['query_string'].decode('utf-8')
+  except (KeyError, UnicodeDecodeError):
+    return None
 
-    # Return the inner application directly and let it run everything else
-    return self.inner(dict(scope, user=user))
 
-class TokenAuthMiddleware:
+class JWTAuthMiddleware(BaseMiddleware):
+  """
+  Custom middleware that finds the user by decoding the JWT (JSON Web Token) in the query string.
+  The user is then added to the URLRouter scope.
+  """
+  def populate_scope(self, scope):
+    # Filled in by resolve_scope once the connection is running on the event loop
+    scope['user'] = UserLazyObject()
+
+  async def resolve_scope(self, scope):
+    # Verification is CPU only and usually a cache hit, no need to leave the loop for it
+    scope['user']._wrapped = verify_jwt(query_token(scope))
+
+class TokenAuthMiddleware(BaseMiddleware):
   """
   Custom middleware that finds user by the token in the query string.
   """
-  def __init__(self, inner):
-    self.inner = inner
+  def populate_scope(self, scope):
+    scope['user'] = UserLazyObject()
 
-  def __call__(self, scope):
-    # Close old database connections to prevent usage of timed out connections
-    close_old_connections()
-    #print(scope)
-    #print(type(scope['query_string']))
-    try:
-      token = Token.objects.get(pk=scope['query_string'].decode('utf-8'))
-      user = User.objects.get(pk=token.user.id)
-    except Token.DoesNotExist:
-      user = None
+  async def resolve_scope(self, scope):
+    scope['user']._wrapped = await database_sync_to_async(self.get_user)(query_token(scope))
 
-    # Return the inner application directly and let it run everything else
-    return self.inner(dict(scope, user=user))
+  @staticmethod
+  def get_user(key):
+    if not key:
+      return None
+    token = Token.objects.select_related('user').filter(pk=key).first()
+    return token.user if token is not None else None
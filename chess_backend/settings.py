@@ -98,10 +98,27 @@ REST_FRAMEWORK = {
 
 REST_USE_JWT = True
 
+# Verified websocket JWTs remembered by chess_backend/middleware.py, until their exp or TTL_SECONDS
+CHESS_JWT_CACHE = {
+  'MAX_ENTRIES': env.int('CHESS_JWT_CACHE_MAX_ENTRIES', 10000),
+  'TTL_SECONDS': env.int('CHESS_JWT_CACHE_TTL_SECONDS', 300),
+  'REJECT_TTL_SECONDS': env.int('CHESS_JWT_CACHE_REJECT_TTL_SECONDS', 30),
+}
+# Longer query strings are rejected without hashing or decoding them
+CHESS_JWT_MAX_LENGTH = env.int('CHESS_JWT_MAX_LENGTH', 4096)
+
 GRAPHENE = {
   'SCHEMA': 'chess_backend.schema.schema',
 }
 
+# Page sizes of the GraphQL connections and the limits chess/graphql_view.py enforces before a query runs
+CHESS_GRAPHQL = {
+  'DEFAULT_PAGE_SIZE': env.int('CHESS_GRAPHQL_DEFAULT_PAGE_SIZE', 20),
+  'MAX_PAGE_SIZE': env.int('CHESS_GRAPHQL_MAX_PAGE_SIZE', 100),
+  'MAX_DEPTH': env.int('CHESS_GRAPHQL_MAX_DEPTH', 8),
+  'MAX_COST': env.int('CHESS_GRAPHQL_MAX_COST', 10000),
+}
+
 ROOT_URLCONF = 'chess_backend.urls'
 ASGI_APPLICATION = "chess_backend.routing.application"
 CHANNEL_LAYERS = {
@@ -113,6 +130,92 @@ CHANNEL_LAYERS = {
   },
 }
 
+# Matches whose player seats are remembered by each worker, see chess/membership.py
+CHESS_MEMBERSHIP_CACHE_MAX_MATCHES = env.int('CHESS_MEMBERSHIP_CACHE_MAX_MATCHES', 10000)
+# How long a user is taken for a spectator of a match with a free seat before its seats are read again, in case
+# they joined through another worker
+CHESS_MEMBERSHIP_CACHE_MISS_SECONDS = env.int('CHESS_MEMBERSHIP_CACHE_MISS_SECONDS', 5)
+
+# Threads the websocket consumers may use for database calls, see chess/executor.py
+CHESS_DB_THREADS = env.int('CHESS_DB_THREADS', 8)
+
+# ChessMatch.fen is the authoritative position, ChessPiece rows are only kept up to date while this is on
+CHESS_MATERIALIZE_PIECES = env.bool('CHESS_MATERIALIZE_PIECES', True)
+
+# Legal move lists and other per-position results shared across matches, see chess/position_cache.py
+CHESS_POSITION_CACHE_MAX_ENTRIES = env.int('CHESS_POSITION_CACHE_MAX_ENTRIES', 100000)
+
+# Move generator benchmark, see chess/perft.py. Runs fail when nodes/s drops more than TOLERANCE_PERCENT below BASELINE
+CHESS_PERFT = {
+  'BASELINE': env.str('CHESS_PERFT_BASELINE', os.path.join(BASE_DIR, 'chess', 'perft_baseline.json')),
+  'TOLERANCE_PERCENT': env.float('CHESS_PERFT_TOLERANCE_PERCENT', 20),
+}
+
+# Batch move validation, see chess/batch_validation.py. Batches of POOL_THRESHOLD items or more are split into
+# CHUNK_SIZE chunks across PROCESSES worker processes
+CHESS_BATCH_VALIDATION = {
+  'MAX_ITEMS': env.int('CHESS_BATCH_VALIDATION_MAX_ITEMS', 20000),
+  'POOL_THRESHOLD': env.int('CHESS_BATCH_VALIDATION_POOL_THRESHOLD', 2000),
+  'CHUNK_SIZE': env.int('CHESS_BATCH_VALIDATION_CHUNK_SIZE', 500),
+  'PROCESSES': env.int('CHESS_BATCH_VALIDATION_PROCESSES', os.cpu_count() or 1),
+}
+
+# Bulk PGN import, see chess/pgn_import.py. CHUNK_SIZE games are parsed per task on PROCESSES worker processes and
+# written in one transaction, BATCH_SIZE rows per INSERT
+CHESS_PGN_IMPORT = {
+  'CHUNK_SIZE': env.int('CHESS_PGN_IMPORT_CHUNK_SIZE', 200),
+  'PROCESSES': env.int('CHESS_PGN_IMPORT_PROCESSES', os.cpu_count() or 1),
+  'BATCH_SIZE': env.int('CHESS_PGN_IMPORT_BATCH_SIZE', 1000),
+}
+
+# Cursor pages of the match and piece listings, and the chunk size of their streamed exports
+CHESS_LIST_PAGE_SIZE = env.int('CHESS_LIST_PAGE_SIZE', 50)
+CHESS_LIST_MAX_PAGE_SIZE = env.int('CHESS_LIST_MAX_PAGE_SIZE', 500)
+CHESS_EXPORT_CHUNK_SIZE = env.int('CHESS_EXPORT_CHUNK_SIZE', 1000)
+
+# How long ChessMatchDetail snapshots stay in the cache, they are keyed by match version so never go stale
+CHESS_SNAPSHOT_CACHE_SECONDS = env.int('CHESS_SNAPSHOT_CACHE_SECONDS', 300)
+
+# Live boards kept in each worker process, see chess/board_cache.py
+CHESS_BOARD_CACHE = {
+  'MAX_MATCHES': env.int('CHESS_BOARD_CACHE_MAX_MATCHES', 1000),
+  'TTL_SECONDS': env.int('CHESS_BOARD_CACHE_TTL_SECONDS', 600),
+  'FLUSH_EVERY_MOVES': env.int('CHESS_BOARD_CACHE_FLUSH_EVERY_MOVES', 10),
+  'FLUSH_INTERVAL_MS': env.int('CHESS_BOARD_CACHE_FLUSH_INTERVAL_MS', 2000),
+  # Set when several worker processes serve the same matches: every move is written at once with a
+  # compare-and-set on ChessMatch.version instead of being batched by the write-behind flush
+  'COMPARE_AND_SET': env.bool('CHESS_BOARD_CACHE_COMPARE_AND_SET', False),
+}
+
+# Spectators of a match get at most one position frame per INTERVAL_MS, fanned out over SHARDS groups,
+# see chess/spectators.py
+CHESS_SPECTATORS = {
+  'INTERVAL_MS': env.int('CHESS_SPECTATORS_INTERVAL_MS', 500),
+  'SHARDS': env.int('CHESS_SPECTATORS_SHARDS', 16),
+  # Cache alias the audience of each shard is counted in. Every worker has to see the same counts, so with
+  # COMPARE_AND_SET on this must be a shared cache (Redis, memcached), a locmem one is refused at startup
+  'CACHE': env.str('CHESS_SPECTATORS_CACHE', 'default'),
+}
+
+# Frames a match socket may have queued, or moves its client may be behind on acknowledging, before POLICY kicks
+# in: 'coalesce' replaces the queue with the latest board, 'disconnect' closes the socket with a resync code.
+# Under daphne only acknowledging clients can fall behind, see chess/outbox.py
+CHESS_OUTBOUND = {
+  'HIGH_WATER': env.int('CHESS_OUTBOUND_HIGH_WATER', 64),
+  'POLICY': env.str('CHESS_OUTBOUND_POLICY', 'coalesce'),
+}
+
+# Matchmaking queue, see chess/matchmaking.py. Players are bucketed by time control and RATING_BAND wide rating
+# bands, and may be paired with a neighbouring band after WIDEN_AFTER_SECONDS
+CHESS_MATCHMAKING = {
+  'RATING_BAND': env.int('CHESS_MATCHMAKING_RATING_BAND', 200),
+  'WIDEN_AFTER_SECONDS': env.int('CHESS_MATCHMAKING_WIDEN_AFTER_SECONDS', 10),
+  'PAIR_INTERVAL_MS': env.int('CHESS_MATCHMAKING_PAIR_INTERVAL_MS', 250),
+  'MAX_PAIRS_PER_TICK': env.int('CHESS_MATCHMAKING_MAX_PAIRS_PER_TICK', 500),
+  'DEFAULT_RATING': env.int('CHESS_MATCHMAKING_DEFAULT_RATING', 1500),
+  'TIME_CONTROLS': env.list('CHESS_MATCHMAKING_TIME_CONTROLS', default=['1+0', '3+2', '5+0', '10+0', '15+10']),
+}
+
 TEMPLATES = [
   {
     'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -135,12 +238,40 @@ WSGI_APPLICATION = 'chess_backend.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
 
-DATABASES = {
-  'default': {
-    'ENGINE': 'django.db.backends.sqlite3',
-    'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# DATABASE_ENGINE is sqlite (the default) or postgresql. CONN_MAX_AGE keeps connections open between requests;
+# the websocket consumers only touch the database from the CHESS_DB_THREADS pool threads, so each worker then
+# holds a fixed pool of that many connections. Behind PgBouncer in transaction mode set
+# DATABASE_DISABLE_SERVER_SIDE_CURSORS, since iterator() cursors can't outlive a transaction there.
+DATABASE_ENGINE = env.str('DATABASE_ENGINE', 'sqlite')
+
+if DATABASE_ENGINE == 'postgresql':
+  DATABASES = {
+    'default': {
+      'ENGINE': 'django.db.backends.postgresql',
+      'NAME': env.str('DATABASE_NAME', 'chess'),
+      'USER': env.str('DATABASE_USER', 'chess'),
+      'PASSWORD': env.str('DATABASE_PASSWORD', ''),
+      'HOST': env.str('DATABASE_HOST', '127.0.0.1'),
+      'PORT': env.int('DATABASE_PORT', 5432),
+      'CONN_MAX_AGE': env.int('DATABASE_CONN_MAX_AGE', 600),
+      'DISABLE_SERVER_SIDE_CURSORS': env.bool('DATABASE_DISABLE_SERVER_SIDE_CURSORS', False),
+      'OPTIONS': {
+        'connect_timeout': env.int('DATABASE_CONNECT_TIMEOUT', 5),
+      },
+    }
+  }
+else:
+  DATABASES = {
+    'default': {
+      'ENGINE': 'django.db.backends.sqlite3',
+      'NAME': env.str('DATABASE_NAME', os.path.join(BASE_DIR, 'db.sqlite3')),
+      'CONN_MAX_AGE': env.int('DATABASE_CONN_MAX_AGE', 0),
+      'OPTIONS': {
+        # seconds a writer waits for the file lock before failing with "database is locked"
+        'timeout': env.int('DATABASE_TIMEOUT', 20),
+      },
+    }
   }
-}
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 